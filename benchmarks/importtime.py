@@ -0,0 +1,86 @@
+"""
+Import time of every function of the app, the part of the cold start spent in Python.
+
+Every function is imported in a fresh interpreter with `python -X importtime`, and the
+best of `--repeat` runs is reported with the packages which took longest. The `(all)`
+row imports all functions in one interpreter, like the worker does when it starts.
+
+    python -m benchmarks.importtime --repeat 5 --json importtime.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARKER = 'benchmark-imports-start'
+# The worker imports azure.functions before any function
+PRELOADED = ['azure.functions']
+
+
+def function_names():
+    return sorted(name for name in os.listdir(ROOT) if os.path.isfile(os.path.join(ROOT, name, 'function.json')))
+
+
+def parse_importtime(stderr):
+    """
+    Cumulative microseconds of the modules imported at the top level after the marker,
+    the imports of the interpreter startup and the preloaded modules come before it.
+    """
+    imports = {}
+    started = False
+    for line in stderr.splitlines():
+        if MARKER in line:
+            started = True
+            continue
+        if not started or not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def measure(names):
+    code = (f"import importlib, sys\n"
+            f"for name in {PRELOADED!r}: importlib.import_module(name)\n"
+            f"print({MARKER!r}, file=sys.stderr)\n"
+            f"for name in {names!r}: importlib.import_module(name)\n")
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr)
+    return parse_importtime(process.stderr)
+
+
+def best_of(names, repeat):
+    runs = [measure(names) for _ in range(repeat)]
+    return min(runs, key=lambda imports: sum(imports.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--top', default=5, type=int, help='number of slowest packages to show per function')
+    parser.add_argument('--json', help='also write the results to this file, to compare runs')
+    args = parser.parse_args()
+
+    names = function_names()
+    results = {}
+    for label, modules in [(name, [name]) for name in names] + [('(all)', names)]:
+        imports = best_of(modules, args.repeat)
+        # The function modules themselves are not packages worth listing
+        packages = sorted(((n, t) for n, t in imports.items() if n not in names), key=lambda i: -i[1])
+        results[label] = {'totalMs': sum(imports.values()) / 1000,
+                          'packages': {n: t / 1000 for n, t in packages[:args.top]}}
+        print(f"{label:<36} {results[label]['totalMs']:8.1f} ms   "
+              + ', '.join(f'{n} {t:.0f}' for n, t in results[label]['packages'].items()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Load the sample retail data into a local PostgreSQL database for the benchmarks.
+
+Either restores `data/retail_org.dump` with pg_restore, or creates the tables from
+`data/products.csv` and `data/sales_orders_s.csv`. Customers are not part of the CSV
+files, so in that case they are generated from the customer IDs of the orders. The
+orders can be duplicated `--scale` times to benchmark larger result sets.
+
+    python -m benchmarks.load_data --host localhost --user postgres --password postgres --scale 10
+"""
+import argparse
+import os
+import subprocess
+
+import psycopg2
+from psycopg2 import sql
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+STATES = ['AK', 'AZ', 'CA', 'CO', 'FL', 'GA', 'IL', 'MA', 'NY', 'OR', 'TX', 'UT', 'WA']
+
+SCHEMA = """
+drop table if exists sales_orders, products, customers;
+create table products(product_id text, product_category text, product_name text, sales_price numeric,
+                      ean13 bigint, ean5 bigint, product_unit text);
+create table sales_orders(order_line_item_no bigserial, order_number bigint, order_datetime timestamp,
+                          customer_id bigint, product_id text, unit_price numeric, quantity int);
+create table customers(customer_id bigint primary key, customer_name text, state text, city text, postcode text);
+"""
+
+PROMPT_SCHEMA = """
+create schema if not exists config;
+drop table if exists config.prompt;
+create table config.prompt(id bigserial, line text, include boolean default true);
+"""
+
+PROMPT_LINES = [
+    'customers(customer_id, customer_name, state, city, postcode)',
+    'products(product_id, product_category, product_name, sales_price, ean13, ean5, product_unit)',
+    'sales_orders(order_line_item_no, order_number, order_datetime, customer_id, product_id, unit_price, quantity)',
+]
+
+
+def create_database(host, port, user, password, database):
+    conn = psycopg2.connect(host=host, port=port, user=user, password=password, dbname='postgres')
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('select 1 from pg_database where datname = %s', (database,))
+        if cursor.fetchone() is None:
+            cursor.execute(sql.SQL('create database {}').format(sql.Identifier(database)))
+    conn.close()
+
+
+def restore_dump(host, port, user, password, database):
+    subprocess.run(['pg_restore', '--no-owner', '--no-privileges', '--clean', '--if-exists',
+                    '-h', host, '-p', str(port), '-U', user, '-d', database,
+                    os.path.join(DATA_DIR, 'retail_org.dump')],
+                   env={**os.environ, 'PGPASSWORD': password}, check=True)
+
+
+def copy_csv(cursor, table, columns, file_name):
+    with open(os.path.join(DATA_DIR, file_name), 'rb') as f:
+        cursor.copy_expert(f'copy {table}({columns}) from stdin with (format csv, header true)', f)
+
+
+def load_csv(conn, scale):
+    with conn, conn.cursor() as cursor:
+        cursor.execute(SCHEMA)
+        copy_csv(cursor, 'products', 'product_id, product_category, product_name, sales_price, ean13, ean5, product_unit',
+                 'products.csv')
+        copy_csv(cursor, 'sales_orders', 'order_number, order_datetime, customer_id, product_id, unit_price, quantity',
+                 'sales_orders_s.csv')
+        if scale > 1:
+            cursor.execute(
+                'insert into sales_orders(order_number, order_datetime, customer_id, product_id, unit_price, quantity) '
+                'select order_number + i::bigint * 1000000000, order_datetime, customer_id, product_id, unit_price, quantity '
+                'from sales_orders cross join generate_series(1, %s) i', (scale - 1,))
+        cursor.execute(
+            "insert into customers select customer_id, 'Customer ' || customer_id, "
+            "(%s::text[])[1 + customer_id %% %s], 'City ' || customer_id %% 50, lpad((customer_id %% 99999)::text, 5, '0') "
+            "from (select distinct customer_id from sales_orders) c", (STATES, len(STATES)))
+
+
+def load_prompt(conn):
+    with conn, conn.cursor() as cursor:
+        cursor.execute(PROMPT_SCHEMA)
+        cursor.executemany('insert into config.prompt(line) values (%s)', [(line,) for line in PROMPT_LINES])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=5432, type=int)
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--database', default='retail_org')
+    parser.add_argument('--dump', action='store_true', help='restore data/retail_org.dump instead of the CSV files')
+    parser.add_argument('--scale', default=1, type=int, help='number of copies of the sales orders')
+    args = parser.parse_args()
+
+    create_database(args.host, args.port, args.user, args.password, args.database)
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.user, password=args.password,
+                            dbname=args.database)
+    if args.dump:
+        restore_dump(args.host, args.port, args.user, args.password, args.database)
+        with conn.cursor() as cursor:
+            cursor.execute("select to_regclass('config.prompt') is not null")
+            has_prompt = cursor.fetchone()[0]
+    else:
+        load_csv(conn, args.scale)
+        has_prompt = False
+    if not has_prompt:
+        load_prompt(conn)
+    with conn.cursor() as cursor:
+        cursor.execute('select count(*) from sales_orders')
+        print(f'Loaded {cursor.fetchone()[0]} sales orders into {args.database}')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Benchmark of the pipeline against local stand-ins for OpenAI, PostgreSQL and Blob storage.
+
+Drives `fn-openai-sql` end to end, its async variant and the generate and execute
+activity functions, the generate activity also with batches of `--batch-size` questions, at the given concurrency levels and result sizes, and reports the
+p50/p95/p99 latency, rows/s and peak RSS of every run, and the p50/p95/p99 latency of
+every stage from the instrumentation spans. The generate targets also report the prompt
+and completion tokens per question, `--prompt-format` compares the prompt formats.
+
+Needs a local PostgreSQL loaded with `benchmarks.load_data` and Azurite for Blob
+storage (`azurite-blob` or `docker run -p 10000:10000 mcr.microsoft.com/azure-storage/azurite azurite-blob --blobHost 0.0.0.0`).
+The stub completions API is started in-process unless `--openai-url` is given.
+
+    python -m benchmarks.run --targets e2e,execute --concurrency 1,8 --rows 1000,100000 --requests 50
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import stub_openai
+
+TARGETS = ['e2e', 'e2e-async', 'generate', 'generate-batch', 'execute']
+SAMPLE_INTERVAL = 0.01
+
+# Numbers the questions, unique across all runs
+_request_ids = itertools.count()
+# The async pools and clients are cached per worker, so all async runs share one event loop like in a worker
+_event_loop = asyncio.new_event_loop()
+
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import psutil
+        return psutil.Process().memory_info().rss
+
+
+class RssSampler:
+    """
+    Samples the resident set size of the process in a background thread to find its peak.
+    """
+    def __init__(self):
+        self.baseline = self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class SpanCollector:
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.tokens = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __call__(self, name, duration_ms, attributes):
+        with self._lock:
+            self.durations[name].append(duration_ms)
+            # Tokens of the OpenAI calls, recorded on their spans
+            for key in ('prompt_tokens', 'completion_tokens'):
+                self.tokens[key] += attributes.get(f'openai.{key}', 0)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def configure_environment(args, openai_url):
+    # Settings are read when the modules are imported, so this must run first
+    os.environ.update({
+        'POSTGRE_SQL_SERVER': args.host,
+        'POSTGRE_SQL_PORT': str(args.port),
+        'POSTGRE_SQL_DB_NAME': args.database,
+        'POSTGRE_SQL_USER': args.user,
+        'POSTGRE_SQL_PWD': args.password,
+        'STORAGE_ACCOUNT_NAME': 'devstoreaccount1',
+        'STORAGE_CONTAINER_NAME': args.container,
+        'RESULTS_STORAGE_CONNECTION_STRING': args.storage_connection_string,
+        'OPENAI_API_KEY': 'benchmark',
+        # The generate activity configures openai from these
+        'AZURE_OPENAI_ENDPOINT': openai_url,
+        'API_TYPE': 'open_ai',
+        'API_VERSION': '',
+    })
+    os.environ.setdefault('QUERY_MAX_ROWS', str(max(args.rows)))
+    os.environ.setdefault('QUERY_MAX_COST', '1e12')
+    if not args.cache:
+        os.environ.setdefault('RESULT_CACHE_TTL', '0')
+    if args.prompt_format:
+        os.environ['PROMPT_FORMAT'] = args.prompt_format
+
+
+def create_container(container_name):
+    from azure.core.exceptions import ResourceExistsError
+    from shared_code import blob_storage
+    try:
+        blob_storage.get_blob_service_client('devstoreaccount1').create_container(container_name)
+    except ResourceExistsError:
+        pass
+
+
+def question(rows, cache):
+    # Unique questions miss the translation cache, as numbers in near-duplicates must match exactly
+    return f'export {rows} sales orders' if cache else f'export {rows} sales orders, request {next(_request_ids)}'
+
+
+def sql_query(rows, partitions=None):
+    if partitions is not None:
+        # Parallel exports split a range of the key, they don't apply to queries with a LIMIT
+        return f'select * from sales_orders where order_line_item_no <= {rows} order by order_line_item_no'
+    return f'select * from sales_orders order by order_line_item_no limit {rows}'
+
+
+def make_request(args, rows):
+    import azure.functions as func
+    body = {'query': question(rows, args.cache), 'outputFormat': args.output_format}
+    return func.HttpRequest(method='POST', url='/api/fn-openai-sql', body=json.dumps(body).encode(),
+                            headers={'content-type': 'application/json'})
+
+
+def db_params(args):
+    return {'host': args.host, 'port': str(args.port), 'database': args.database, 'user': args.user,
+            'password': args.password}
+
+
+def run_sync(target, args, rows):
+    if target == 'e2e':
+        response = importlib.import_module('fn-openai-sql').main(make_request(args, rows))
+        if response.status_code != 200:
+            raise BenchmarkError(response.get_body().decode())
+        return json.loads(response.get_body())['rows']
+    if target == 'generate':
+        result = importlib.import_module('fn-drbl-act-generate-sql-query').main(
+            {**db_params(args), 'text_query': question(rows, args.cache)})
+        if not result.lower().startswith('select'):
+            raise BenchmarkError(result)
+        return 1
+    if target == 'generate-batch':
+        results = importlib.import_module('fn-drbl-act-generate-sql-query').main(
+            {**db_params(args), 'text_queries': [question(rows, args.cache) for _ in range(args.batch_size)]})
+        for result in results:
+            if not result.lower().startswith('select'):
+                raise BenchmarkError(result)
+        return len(results)
+    params = {**db_params(args), 'sql_query': sql_query(rows, args.partitions), 'storage_account_name': 'devstoreaccount1',
+              'container_name': args.container, 'output_format': args.output_format}
+    if args.partitions is not None:
+        params['partitions'] = args.partitions
+    result = importlib.import_module('fn-drbl-act-execute-sql-query').main(params)
+    if 'error' in result:
+        raise BenchmarkError(result['error'])
+    return result['rows']
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    try:
+        rows = function(*args)
+        return time.perf_counter() - start, rows, None
+    except Exception as e:
+        return time.perf_counter() - start, 0, e
+
+
+def run_threads(target, args, rows, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda i: timed(run_sync, target, args, rows), range(args.requests)))
+
+
+async def run_async(args, rows, concurrency):
+    main = importlib.import_module('fn-openai-sql-async').main
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await main(make_request(args, rows))
+                if response.status_code != 200:
+                    raise BenchmarkError(response.get_body().decode())
+                return time.perf_counter() - start, None, None
+            except Exception as e:
+                return time.perf_counter() - start, 0, e
+
+    return await asyncio.gather(*(request() for _ in range(args.requests)))
+
+
+def run(target, args, rows, concurrency):
+    from shared_code import instrumentation
+    spans = SpanCollector()
+    instrumentation.add_listener(spans)
+    try:
+        with RssSampler() as rss:
+            start = time.perf_counter()
+            if target == 'e2e-async':
+                results = _event_loop.run_until_complete(run_async(args, rows, concurrency))
+            else:
+                results = run_threads(target, args, rows, concurrency)
+            elapsed = time.perf_counter() - start
+    finally:
+        instrumentation.remove_listener(spans)
+
+    latencies = [r[0] * 1000 for r in results if r[2] is None]
+    errors = [r[2] for r in results if r[2] is not None]
+    for error in errors[:3]:
+        print(f'  {target}: {error!r}', file=sys.stderr)
+    # The async function doesn't report the number of rows, the generate targets count the questions
+    rows_total = sum((r[1] if r[1] is not None else rows) for r in results if r[2] is None)
+    generate = target.startswith('generate')
+    return {
+        'target': target,
+        'concurrency': concurrency,
+        'rows': rows,
+        'requests': len(results),
+        'errors': len(errors),
+        'seconds': elapsed,
+        'requestsPerSecond': len(latencies) / elapsed,
+        'rowsPerSecond': rows_total / elapsed if not generate else 0,
+        'translationsPerSecond': rows_total / elapsed if generate else 0,
+        'p50Ms': percentile(latencies, 50),
+        'p95Ms': percentile(latencies, 95),
+        'p99Ms': percentile(latencies, 99),
+        'promptTokens': spans.tokens['prompt_tokens'] / max(rows_total, 1) if generate else 0,
+        'completionTokens': spans.tokens['completion_tokens'] / max(rows_total, 1) if generate else 0,
+        'peakRssMb': rss.peak / 2 ** 20,
+        'rssGrowthMb': (rss.peak - rss.baseline) / 2 ** 20,
+        'stages': {name: {'count': len(durations), 'p50Ms': percentile(durations, 50),
+                          'p95Ms': percentile(durations, 95), 'p99Ms': percentile(durations, 99)}
+                   for name, durations in sorted(spans.durations.items())},
+    }
+
+
+def print_result(result):
+    print(f"{result['target']:<14} c={result['concurrency']:<4} rows={result['rows']:<8} "
+          f"req={result['requests']:<5} err={result['errors']:<3} "
+          f"p50={result['p50Ms']:8.1f}ms p95={result['p95Ms']:8.1f}ms p99={result['p99Ms']:8.1f}ms "
+          f"{result['requestsPerSecond']:7.1f} req/s "
+          + (f"{result['translationsPerSecond']:10.1f} SQL/s {result['promptTokens']:6.0f}+{result['completionTokens']:.0f} tokens/SQL "
+             if result['target'].startswith('generate')
+             else f"{result['rowsPerSecond']:10.0f} rows/s ") +
+          f"peak RSS={result['peakRssMb']:7.1f}MB (+{result['rssGrowthMb']:.1f})")
+    for name, stage in result['stages'].items():
+        print(f"    {name:<32} n={stage['count']:<6} p50={stage['p50Ms']:8.1f}ms "
+              f"p95={stage['p95Ms']:8.1f}ms p99={stage['p99Ms']:8.1f}ms")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=5432, type=int)
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--database', default='retail_org')
+    parser.add_argument('--storage-connection-string', default='UseDevelopmentStorage=true')
+    parser.add_argument('--container', default='benchmark')
+    parser.add_argument('--openai-url', help='URL of an already running completions API, e.g. the stub')
+    parser.add_argument('--latency-ms', default=800, type=float, help='latency of the in-process stub')
+    parser.add_argument('--jitter-ms', default=200, type=float)
+    parser.add_argument('--targets', default='e2e,generate,execute',
+                        type=lambda v: v.split(','), help=f"comma separated, of {', '.join(TARGETS)}")
+    parser.add_argument('--concurrency', default=[1, 8], type=int_list)
+    parser.add_argument('--rows', default=[1000, 100000], type=int_list, help='result sizes')
+    parser.add_argument('--requests', default=50, type=int, help='requests per run')
+    parser.add_argument('--warmup', default=2, type=int, help='requests per target before measuring')
+    parser.add_argument('--batch-size', default=8, type=int, help='questions per request of generate-batch')
+    parser.add_argument('--output-format', default='csv')
+    parser.add_argument('--partitions', type=int,
+                        help='parallel export partitions of the execute target, which then queries a range of keys')
+    parser.add_argument('--prompt-format', choices=['compact', 'lines'], help='PROMPT_FORMAT of the generate targets')
+    parser.add_argument('--cache', action='store_true', help='repeat the same questions, hitting the caches')
+    parser.add_argument('--json', help='also write the results to this file, to compare runs')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the functions')
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+
+    openai_url = args.openai_url
+    if not openai_url:
+        stub = stub_openai.start(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+        openai_url = f'http://127.0.0.1:{stub.server_address[1]}/v1'
+    configure_environment(args, openai_url)
+    import openai
+    openai.api_base = openai_url
+    openai.api_type = 'open_ai'
+    openai.api_version = None
+    if not all(target.startswith('generate') for target in args.targets):
+        create_container(args.container)
+
+    results = []
+    for target in args.targets:
+        if args.warmup:
+            warmup = argparse.Namespace(**{**vars(args), 'requests': args.warmup})
+            run(target, warmup, min(args.rows), 1)
+        for rows in args.rows:
+            for concurrency in args.concurrency:
+                result = run(target, args, rows, concurrency)
+                print_result(result)
+                results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
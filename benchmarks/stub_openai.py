@@ -0,0 +1,100 @@
+"""
+Stub of the OpenAI completions API with a configurable latency, so the pipeline can be
+benchmarked without calling OpenAI.
+
+Every POST to a path ending in `/completions` is answered after the latency with a
+completion for the question of the prompt. Questions like "export 1000 sales orders"
+return `* from sales_orders limit 1000`, so the benchmark controls the size of the
+results, anything else returns the products. Prompt lists and prompts with numbered
+questions, as sent by batched generation, get an answer for every question.
+
+    python -m benchmarks.stub_openai --port 8089 --latency-ms 800 --jitter-ms 200
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EXPORT_QUESTION = re.compile(r'export (\d+) sales orders')
+NUMBERED_QUESTION = re.compile(r'### (\d+)\. A query to (.*?)(?:\\n|\n)')
+
+
+def answer(question):
+    match = EXPORT_QUESTION.search(question)
+    if match:
+        return f' * from sales_orders order by order_line_item_no limit {match.group(1)}'
+    return ' * from products'
+
+
+def complete(prompt):
+    questions = NUMBERED_QUESTION.findall(prompt)
+    if questions:
+        # The completion continues after "1. SELECT"
+        return '\\n'.join(f'{number}. SELECT{answer(question)};' for number, question in questions)[len('1. SELECT'):]
+    # The question is the last line of the prompt, after "### A query to"
+    return answer(prompt.rsplit('### A query to', 1)[-1])
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    latency_ms = 0
+    jitter_ms = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.split('?')[0].endswith('/completions'):
+            self.send_error(404)
+            return
+        prompts = body.get('prompt', '')
+        if not isinstance(prompts, list):
+            prompts = [prompts]
+        time.sleep(max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+        texts = [complete(prompt) for prompt in prompts]
+        prompt_tokens = sum(len(prompt) for prompt in prompts) // 4
+        completion_tokens = sum(len(text) for text in texts) // 4
+        response = json.dumps({
+            'id': 'cmpl-stub',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{'text': text, 'index': i, 'logprobs': None, 'finish_reason': 'stop'}
+                        for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, latency_ms=0, jitter_ms=0):
+    """
+    Start the stub in a background thread, returning the server. Port 0 picks a free port.
+    """
+    handler = type('Handler', (CompletionHandler,), {'latency_ms': latency_ms, 'jitter_ms': jitter_ms})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', default=8089, type=int)
+    parser.add_argument('--latency-ms', default=800, type=float)
+    parser.add_argument('--jitter-ms', default=0, type=float)
+    args = parser.parse_args()
+    handler = type('Handler', (CompletionHandler,), {'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms})
+    print(f'Stub completions API listening on http://127.0.0.1:{args.port}')
+    ThreadingHTTPServer(('127.0.0.1', args.port), handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+-- Queue of the admission control of the queries executed on the database, required
+-- when ADMISSION_MAX_CONCURRENCY is set. Run once on the application database:
+--     psql "host=<server> dbname=retail_org user=<admin user>" -f deployment/admission.sql
+CREATE SCHEMA IF NOT EXISTS admission;
+
+CREATE TABLE IF NOT EXISTS admission.queue (
+    id uuid PRIMARY KEY,
+    priority int NOT NULL,
+    slots int NOT NULL DEFAULT 1,
+    state text NOT NULL DEFAULT 'waiting',
+    enqueued_at timestamptz NOT NULL DEFAULT clock_timestamp(),
+    heartbeat_at timestamptz NOT NULL DEFAULT clock_timestamp()
+);
@@ -1,28 +1,74 @@
+import csv
+import io
 import logging
-import pandas as pd
-import psycopg2
+from shared_code import admission, db_pool, instrumentation, query_guard, result_cache, result_stream
 
-def execute_sql_query(host, port, database, user, password, sql_query): 
-    with psycopg2.connect(host=host, 
-                        port=port, 
-                        database=database, 
-                        user=user, 
-                        password=password) as conn:
-        with conn.cursor() as cursor:
-                cursor.execute(sql_query)
-                results_df = pd.DataFrame(cursor.fetchall(), 
-                            columns=[desc[0] for desc in cursor.description])
-                return results_df.to_csv(index=False)
+def execute_sql_query(host, port, database, user, password, sql_query, priority=admission.NORMAL): 
+    with instrumentation.span('execute_sql_query') as span:
+        with admission.admit(host, port, database, user, password, priority):
+            with db_pool.connection(host, port, database, user, password) as conn:
+                sql_query = query_guard.guard_query(conn, sql_query)
+                with conn.cursor() as cursor:
+                        cursor.execute(sql_query)
+                        # Rows are written to the CSV in batches, without a DataFrame copy
+                        output = io.StringIO()
+                        writer = csv.writer(output, lineterminator='\n')
+                        writer.writerow([desc[0] for desc in cursor.description])
+                        rows = 0
+                        for batch in iter(lambda: cursor.fetchmany(result_stream.RESULTS_BATCH_SIZE), []):
+                            writer.writerows(batch)
+                            rows += len(batch)
+                        span.set_attribute('db.rows', rows)
+                        instrumentation.add('openai_sql.rows', rows)
+                        return output.getvalue()
     
 def main(params) -> str:
     try:
-        return execute_sql_query(
-            params['host'], 
-            params['port'], 
-            params['database'], 
-            params['user'], 
-            params['password'], 
-            params['sql_query'])
+        with instrumentation.span('fn-drbl-act-execute-sql-query', 
+                                  correlation_id=params.get('correlation_id'), 
+                                  trace_context=params.get('trace_context')):
+            # Queries wait for a slot on the database, batch orchestrations behind the others.
+            # When too many are waiting an `overloaded` error is returned, deferred by the orchestrator.
+            priority = params.get('priority', admission.NORMAL)
+            if priority not in admission.PRIORITIES:
+                priority = admission.NORMAL
+            # Streaming mode : results are written straight to a blob in the requested format 
+            # and its SAS URL is returned. Results of the same query are reused while fresh.
+            # Large results of queries on a range key are exported in `partitions` parallel parts.
+            # With `preview_rows` the first rows fetched for the export are returned inline too.
+            if 'storage_account_name' in params and 'container_name' in params:
+                results = result_cache.export_query_to_blob(
+                    params['host'], 
+                    params['port'], 
+                    params['database'], 
+                    params['user'], 
+                    params['password'], 
+                    params['sql_query'],
+                    params['storage_account_name'], 
+                    params['container_name'], 
+                    params.get('output_format'),
+                    params.get('partitions'),
+                    priority,
+                    params.get('preview_rows', 0))
+                output = { 'resultsFileUrl': results.url, 'rows': results.rows }
+                if results.parts is not None:
+                    output['parts'] = results.parts
+                if results.preview is not None:
+                    output['preview'] = results.preview
+                return output
+            return execute_sql_query(
+                params['host'], 
+                params['port'], 
+                params['database'], 
+                params['user'], 
+                params['password'], 
+                params['sql_query'],
+                priority)
+    except admission.AdmissionRejected as e:
+        # Deferred by the orchestrator
+        logging.warning(e.message)
+        return query_guard.error_result(e, params.get('sql_query'))
     except Exception as e:
         logging.exception(e)
-        return str(e)
+        # Rejected or failed queries return {'error': {'code': ..., 'message': ...}} instead of results
+        return query_guard.error_result(e, params.get('sql_query'))
@@ -99,67 +99,59 @@
 #         return str(e)
 
 ###########################################################
-import openai
 import logging
-import pandas as pd
-import psycopg2
+import os
+from shared_code import instrumentation, translation
+from shared_code.lazy_modules import lazy_import
 
-def get_prompt_text(prompt_lines, text_query):
-    schema_text=''
-    for pl in prompt_lines:
-        schema_text+= f'# {pl}\\n'
-    return ( '### Postgres SQL tables, with their properties:\\n#\\n' + schema_text + 
-            '#\\n### A query to ' + text_query +'\\nSELECT' )
+openai = lazy_import('openai')
 
-def generate_openai_prompt(host, port, database, user, password, text_query):
-    sql_query = "Select line from config.prompt where include is true;"
-    with psycopg2.connect(host=host, 
-                    port=port, 
-                    database=database, 
-                    user=user, 
-                    password=password) as conn:
-        with conn.cursor() as cursor:
-                cursor.execute(sql_query)
-                df = pd.DataFrame(cursor.fetchall(), 
-                            columns=[desc[0] for desc in cursor.description])
-                prompt_lines = df['line'].values.tolist()
-    return get_prompt_text(prompt_lines, text_query)
+ENGINE = "LTIM"
 
-def prompt_openai(prompt):
-    logging.info(prompt)
-    return openai.Completion.create(
-        engine="LTIM",
-        prompt=prompt,
-        temperature=0,
-        max_tokens=150,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=["#", ";"]
-    )
+def configure_openai():
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+    openai.api_base = os.environ["AZURE_OPENAI_ENDPOINT"]
+    openai.api_type = os.environ['API_TYPE']
+    openai.api_version = os.environ['API_VERSION']
 
-def generate_sql_query(prompt_text):
-    response = prompt_openai(prompt_text)
-    s = response["choices"][0]["text"]
-    s = s.replace('\\n', ' ').replace('\n', ' ')
-    # print(response)
-    return f'select {s};'        
-      
     
-def main(params) -> str:
+def main(params):
+    configure_openai()
+    # A list of SQL queries is returned when a list of `text_queries` is passed. Questions which
+    # could not be translated have a structured `translation_failed` error instead of their SQL.
+    if params.get('text_queries') is not None:
+        try:
+            with instrumentation.span('fn-drbl-act-generate-sql-query', 
+                                      {'batch.size': len(params['text_queries'])},
+                                      correlation_id=params.get('correlation_id'), 
+                                      trace_context=params.get('trace_context')):
+                # Batched mode, see `translation.translate_text_queries`
+                return translation.translate_text_queries(
+                        params['host'], 
+                        params['port'], 
+                        params['database'], 
+                        params['user'], 
+                        params['password'], 
+                        params['text_queries'],
+                        engine=ENGINE)
+        except Exception as e:
+            logging.exception(e)
+            return [translation.translation_error(e)] * len(params['text_queries'])
     try:
-        prompt_text = generate_openai_prompt(
-                params['host'], 
-                params['port'], 
-                params['database'], 
-                params['user'], 
-                params['password'], 
-                params['text_query'])
-
-        return generate_sql_query(prompt_text)    
+        with instrumentation.span('fn-drbl-act-generate-sql-query', 
+                                  correlation_id=params.get('correlation_id'), 
+                                  trace_context=params.get('trace_context')):
+            return translation.translate_text_query(
+                    params['host'], 
+                    params['port'], 
+                    params['database'], 
+                    params['user'], 
+                    params['password'], 
+                    params['text_query'],
+                    engine=ENGINE)
     except Exception as e:
         logging.exception(e)
-        return str(e)
+        return translation.translation_error(e)
     
 
     
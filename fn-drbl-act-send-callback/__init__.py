@@ -0,0 +1,19 @@
+import logging
+from shared_code import callbacks, instrumentation
+
+def main(params) -> dict:
+    # One delivery attempt, retries are scheduled by the orchastrator with durable timers
+    try:
+        with instrumentation.span('fn-drbl-act-send-callback', 
+                                  {'callback.attempt': params.get('attempt', 1)},
+                                  correlation_id=params.get('correlation_id'), 
+                                  trace_context=params.get('trace_context')):
+            return callbacks.post_callback(
+                params['callback_url'], 
+                params['payload'], 
+                params['payload']['instanceId'],
+                params.get('attempt', 1),
+                params.get('correlation_id'))
+    except Exception as e:
+        logging.exception(e)
+        return {'delivered': False, 'retry': True, 'error': str(e)}
@@ -0,0 +1,18 @@
+import logging
+import azure.durable_functions as df
+from shared_code import callbacks, instrumentation
+
+async def main(params, starter: str) -> dict:
+    # Starts the delivery orchastration without waiting for it, so the calling orchastration completes right away
+    try:
+        with instrumentation.span('fn-drbl-act-start-callback', 
+                                  correlation_id=params.get('correlation_id'), 
+                                  trace_context=params.get('trace_context')):
+            client = df.DurableOrchestrationClient(starter)
+            instance_id = await client.start_new('fn-drbl-orch-send-callback', 
+                                                 callbacks.delivery_instance_id(params['payload']['instanceId']), 
+                                                 params)
+            return {'started': True, 'instanceId': instance_id}
+    except Exception as e:
+        logging.exception(e)
+        return {'started': False, 'error': str(e)}
@@ -1,6 +1,8 @@
 import logging
+import uuid
 import azure.functions as func
 import azure.durable_functions as df
+from shared_code import callbacks, instrumentation
 
 async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
     client = df.DurableOrchestrationClient(starter)
@@ -8,8 +10,26 @@ async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
     #Get orchastration function name and data
     function_name = req.route_params["functionName"]
     data = req.get_json()
+
+    # Callback deliveries sign their input, they are only started by the orchastrations with their output
+    if function_name == 'fn-drbl-orch-send-callback':
+        return func.HttpResponse(f'Orchastrator {function_name} can not be started directly.', status_code=404)
+
+    # The callback URL is checked up front, not only once the orchastration has completed
+    if data.get('callbackUrl') is not None:
+        error = callbacks.validate_callback_url(data['callbackUrl'])
+        if error:
+            return func.HttpResponse(error, status_code=400)
+
+    # Correlation ID and trace context are passed through the orchastrator to the activities
+    correlation_id = req.headers.get('x-correlation-id') or uuid.uuid4().hex
+    with instrumentation.span('fn-drbl-http-starter', {'function_name': function_name}, correlation_id=correlation_id):
+        data['correlationId'] = correlation_id
+        data['traceContext'] = instrumentation.inject()
     
-    #Call orchastrator function
-    instance_id = await client.start_new(function_name, client_input=data)
+        #Call orchastrator function
+        instance_id = await client.start_new(function_name, client_input=data)
     logging.info(f"Started orchestration with ID = '{instance_id}'.")
-    return client.create_check_status_response(req, instance_id)
\ No newline at end of file
+    response = client.create_check_status_response(req, instance_id)
+    response.headers['x-correlation-id'] = correlation_id
+    return response
\ No newline at end of file
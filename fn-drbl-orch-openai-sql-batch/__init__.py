@@ -0,0 +1,135 @@
+import logging
+import os
+import azure.durable_functions as df
+from shared_code import callbacks, priorities, query_guard, result_formats
+
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 10))
+# Same setting as in `openai_batch`, which is not imported so that replays don't load openai
+GENERATE_BATCH_SIZE = int(os.environ.get('GENERATE_BATCH_SIZE', 8))
+
+def normalize_query(text_query):
+    return ' '.join(text_query.lower().split())
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def orchestrator_function(context: df.DurableOrchestrationContext):
+    """
+    Orchastrates a batch of natural language queries using fan-out/fan-in :
+
+    1. Generate the SQL for every distinct query text in parallel, batching `GENERATE_BATCH_SIZE`
+       query texts per activity so they share prompts
+    2. Execute every distinct SQL query in parallel, uploading the results to a azure storage blob
+    3. Return a manifest with the SQL and the SAS URL of the results of each query
+
+    Progress is published as custom status after every window of activities.
+
+    At most `maxConcurrency` activities run at the same time.
+    """
+    logging.info("Starting execution of batch orchastrator function")
+
+    #Get environment variables
+    host = os.environ["POSTGRE_SQL_SERVER"]
+    port = os.environ["POSTGRE_SQL_PORT"]
+    database = os.environ["POSTGRE_SQL_DB_NAME"]
+    user = os.environ['POSTGRE_SQL_USER']
+    password = os.environ['POSTGRE_SQL_PWD']
+    storage_account_name = os.environ["STORAGE_ACCOUNT_NAME"]
+    container_name = os.environ["STORAGE_CONTAINER_NAME"]
+
+    # Get query texts from input
+    params = context.get_input()
+    if params.get('queries'):
+        text_queries = params['queries']
+    else:
+        output = ['Please provide a list of query texts.']
+        # POST the validation error to the callbackUrl of the request, if any
+        yield from callbacks.send_callback(context, params, output)
+        return output
+
+    # Correlation ID and trace context set by the starter, passed on to the activities
+    correlation_id = params.get('correlationId')
+    trace_context = params.get('traceContext')
+
+    # Output format of the results files, CSV by default or when null
+    output_format = params.get('outputFormat')
+    if not result_formats.is_supported(output_format):
+        output = [f"Unsupported output format, please use one of {', '.join(result_formats.OUTPUT_FORMATS)}."]
+        yield from callbacks.send_callback(context, params, output)
+        return output
+    max_concurrency = max(1, int(params.get('maxConcurrency', BATCH_MAX_CONCURRENCY)))
+
+    # Identical questions are only translated once. The first of them is sent as written, values
+    # in questions can be case sensitive.
+    distinct_queries = {}
+    for text_query in text_queries:
+        distinct_queries.setdefault(normalize_query(text_query), text_query)
+    sql_queries = {}
+    context.set_custom_status({ 'stage': 'generating_sql', 'queriesCompleted': 0, 'queriesTotal': len(distinct_queries) })
+    query_batches = list(chunks(list(distinct_queries), max(1, GENERATE_BATCH_SIZE)))
+    for window in chunks(query_batches, max_concurrency):
+        tasks = [context.call_activity('fn-drbl-act-generate-sql-query',
+                                {
+                                    'host' : host,
+                                    'port' : port,
+                                    'database' : database,
+                                    'user' : user,
+                                    'password': password,
+                                    'correlation_id': correlation_id,
+                                    'trace_context': trace_context,
+                                    'text_queries': [distinct_queries[key] for key in batch]
+                                }) for batch in window]
+        results = yield context.task_all(tasks)
+        for batch, batch_results in zip(window, results):
+            sql_queries.update(zip(batch, batch_results))
+        context.set_custom_status({ 'stage': 'generating_sql', 'queriesCompleted': len(sql_queries), 
+                                    'queriesTotal': len(distinct_queries) })
+
+    # Different questions translating to the same SQL are only executed once, questions which could
+    # not be translated have a translation_failed error instead of SQL and are not executed
+    distinct_sql_queries = list(dict.fromkeys(sql_query for sql_query in sql_queries.values()
+                                              if not query_guard.is_error_result(sql_query)))
+    query_results = {}
+    context.set_custom_status({ 'stage': 'executing_sql', 'queriesCompleted': 0, 'queriesTotal': len(distinct_sql_queries), 
+                                'rowsProcessed': 0 })
+    for batch in chunks(distinct_sql_queries, max_concurrency):
+        # Batch queries are admitted to the database after interactive and single queries
+        inputs = [{
+                    'host' : host,
+                    'port' : port,
+                    'database' : database,
+                    'user' : user,
+                    'password': password,
+                    'correlation_id': correlation_id,
+                    'trace_context': trace_context,
+                    'sql_query': sql_query,
+                    'storage_account_name': storage_account_name,
+                    'container_name': container_name,
+                    'output_format': output_format,
+                    'priority': priorities.BATCH
+                } for sql_query in batch]
+        results = yield context.task_all([context.call_activity('fn-drbl-act-execute-sql-query', i) for i in inputs])
+        # Queries rejected while the database is overloaded are called again after a durable timer
+        results = yield from priorities.retry_overloaded(context, 'fn-drbl-act-execute-sql-query', inputs, results)
+        query_results.update(zip(batch, results))
+        context.set_custom_status({ 'stage': 'executing_sql', 'queriesCompleted': len(query_results), 
+                                    'queriesTotal': len(distinct_sql_queries), 
+                                    'rowsProcessed': sum(r.get('rows', 0) for r in query_results.values()) })
+
+    # Return the manifest in the order of the input queries
+    manifest = []
+    for text_query in text_queries:
+        sql_query = sql_queries[normalize_query(text_query)]
+        if query_guard.is_error_result(sql_query):
+            manifest.append({ 'query': text_query, 'sqlQuery': None, **sql_query })
+            continue
+        # Queries rejected by the guard or failing have a structured error instead of a SAS URL and rows
+        manifest.append({ 'query': text_query, 'sqlQuery': sql_query, **query_results[sql_query] })
+    context.set_custom_status({ 'stage': 'completed', 'queriesCompleted': len(query_results), 
+                                'queriesTotal': len(distinct_sql_queries) })
+    # POST the manifest to the callbackUrl of the request, if any, without waiting for the delivery
+    yield from callbacks.send_callback(context, params, { 'results': manifest })
+    return { 'results': manifest }
+
+main = df.Orchestrator.create(orchestrator_function)
@@ -1,7 +1,7 @@
 import logging
 import os
-import openai
 import azure.durable_functions as df
+from shared_code import callbacks, priorities, query_guard, result_formats
 
 def orchestrator_function(context: df.DurableOrchestrationContext):
     logging.info("Starting execution of orchastrator function")
@@ -14,19 +14,38 @@ def orchestrator_function(context: df.DurableOrchestrationContext):
     password = os.environ['POSTGRE_SQL_PWD']
     storage_account_name = os.environ["STORAGE_ACCOUNT_NAME"]
     container_name = os.environ["STORAGE_CONTAINER_NAME"]
-    openai.api_key = os.environ["OPENAI_API_KEY"]
-    openai.api_base = os.environ["AZURE_OPENAI_ENDPOINT"]
-    openai.api_type = os.environ['API_TYPE']
-    openai.api_version = os.environ['API_VERSION']
-    deployment_name = os.environ['DEPLOYMENT_NAME']
 
     # Get query text from input
     params = context.get_input()    
     if 'query' in params:
         text_query = params['query']
     else: 
-        return ['Please provide query text.']
+        output = ['Please provide query text.']
+        # POST the validation error to the callbackUrl of the request, if any
+        yield from callbacks.send_callback(context, params, output)
+        return output
+
+    # Correlation ID and trace context set by the starter, passed on to the activities
+    correlation_id = params.get('correlationId')
+    trace_context = params.get('traceContext')
+
+    # Output format of the results file, CSV by default or when null
+    output_format = params.get('outputFormat')
+    if not result_formats.is_supported(output_format):
+        output = [f"Unsupported output format, please use one of {', '.join(result_formats.OUTPUT_FORMATS)}."]
+        yield from callbacks.send_callback(context, params, output)
+        return output
+
+    # Number of rows of the inline preview, 0 to skip it, at most RESULTS_PREVIEW_MAX_ROWS
+    preview_rows = result_formats.preview_rows(params.get('previewRows'))
+    if preview_rows is None:
+        output = ['previewRows must be a whole number of rows, 0 skips the preview.']
+        yield from callbacks.send_callback(context, params, output)
+        return output
     
+    # Progress is published as custom status, returned to clients polling statusQueryGetUri
+    context.set_custom_status({ 'stage': 'generating_sql' })
+
     # Generate convert the text query to SQL using OpenAI api
     sql_query = yield context.call_activity('fn-drbl-act-generate-sql-query', 
                                 { 
@@ -35,30 +54,66 @@ def orchestrator_function(context: df.DurableOrchestrationContext):
                                     'database' : database,
                                     'user' : user,
                                     'password': password,
+                                    'correlation_id': correlation_id,
+                                    'trace_context': trace_context,
                                     'text_query': text_query
                                 }
                             )
-    # Exectute the SQL query and get results in CSV format
-    results = yield context.call_activity('fn-drbl-act-execute-sql-query', 
-                                { 
-                                    'host' : host, 
-                                    'port' : port,
-                                    'database' : database,
-                                    'user' : user,
-                                    'password': password,
-                                    'sql_query': sql_query
-                                }
-                            )
-    # Upload the CSV to a azure storage blob and return a SAS URL
-    results_blob_sas_url = yield context.call_activity('fn-drbl-act-upload-results-to-blob', 
-                                { 
-                                    'storage_account_name': storage_account_name, 
-                                    'container_name': container_name,                                     
-                                    'results': results
-                                }
-                            )
+    # Questions which could not be translated have a translation_failed error instead of SQL
+    if query_guard.is_error_result(sql_query):
+        context.set_custom_status({ 'stage': 'failed', 'sqlQuery': None, **sql_query })
+        output = { 'sqlQuery': None, **sql_query }
+        yield from callbacks.send_callback(context, params, output)
+        return output
+
+    # Publish the SQL as soon as it is known
+    context.set_custom_status({ 'stage': 'executing_sql', 'sqlQuery': sql_query, 'rowsProcessed': 0 })
+
+    # Exectute the SQL query and upload the results to a azure storage blob in the same activity.
+    # Only the SAS URL of the blob and the first rows of the results for the preview flow 
+    # through the orchestration history, not the results.
+    export_params = { 
+                        'host' : host, 
+                        'port' : port,
+                        'database' : database,
+                        'user' : user,
+                        'password': password,
+                        'correlation_id': correlation_id,
+                        'trace_context': trace_context,
+                        'sql_query': sql_query,
+                        'priority': priorities.NORMAL,
+                        'storage_account_name': storage_account_name, 
+                        'container_name': container_name,
+                        'output_format': output_format,
+                        'preview_rows': preview_rows
+                    }
+    results = yield context.call_activity('fn-drbl-act-execute-sql-query', export_params)
+    # Exports rejected while the database is overloaded are called again after a durable timer
+    [results] = yield from priorities.retry_overloaded(context, 'fn-drbl-act-execute-sql-query', 
+                                                      [export_params], [results])
     
-    # Return the query and the SAS URL
-    return { 'sqlQuery': sql_query, 'resultsFileUrl': results_blob_sas_url }
+    # Queries rejected by the guard or failing return a structured error instead of a SAS URL
+    if query_guard.is_error_result(results):
+        context.set_custom_status({ 'stage': 'failed', 'sqlQuery': sql_query, **results })
+        output = { 'sqlQuery': sql_query, **results }
+        # POST the error to the callbackUrl of the request, if any
+        yield from callbacks.send_callback(context, params, output)
+        return output
+
+    # Taken from the rows of the export, results reused from the results cache have no preview.
+    # Its size is bounded by RESULTS_PREVIEW_MAX_BYTES, so it fits in the custom status.
+    preview = results.get('preview')
+    context.set_custom_status({ 'stage': 'completed', 'sqlQuery': sql_query, 'rowsProcessed': results['rows'], 
+                                'preview': preview })
+
+    # Return the query, the SAS URL, the number of rows and the preview
+    output = { 'sqlQuery': sql_query, 'resultsFileUrl': results['resultsFileUrl'], 'rows': results['rows'], 
+               'preview': preview }
+    # Results exported in parallel parts with a manifest also have the SAS URLs of the parts
+    if 'parts' in results:
+        output['parts'] = results['parts']
+    # POST the result manifest to the callbackUrl of the request, if any, without waiting for the delivery
+    yield from callbacks.send_callback(context, params, output)
+    return output
 
 main = df.Orchestrator.create(orchestrator_function)
@@ -0,0 +1,15 @@
+import logging
+import azure.durable_functions as df
+from shared_code import callbacks
+
+def orchestrator_function(context: df.DurableOrchestrationContext):
+    """
+    Delivers the output of an orchastration to the `callbackUrl` of its request, retrying
+    failed deliveries after durable timers. Started by `fn-drbl-act-start-callback`, the
+    orchastration whose output it delivers has already completed.
+    """
+    logging.info("Starting execution of callback orchastrator function")
+    result = yield from callbacks.deliver_callback(context, context.get_input())
+    return result
+
+main = df.Orchestrator.create(orchestrator_function)
@@ -0,0 +1,70 @@
+import azure.functions as func
+import asyncio
+import os
+import logging
+import json
+import uuid
+from shared_code import (admission, async_blob_storage, async_result_stream, instrumentation, query_guard, result_formats,
+                         translation)
+from shared_code.lazy_modules import lazy_import
+
+openai = lazy_import('openai')
+
+MODEL = "code-davinci-002"
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Starting execution')
+    host = os.environ["POSTGRE_SQL_SERVER"]
+    port = os.environ["POSTGRE_SQL_PORT"]
+    database = os.environ["POSTGRE_SQL_DB_NAME"]
+    user = os.environ['POSTGRE_SQL_USER']
+    password = os.environ['POSTGRE_SQL_PWD']
+    storage_account_name = os.environ["STORAGE_ACCOUNT_NAME"]
+    container_name = os.environ["STORAGE_CONTAINER_NAME"]
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+
+    text_query = None
+    output_format = result_formats.DEFAULT_OUTPUT_FORMAT
+    try:
+        req_body = req.get_json()
+    except ValueError:
+        pass
+    else:
+        text_query = req_body.get('query')
+        output_format = req_body.get('outputFormat', output_format)
+
+    if not text_query:
+        return func.HttpResponse("Please provide query text", status_code = 400)
+    if not result_formats.is_supported(output_format):
+        return func.HttpResponse(f"Unsupported output format, please use one of {', '.join(result_formats.OUTPUT_FORMATS)}",
+                                 status_code = 400)
+
+    correlation_id = req.headers.get('x-correlation-id') or uuid.uuid4().hex
+    sql_query = None
+    try:
+        with instrumentation.span('fn-openai-sql-async', correlation_id=correlation_id) as span:
+            # Warm the blob client, credential and user delegation key while the SQL is generated
+            sql_query, _ = await asyncio.gather(
+                translation.translate_text_query_async(host, port, database, user, password, text_query, model=MODEL),
+                async_blob_storage.warm(storage_account_name))
+            # Stream the results from a cursor to a blob, uploading blocks while rows are still being fetched.
+            # Interactive queries are admitted ahead of orchestrations.
+            results_blob_uri = await async_result_stream.export_query_to_blob(host, port, database, user, password, sql_query,
+                                                                              storage_account_name, container_name,
+                                                                              result_formats.new_file_name(output_format), output_format)
+        # Tokens of the OpenAI completions of the request, 0 when the translation was cached
+        return func.HttpResponse(json.dumps({ "sqlQuery": sql_query, "resultsFileUrl": results_blob_uri,
+                                              "usage": instrumentation.request_usage(span)}), status_code=200,
+                                 headers={'x-correlation-id': correlation_id})
+    except admission.AdmissionRejected as e:
+        logging.warning(e.message)
+        # Too many queries waiting for the database, the client should retry later
+        return func.HttpResponse(json.dumps(query_guard.error_result(e, sql_query)), status_code=503,
+                                 mimetype='application/json',
+                                 headers={'x-correlation-id': correlation_id, 'Retry-After': f'{e.retry_after:.0f}'})
+    except Exception as e:
+        logging.exception(e)
+        # Queries refused by the guard are reported as client errors
+        status_code = 422 if isinstance(e, query_guard.QueryRejected) else 500
+        return func.HttpResponse(json.dumps(query_guard.error_result(e, sql_query)), status_code=status_code,
+                                 mimetype='application/json', headers={'x-correlation-id': correlation_id})
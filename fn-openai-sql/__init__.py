@@ -1,97 +1,16 @@
-from azure.identity import DefaultAzureCredential
 import azure.functions as func
 import os
-import io
-import csv
-import openai
 import logging
 import json
-import pandas as pd
 import uuid
 # import pyodbc
-import psycopg2
-from datetime import datetime, timedelta
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+from shared_code import admission, instrumentation, query_guard, result_cache, result_formats, translation
+from shared_code.lazy_modules import lazy_import
 
-def execute_sql_query(host, port, database, user, password, sql_query): 
-    with psycopg2.connect(host=host, 
-                        port=port, 
-                        database=database, 
-                        user=user, 
-                        password=password) as conn:
-        with conn.cursor() as cursor:
-                cursor.execute(sql_query)
-                results_df = pd.DataFrame(cursor.fetchall(), 
-                            columns=[desc[0] for desc in cursor.description])
-                return results_df
+openai = lazy_import('openai')
 
-def get_prompt_text(prompt_lines, text_query):
-    schema_text=''
-    for pl in prompt_lines:
-        schema_text+= f'# {pl}\\n'
-    return ( '### Postgres SQL tables, with their properties:\\n#\\n' + schema_text + 
-            '#\\n### A query to' + text_query +'\\nSELECT' )
+MODEL = "code-davinci-002"
 
-def generate_openai_prompt(host, port, database, user, password, text_query):
-    sql_query = "Select line from config.prompt where include is true;"
-    df = execute_sql_query(host, port, database, user, password, sql_query)
-    prompt_lines = df['line'].values.tolist()
-    return get_prompt_text(prompt_lines, text_query)
-    
-def prompt_openai(prompt):
-    return openai.Completion.create(
-        model="code-davinci-002",
-        prompt=prompt,
-        temperature=0,
-        max_tokens=150,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=["#", ";"]
-    )
-
-def generate_sql_query(prompt_text):
-    response = prompt_openai(prompt_text)
-    s = response["choices"][0]["text"]
-    s = s.replace('\\n', ' ').replace('\n', ' ')
-    # print(response)
-    return f'select {s};'        
-
-def upload_results_to_blob(results_df, storage_account_name, container_name, file_name ):        
-    
-    #Create BlobServiceClient, ContainerClient and BlobClient    
-    blob_service_client = BlobServiceClient(
-        account_url=f"https://{storage_account_name}.blob.core.windows.net",
-        credential=DefaultAzureCredential()
-    )
-
-    container_client = blob_service_client.get_container_client(container_name)
-    blob_client = container_client.get_blob_client(file_name)
-
-    # Convert Dataframe to CSV and upload it to a blob
-    blob_client.upload_blob(results_df.to_csv(index=False), overwrite=True)
-
-    udk = blob_service_client.get_user_delegation_key(
-        key_start_time=datetime.utcnow() - timedelta(hours=1),
-        key_expiry_time=datetime.utcnow() + timedelta(hours=1))
-
-    # Create and return a SAS URI for the blob
-    sas_token = generate_blob_sas(
-        account_name=storage_account_name,
-        container_name=container_name,
-        blob_name=file_name,        
-        user_delegation_key=udk,
-        permission=BlobSasPermissions(read=True),
-        start=datetime.utcnow() - timedelta(minutes=15),
-        expiry=datetime.utcnow() + timedelta(minutes=30),
-        default_credential=True
-    )
-    
-    blob_url = blob_client.url
-    sas_uri = f"{blob_url}?{sas_token}"
-    return sas_uri
-       
-    
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Starting execution')
     host = os.environ["POSTGRE_SQL_SERVER"]
@@ -103,6 +22,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     container_name = os.environ["STORAGE_CONTAINER_NAME"]
     openai.api_key = os.environ["OPENAI_API_KEY"]
 
+    text_query = None
+    output_format = result_formats.DEFAULT_OUTPUT_FORMAT
     try:
         req_body = req.get_json()
         logging.error(req_body)
@@ -110,16 +31,42 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         pass
     else:
         text_query = req_body.get('query')
+        output_format = req_body.get('outputFormat', output_format)
     
     if not text_query:
-        func.HttpResponse("Please provide query text", status_code = 400)
+        return func.HttpResponse("Please provide query text", status_code = 400)
+    if not result_formats.is_supported(output_format):
+        return func.HttpResponse(f"Unsupported output format, please use one of {', '.join(result_formats.OUTPUT_FORMATS)}", 
+                                 status_code = 400)
 
+    correlation_id = req.headers.get('x-correlation-id') or uuid.uuid4().hex
+    sql_query = None
     try:
-        prompt_text = generate_openai_prompt(host, port, database, user, password, text_query)    
-        sql_query = generate_sql_query(prompt_text)    
-        results_df = execute_sql_query(host, port, database, user, password, sql_query)
-        results_blob_uri = upload_results_to_blob(results_df, storage_account_name, container_name, f"file_{uuid.uuid4()}.csv")
-        return func.HttpResponse(json.dumps({ "sqlQuery": sql_query, "resultsFileUrl": results_blob_uri}), status_code=200)
+        with instrumentation.span('fn-openai-sql', correlation_id=correlation_id) as span:
+            # Translations are cached, see `translation`
+            sql_query = translation.translate_text_query(host, port, database, user, password, text_query,
+                                                         model=MODEL)
+            # Stream the results from a server-side cursor to a blob in batches, or reuse the recent
+            # results of the same query. Interactive queries are admitted ahead of orchestrations.
+            results = result_cache.export_query_to_blob(host, port, database, user, password, sql_query, 
+                                                        storage_account_name, container_name, output_format,
+                                                        priority=admission.INTERACTIVE)
+        # Tokens of the OpenAI completions of the request, 0 when the translation was cached
+        body = { "sqlQuery": sql_query, "resultsFileUrl": results.url, "rows": results.rows,
+                 "usage": instrumentation.request_usage(span)}
+        # Results exported in parallel parts with a manifest also have the SAS URLs of the parts
+        if results.parts is not None:
+            body["parts"] = results.parts
+        return func.HttpResponse(json.dumps(body), status_code=200, headers={'x-correlation-id': correlation_id})
+    except admission.AdmissionRejected as e:
+        logging.warning(e.message)
+        # Too many queries waiting for the database, the client should retry later
+        return func.HttpResponse(json.dumps(query_guard.error_result(e, sql_query)), status_code=503,
+                                 mimetype='application/json', 
+                                 headers={'x-correlation-id': correlation_id, 'Retry-After': f'{e.retry_after:.0f}'})
     except Exception as e: 
         logging.exception(e)
-        return func.HttpResponse(str(e), status_code=500)        
\ No newline at end of file
+        # Queries refused by the guard are reported as client errors
+        status_code = 422 if isinstance(e, query_guard.QueryRejected) else 500
+        return func.HttpResponse(json.dumps(query_guard.error_result(e, sql_query)), status_code=status_code,
+                                 mimetype='application/json', headers={'x-correlation-id': correlation_id})        
\ No newline at end of file
@@ -0,0 +1,22 @@
+import azure.functions as func
+import os
+import logging
+from shared_code import instrumentation, summary_tables
+
+def main(timer: func.TimerRequest) -> None:
+    # Appends the order lines added since the last run to the summary tables, and
+    # rebuilds them once every SUMMARY_FULL_REFRESH_INTERVAL
+    if not summary_tables.SUMMARY_TABLES_ENABLED:
+        return
+    if timer.past_due:
+        logging.info('Summary refresh is past due')
+    try:
+        with instrumentation.span('fn-timer-refresh-summaries'):
+            summary_tables.refresh_summaries(
+                    os.environ["POSTGRE_SQL_SERVER"], 
+                    os.environ["POSTGRE_SQL_PORT"], 
+                    os.environ["POSTGRE_SQL_DB_NAME"], 
+                    os.environ['POSTGRE_SQL_USER'], 
+                    os.environ['POSTGRE_SQL_PWD'])
+    except Exception as e:
+        logging.exception(e)
@@ -0,0 +1,244 @@
+"""
+Admission control of the queries executed on the database, so a burst of requests or
+batch orchestrations doesn't open more connections than the server can serve.
+
+At most `ADMISSION_MAX_CONCURRENCY` queries run at the same time per database, across
+all workers. The others wait in a queue kept in the database itself, in the
+`admission.queue` table created by `deployment/admission.sql`, and are admitted by
+priority then in arrival order: `interactive` for `fn-openai-sql`, `normal` for single
+orchestrations and `batch` for batch orchestrations. `ADMISSION_INTERACTIVE_RESERVED`
+slots are kept for interactive queries. Admission decisions are serialized with a transaction level advisory lock and
+waiters poll in short transactions, so no connection is held while waiting.
+
+When `ADMISSION_MAX_QUEUE` queries are already waiting, or a query waited
+`ADMISSION_MAX_WAIT` seconds, it is rejected with an `overloaded` error and a
+`retryAfter`. HTTP functions return it as 503 with Retry-After, orchestrators defer
+the activity with a durable timer and call it again, see `priorities`.
+
+Slots of workers which stopped without releasing them are freed after
+`ADMISSION_LEASE_TIMEOUT` seconds, which must be longer than the longest export.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from shared_code import db_pool, instrumentation, query_guard
+from shared_code.priorities import ADMISSION_RETRY_AFTER, BATCH, INTERACTIVE, NORMAL, OVERLOADED, PRIORITIES
+
+# Queries running at the same time per database, 0 disables admission control
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', 0))
+# Slots only interactive queries can use
+ADMISSION_INTERACTIVE_RESERVED = int(os.environ.get('ADMISSION_INTERACTIVE_RESERVED', 1))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 50))
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 30))  # Seconds
+ADMISSION_LEASE_TIMEOUT = float(os.environ.get('ADMISSION_LEASE_TIMEOUT', 900))  # Seconds
+ADMISSION_POLL_INTERVAL = float(os.environ.get('ADMISSION_POLL_INTERVAL', 0.2))  # Seconds
+
+# The queue is created by deployment/admission.sql
+ADMISSION_SCHEMA = 'admission'
+# Polls back off to this interval
+MAX_POLL_INTERVAL = 1.0
+# Waiting rows which were not polled for this long belong to requests which are gone
+WAITER_TIMEOUT = 10.0
+# Key of the advisory lock serializing admissions, in the same database as the queue
+LOCK_KEY = 0x6f61_7371
+
+LOCK_QUERY = 'Select pg_advisory_xact_lock({});'
+EXPIRE_QUERY = (f'Delete from {ADMISSION_SCHEMA}.queue where heartbeat_at < clock_timestamp() - '
+                "case when state = 'running' then {}::float8 else {}::float8 end * interval '1 second';")
+DEPTH_QUERY = f"Select count(*) from {ADMISSION_SCHEMA}.queue where state = 'waiting';"
+TOUCH_QUERY = (f'Update {ADMISSION_SCHEMA}.queue set heartbeat_at = clock_timestamp() '
+               "where id = {} and state = 'waiting' returning id;")
+# A request which lost its row, e.g. after a long pause, joins the queue again at the end
+ENQUEUE_QUERY = f'Insert into {ADMISSION_SCHEMA}.queue (id, priority, slots) values ({{}}, {{}}, {{}});'
+# Admitted when enough slots are free and no waiter of a higher priority, or of the same
+# priority and older, is ahead of it
+ADMIT_QUERY = (f"Update {ADMISSION_SCHEMA}.queue q set state = 'running', heartbeat_at = clock_timestamp() "
+               "where q.id = {} and (select coalesce(sum(slots), 0) from " + ADMISSION_SCHEMA + ".queue "
+               "where state = 'running') + q.slots <= {} and not exists (select 1 from " + ADMISSION_SCHEMA + ".queue w "
+               "where w.state = 'waiting' and w.id <> q.id and (w.priority > q.priority or "
+               "w.priority = q.priority and w.enqueued_at < q.enqueued_at)) returning id;")
+RELEASE_QUERY = f'Delete from {ADMISSION_SCHEMA}.queue where id = {{}};'
+
+_PSYCOPG = ('%s',) * 3
+_ASYNCPG = ('$1', '$2', '$3')
+
+
+class AdmissionRejected(query_guard.QueryRejected):
+    def __init__(self, message, retry_after, sql_query=None):
+        super().__init__(OVERLOADED, message, sql_query, {'retryAfter': retry_after})
+        self.retry_after = retry_after
+
+
+def is_enabled():
+    return ADMISSION_MAX_CONCURRENCY > 0
+
+
+def concurrency_limit(priority):
+    # Slots in use above which a query of the priority waits
+    if priority == INTERACTIVE:
+        return ADMISSION_MAX_CONCURRENCY
+    return max(1, ADMISSION_MAX_CONCURRENCY - ADMISSION_INTERACTIVE_RESERVED)
+
+
+def max_slots(priority):
+    # Slots a query of the priority can hold, None without admission control
+    return concurrency_limit(priority) if is_enabled() else None
+
+
+def _step(cursor, request_id, priority, first, slots=1):
+    """
+    One admission attempt in the current transaction. Returns whether the request was
+    admitted and the number of other requests waiting, or raises AdmissionRejected when
+    it would have to wait in a full queue.
+    """
+    cursor.execute(LOCK_QUERY.format('%s'), (LOCK_KEY,))
+    cursor.execute(EXPIRE_QUERY.format(*_PSYCOPG), (ADMISSION_LEASE_TIMEOUT, WAITER_TIMEOUT))
+    cursor.execute(DEPTH_QUERY)
+    waiting = cursor.fetchone()[0]
+    cursor.execute(TOUCH_QUERY.format('%s'), (request_id,))
+    if cursor.fetchone() is None:
+        cursor.execute(ENQUEUE_QUERY.format(*_PSYCOPG), (request_id, PRIORITIES[priority], slots))
+        waiting += 1
+    cursor.execute(ADMIT_QUERY.format(*_PSYCOPG), (request_id, concurrency_limit(priority)))
+    admitted = cursor.fetchone() is not None
+    # Requests which can't run right away only join a queue which isn't full, the
+    # rollback removes their row
+    if first and not admitted and waiting > ADMISSION_MAX_QUEUE:
+        _reject(priority, 'queue_full', waiting - 1)
+    return admitted, waiting - 1
+
+
+async def _step_async(conn, request_id, priority, first, slots=1):
+    # `_step` on an asyncpg connection
+    await conn.execute(LOCK_QUERY.format('$1'), LOCK_KEY)
+    await conn.execute(EXPIRE_QUERY.format(*_ASYNCPG), ADMISSION_LEASE_TIMEOUT, WAITER_TIMEOUT)
+    waiting = await conn.fetchval(DEPTH_QUERY)
+    if await conn.fetchval(TOUCH_QUERY.format('$1'), request_id) is None:
+        await conn.execute(ENQUEUE_QUERY.format(*_ASYNCPG), request_id, PRIORITIES[priority], slots)
+        waiting += 1
+    admitted = await conn.fetchval(ADMIT_QUERY.format(*_ASYNCPG), request_id, concurrency_limit(priority)) is not None
+    if first and not admitted and waiting > ADMISSION_MAX_QUEUE:
+        _reject(priority, 'queue_full', waiting - 1)
+    return admitted, waiting - 1
+
+
+def _reject(priority, reason, waiting):
+    instrumentation.add('openai_sql.admission.rejected', 1, {'priority': priority, 'reason': reason})
+    if reason == 'queue_full':
+        message = f'Too many queries waiting for the database ({waiting}), retry later.'
+    else:
+        message = f'Query waited {ADMISSION_MAX_WAIT:g} s for the database, retry later.'
+    raise AdmissionRejected(message, ADMISSION_RETRY_AFTER)
+
+
+def _record(span, priority, started, queue_depth, outcome):
+    wait = (time.monotonic() - started) * 1000
+    span.set_attribute('admission.wait_ms', round(wait, 1))
+    span.set_attribute('admission.queue_depth', queue_depth)
+    attributes = {'priority': priority, 'outcome': outcome}
+    instrumentation.record('openai_sql.admission.wait', wait, attributes, unit='ms')
+    instrumentation.record('openai_sql.admission.queue_depth', queue_depth, attributes)
+
+
+def _poll_interval(attempt, started):
+    # Backs off, but polls once more when ADMISSION_MAX_WAIT is reached
+    remaining = started + ADMISSION_MAX_WAIT - time.monotonic()
+    return max(0.0, min(ADMISSION_POLL_INTERVAL * 2 ** attempt, MAX_POLL_INTERVAL, remaining))
+
+
+@contextmanager
+def admit(host, port, database, user, password, priority=NORMAL, slots=1):
+    """
+    Waits for `slots` slots to run a query on the database, one per connection it uses,
+    released when the block exits. Raises AdmissionRejected when the queue is full or
+    the wait is too long.
+    """
+    if not is_enabled():
+        yield
+        return
+    request_id = str(uuid.uuid4())
+    started = time.monotonic()
+    # Requests waiting when this one joined the queue
+    queue_depth = 0
+    # The row is removed whether the request was admitted, rejected or failed
+    try:
+        with instrumentation.span('admission', {'admission.priority': priority}) as span:
+            try:
+                for attempt in itertools.count():
+                    with db_pool.connection(host, port, database, user, password) as conn:
+                        with conn.cursor() as cursor:
+                            admitted, waiting = _step(cursor, request_id, priority, attempt == 0,
+                                                      min(slots, concurrency_limit(priority)))
+                    if attempt == 0:
+                        queue_depth = waiting
+                    if admitted:
+                        break
+                    if time.monotonic() - started >= ADMISSION_MAX_WAIT:
+                        _reject(priority, 'timeout', waiting)
+                    time.sleep(_poll_interval(attempt, started))
+            except BaseException:
+                _record(span, priority, started, queue_depth, 'rejected')
+                raise
+            _record(span, priority, started, queue_depth, 'admitted')
+        yield
+    finally:
+        _release(host, port, database, user, password, request_id)
+
+
+def _release(host, port, database, user, password, request_id):
+    try:
+        with db_pool.connection(host, port, database, user, password) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(RELEASE_QUERY.format('%s'), (request_id,))
+    except Exception as e:
+        # The slot is freed by ADMISSION_LEASE_TIMEOUT instead
+        logging.warning(f'Admission slot {request_id} was not released: {e!r}')
+
+
+@asynccontextmanager
+async def admit_async(host, port, database, user, password, priority=INTERACTIVE):
+    """
+    `admit` which polls with the asyncpg pool, without blocking the event loop.
+    """
+    if not is_enabled():
+        yield
+        return
+    from shared_code import async_db_pool
+    pool = await async_db_pool.get_pool(host, port, database, user, password)
+    request_id = uuid.uuid4()
+    started = time.monotonic()
+    queue_depth = 0
+    try:
+        with instrumentation.span('admission', {'admission.priority': priority}) as span:
+            try:
+                for attempt in itertools.count():
+                    async with pool.acquire() as conn:
+                        async with conn.transaction():
+                            admitted, waiting = await _step_async(conn, request_id, priority, attempt == 0)
+                    if attempt == 0:
+                        queue_depth = waiting
+                    if admitted:
+                        break
+                    if time.monotonic() - started >= ADMISSION_MAX_WAIT:
+                        _reject(priority, 'timeout', waiting)
+                    await asyncio.sleep(_poll_interval(attempt, started))
+            except BaseException:
+                _record(span, priority, started, queue_depth, 'rejected')
+                raise
+            _record(span, priority, started, queue_depth, 'admitted')
+        yield
+    finally:
+        await _release_async(pool, request_id)
+
+
+async def _release_async(pool, request_id):
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(RELEASE_QUERY.format('$1'), request_id)
+    except Exception as e:
+        logging.warning(f'Admission slot {request_id} was not released: {e!r}')
@@ -0,0 +1,107 @@
+"""
+asyncio counterpart of `blob_storage`. Clients, credential and user delegation key are
+cached per worker with the same settings.
+"""
+import asyncio
+import base64
+from datetime import datetime, timedelta
+
+from shared_code.blob_storage import (RESULTS_STORAGE_CONNECTION_STRING, SAS_LIFETIME, SAS_START_SKEW,
+                                      USER_DELEGATION_KEY_LIFETIME, USER_DELEGATION_KEY_REFRESH_MARGIN, storage_blob)
+from shared_code.lazy_modules import lazy_import
+
+identity_aio = lazy_import('azure.identity.aio')
+storage_blob_aio = lazy_import('azure.storage.blob.aio')
+
+_credential = None
+_clients = {}
+_delegation_keys = {}  # account name -> (user delegation key, expiry time)
+_delegation_key_lock = None
+
+
+def get_blob_service_client(storage_account_name):
+    global _credential
+    client = _clients.get(storage_account_name)
+    if client is None:
+        if RESULTS_STORAGE_CONNECTION_STRING:
+            client = storage_blob_aio.BlobServiceClient.from_connection_string(RESULTS_STORAGE_CONNECTION_STRING)
+        else:
+            if _credential is None:
+                _credential = identity_aio.DefaultAzureCredential()
+            client = storage_blob_aio.BlobServiceClient(
+                account_url=f"https://{storage_account_name}.blob.core.windows.net",
+                credential=_credential
+            )
+        _clients[storage_account_name] = client
+    return client
+
+
+async def get_user_delegation_key(blob_service_client):
+    global _delegation_key_lock
+    if _delegation_key_lock is None:
+        _delegation_key_lock = asyncio.Lock()
+    # Concurrent requests wait for a single refresh instead of each fetching a key
+    async with _delegation_key_lock:
+        now = datetime.utcnow()
+        cached = _delegation_keys.get(blob_service_client.account_name)
+        if cached is not None and cached[1] - now > SAS_LIFETIME + USER_DELEGATION_KEY_REFRESH_MARGIN:
+            return cached[0]
+
+        key_expiry_time = now + USER_DELEGATION_KEY_LIFETIME
+        udk = await blob_service_client.get_user_delegation_key(
+            key_start_time=now - timedelta(hours=1),
+            key_expiry_time=key_expiry_time)
+        _delegation_keys[blob_service_client.account_name] = (udk, key_expiry_time)
+        return udk
+
+
+async def warm(storage_account_name):
+    # Create the client and fetch the delegation key ahead of the upload
+    blob_service_client = get_blob_service_client(storage_account_name)
+    if not getattr(blob_service_client.credential, 'account_key', None):
+        await get_user_delegation_key(blob_service_client)
+
+
+async def get_blob_sas_url(blob_service_client, storage_account_name, container_name, file_name):
+    account_key = getattr(blob_service_client.credential, 'account_key', None)
+    if account_key:
+        signing = {'account_key': account_key}
+    else:
+        signing = {'user_delegation_key': await get_user_delegation_key(blob_service_client)}
+
+    now = datetime.utcnow()
+    sas_token = storage_blob.generate_blob_sas(
+        account_name=blob_service_client.account_name,
+        container_name=container_name,
+        blob_name=file_name,
+        permission=storage_blob.BlobSasPermissions(read=True),
+        start=now - SAS_START_SKEW,
+        expiry=now + SAS_LIFETIME,
+        **signing
+    )
+    blob_url = blob_service_client.get_blob_client(container_name, file_name).url
+    return f"{blob_url}?{sas_token}"
+
+
+class AsyncBlockUploader:
+    """
+    Stages blocks of a block blob as they are produced and commits the block list
+    at the end.
+    """
+    def __init__(self, blob_client, content_type):
+        self.blob_client = blob_client
+        self.content_type = content_type
+        self.bytes_written = 0
+        self._block_ids = []
+
+    async def stage(self, data):
+        block_id = base64.b64encode(f'{len(self._block_ids):08d}'.encode()).decode()
+        await self.blob_client.stage_block(block_id, bytes(data))
+        self._block_ids.append(block_id)
+        self.bytes_written += len(data)
+
+    async def commit(self):
+        if not self._block_ids:
+            await self.stage(b'')
+        await self.blob_client.commit_block_list(
+            self._block_ids, content_settings=storage_blob.ContentSettings(content_type=self.content_type))
@@ -0,0 +1,45 @@
+"""
+Worker-lifetime asyncpg connection pools for the asyncio functions, keyed by server,
+database and user. Uses the same pool settings as `db_pool`.
+"""
+import asyncio
+import os
+
+from shared_code.lazy_modules import lazy_import
+
+asyncpg = lazy_import('asyncpg')
+
+POOL_MAX_SIZE = int(os.environ.get('POSTGRE_SQL_POOL_MAX_SIZE', 5))
+POOL_IDLE_TIMEOUT = float(os.environ.get('POSTGRE_SQL_POOL_IDLE_TIMEOUT', 300))
+
+_pools = {}
+_pools_lock = None
+
+
+async def get_pool(host, port, database, user, password):
+    global _pools_lock
+    key = (host, str(port), database, user)
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+
+    if _pools_lock is None:
+        _pools_lock = asyncio.Lock()
+    async with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = await asyncpg.create_pool(
+                host=host,
+                port=int(port),
+                database=database,
+                user=user,
+                password=password,
+                min_size=0,
+                max_size=POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=POOL_IDLE_TIMEOUT)
+    return pool
+
+
+async def connect(host, port, database, user, password):
+    # Dedicated connection outside of the pool, e.g. for LISTEN
+    return await asyncpg.connect(host=host, port=int(port), database=database, user=user, password=password)
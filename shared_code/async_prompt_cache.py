@@ -0,0 +1,84 @@
+"""
+asyncio counterpart of `prompt_cache`, sharing its queries, rendering and settings.
+Notifications on `PROMPT_CACHE_NOTIFY_CHANNEL` are received with an asyncpg listener.
+"""
+import asyncio
+import logging
+
+from shared_code import async_db_pool, instrumentation
+from shared_code.prompt_cache import (CATALOG_QUERY, PROMPT_CACHE_LISTEN_RETRY, PROMPT_CACHE_NOTIFY_CHANNEL,
+                                      PROMPT_CACHE_TTL, PROMPT_LINES_QUERY, PROMPT_VERSION_QUERY, PromptSchema,
+                                      catalog_params, get_schema_text, to_catalog)
+
+
+class AsyncPromptSchemaCache:
+    def __init__(self, host, port, database, user, password,
+                 ttl=PROMPT_CACHE_TTL, notify_channel=PROMPT_CACHE_NOTIFY_CHANNEL):
+        self.conn_params = (host, port, database, user, password)
+        self.ttl = ttl
+        self.notify_channel = notify_channel
+        self._schema = None
+        self._expires_at = 0
+        self._listener = None
+        self._listen_failed_at = None
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        async with self._lock:
+            await self._ensure_listener()
+            if self._schema is None or asyncio.get_event_loop().time() >= self._expires_at:
+                await self._refresh()
+            return self._schema
+
+    def invalidate(self, *args):
+        self._schema = None
+
+    async def _refresh(self):
+        pool = await async_db_pool.get_pool(*self.conn_params)
+        async with pool.acquire() as conn:
+            version = await conn.fetchval(PROMPT_VERSION_QUERY)
+            if self._schema is None or self._schema.version != version:
+                logging.info(f'Loading prompt schema version {version}')
+                lines = [row['line'] for row in await conn.fetch(PROMPT_LINES_QUERY)]
+                rows = await conn.fetch(CATALOG_QUERY.format('$1', '$2', '$3'), *catalog_params(lines))
+                self._schema = PromptSchema(lines, get_schema_text(lines), version, to_catalog(map(tuple, rows)))
+        self._expires_at = asyncio.get_event_loop().time() + self.ttl
+
+    async def _ensure_listener(self):
+        if not self.notify_channel or (self._listener is not None and not self._listener.is_closed()):
+            return
+        now = asyncio.get_event_loop().time()
+        if self._listen_failed_at is not None and now - self._listen_failed_at < PROMPT_CACHE_LISTEN_RETRY:
+            return
+        try:
+            self._listener = await async_db_pool.connect(*self.conn_params)
+            await self._listener.add_listener(self.notify_channel, self.invalidate)
+            self._listen_failed_at = None
+            # Changes may have been missed while not listening
+            self._schema = None
+        except Exception as e:
+            # Fall back to TTL based invalidation until the listener can be re-established,
+            # the cached schema is kept
+            logging.exception(e)
+            if self._listener is not None:
+                self._listener.terminate()
+            self._listener = None
+            self._listen_failed_at = asyncio.get_event_loop().time()
+
+
+_caches = {}
+
+
+def get_prompt_cache(host, port, database, user, password):
+    key = (host, str(port), database, user)
+    cache = _caches.get(key)
+    if cache is None:
+        cache = _caches[key] = AsyncPromptSchemaCache(host, port, database, user, password)
+    return cache
+
+
+async def get_prompt_schema(host, port, database, user, password):
+    with instrumentation.span('get_prompt_schema') as span:
+        prompt_schema = await get_prompt_cache(host, port, database, user, password).get()
+        span.set_attribute('prompt.version', prompt_schema.version)
+        return prompt_schema
@@ -0,0 +1,124 @@
+"""
+asyncio pipeline which streams query results from an asyncpg cursor to a block blob.
+Rows are fetched and encoded by one task while the previously encoded blocks are being
+staged by another, so the upload starts while rows are still streaming.
+"""
+import asyncio
+import logging
+import time
+
+from shared_code import admission, async_blob_storage, async_db_pool, instrumentation, query_guard, result_formats
+from shared_code.blob_storage import RESULTS_BLOCK_SIZE
+from shared_code.result_stream import RESULTS_BATCH_SIZE
+
+# Number of encoded blocks which may wait for upload before fetching is paused
+RESULTS_UPLOAD_QUEUE_SIZE = 2
+
+
+class BlockBuffer:
+    """
+    File-like sink for the result encoders which hands out complete blocks.
+    """
+    def __init__(self):
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take_blocks(self, block_size):
+        while len(self._buffer) >= block_size:
+            block = bytes(self._buffer[:block_size])
+            del self._buffer[:block_size]
+            yield block
+
+    def take_rest(self):
+        block = bytes(self._buffer)
+        self._buffer = bytearray()
+        return block
+
+
+async def _produce(pool, sql_query, result_format, queue, batch_size, block_size, span):
+    sink = BlockBuffer()
+    rows_count = 0
+    start = time.monotonic()
+    async with pool.acquire() as conn:
+        wait_ms = (time.monotonic() - start) * 1000
+        instrumentation.record('openai_sql.db_pool.wait_time', wait_ms, unit='ms')
+        span.set_attribute('db.pool_wait_ms', wait_ms)
+        # Cursors need a transaction
+        async with conn.transaction():
+            sql_query = await query_guard.guard_query_async(conn, sql_query)
+            statement = await conn.prepare(sql_query)
+            description = [result_formats.Column(attr.name, attr.type.oid) for attr in statement.get_attributes()]
+            encoder = result_format.encoder(sink, description)
+            cursor = await statement.cursor()
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+                encoder.write_batch(rows)
+                rows_count += len(rows)
+                span.set_attribute('db.rows', rows_count)
+                for block in sink.take_blocks(block_size):
+                    await queue.put(block)
+            encoder.close()
+    instrumentation.add('openai_sql.rows', rows_count)
+    rest = sink.take_rest()
+    if rest:
+        await queue.put(rest)
+    await queue.put(None)
+
+
+async def _consume(uploader, queue):
+    while True:
+        block = await queue.get()
+        if block is None:
+            break
+        await uploader.stage(block)
+    await uploader.commit()
+
+
+async def export_query_to_blob(host, port, database, user, password, sql_query,
+                               storage_account_name, container_name, file_name, output_format=None,
+                               batch_size=RESULTS_BATCH_SIZE, block_size=RESULTS_BLOCK_SIZE,
+                               priority=admission.INTERACTIVE):
+    """
+    Execute the query, once admitted with the given priority, and stream the results in
+    the given output format to a block blob, returning the SAS URL of the blob.
+    """
+    result_format = result_formats.get_output_format(output_format)
+    pool = await async_db_pool.get_pool(host, port, database, user, password)
+    blob_service_client = async_blob_storage.get_blob_service_client(storage_account_name)
+    uploader = async_blob_storage.AsyncBlockUploader(
+        blob_service_client.get_blob_client(container_name, file_name), result_format.content_type)
+
+    with instrumentation.span('export_query_to_blob', {'output_format': result_format.extension}) as span:
+        async with admission.admit_async(host, port, database, user, password, priority):
+            queue = asyncio.Queue(maxsize=RESULTS_UPLOAD_QUEUE_SIZE)
+            tasks = [asyncio.ensure_future(_produce(pool, sql_query, result_format, queue, batch_size, block_size, span)),
+                     asyncio.ensure_future(_consume(uploader, queue))]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # A failed upload must not leave the producer blocked on a full queue, and vice versa
+                for task in tasks:
+                    task.cancel()
+                raise
+        span.set_attribute('blob.bytes_uploaded', uploader.bytes_written)
+        instrumentation.add('openai_sql.bytes_uploaded', uploader.bytes_written, unit='By')
+        logging.info(f'Uploaded {uploader.bytes_written} bytes to {file_name}')
+        return await async_blob_storage.get_blob_sas_url(blob_service_client, storage_account_name,
+                                                         container_name, file_name)
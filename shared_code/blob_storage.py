@@ -0,0 +1,175 @@
+"""
+Helpers for writing query results to Azure Blob Storage and handing out SAS URLs.
+
+The credential, the BlobServiceClient of each storage account and the user delegation
+key are cached for the lifetime of the worker, so generating a SAS URL is a local HMAC
+operation except when the delegation key is about to expire. Setting
+`RESULTS_STORAGE_CONNECTION_STRING` (e.g. `UseDevelopmentStorage=true` for Azurite)
+uses the connection string and account key SAS instead.
+"""
+import base64
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from shared_code import instrumentation
+from shared_code.lazy_modules import lazy_import
+
+identity = lazy_import('azure.identity')
+storage_blob = lazy_import('azure.storage.blob')
+
+# Size of the blocks staged by BlockBlobWriter, bounds the upload buffer
+RESULTS_BLOCK_SIZE = int(os.environ.get('RESULTS_BLOCK_SIZE', 4 * 1024 * 1024))
+RESULTS_STORAGE_CONNECTION_STRING = os.environ.get('RESULTS_STORAGE_CONNECTION_STRING', '')
+USER_DELEGATION_KEY_LIFETIME = timedelta(seconds=float(os.environ.get('USER_DELEGATION_KEY_LIFETIME', 6 * 3600)))
+# Delegation key is refreshed when it would expire within this margin after the SAS expiry
+USER_DELEGATION_KEY_REFRESH_MARGIN = timedelta(minutes=5)
+SAS_START_SKEW = timedelta(minutes=15)
+SAS_LIFETIME = timedelta(minutes=30)
+
+_credential = None
+_clients = {}
+_delegation_keys = {}  # account name -> (user delegation key, expiry time)
+_lock = threading.Lock()
+
+
+def get_credential():
+    global _credential
+    with _lock:
+        if _credential is None:
+            _credential = identity.DefaultAzureCredential()
+        return _credential
+
+
+def get_blob_service_client(storage_account_name):
+    with _lock:
+        client = _clients.get(storage_account_name)
+    if client is not None:
+        return client
+
+    if RESULTS_STORAGE_CONNECTION_STRING:
+        client = storage_blob.BlobServiceClient.from_connection_string(RESULTS_STORAGE_CONNECTION_STRING)
+    else:
+        client = storage_blob.BlobServiceClient(
+            account_url=f"https://{storage_account_name}.blob.core.windows.net",
+            credential=get_credential()
+        )
+    with _lock:
+        return _clients.setdefault(storage_account_name, client)
+
+
+def get_user_delegation_key(blob_service_client):
+    now = datetime.utcnow()
+    account_name = blob_service_client.account_name
+    with _lock:
+        cached = _delegation_keys.get(account_name)
+    if cached is not None and cached[1] - now > SAS_LIFETIME + USER_DELEGATION_KEY_REFRESH_MARGIN:
+        return cached[0]
+
+    key_expiry_time = now + USER_DELEGATION_KEY_LIFETIME
+    udk = blob_service_client.get_user_delegation_key(
+        key_start_time=now - timedelta(hours=1),
+        key_expiry_time=key_expiry_time)
+    with _lock:
+        _delegation_keys[account_name] = (udk, key_expiry_time)
+    return udk
+
+
+def get_blob_sas_url(blob_service_client, storage_account_name, container_name, file_name):
+    now = datetime.utcnow()
+    account_key = getattr(blob_service_client.credential, 'account_key', None)
+    if account_key:
+        signing = {'account_key': account_key}
+    else:
+        signing = {'user_delegation_key': get_user_delegation_key(blob_service_client)}
+
+    sas_token = storage_blob.generate_blob_sas(
+        account_name=blob_service_client.account_name,
+        container_name=container_name,
+        blob_name=file_name,
+        permission=storage_blob.BlobSasPermissions(read=True),
+        start=now - SAS_START_SKEW,
+        expiry=now + SAS_LIFETIME,
+        **signing
+    )
+    blob_url = blob_service_client.get_blob_client(container_name, file_name).url
+    return f"{blob_url}?{sas_token}"
+
+
+def upload_blob(storage_account_name, container_name, file_name, data, content_type=None):
+    with instrumentation.span('upload_results_to_blob', {'blob.bytes_uploaded': len(data)}):
+        blob_service_client = get_blob_service_client(storage_account_name)
+        blob_client = blob_service_client.get_blob_client(container_name, file_name)
+        blob_client.upload_blob(data, overwrite=True,
+                                content_settings=storage_blob.ContentSettings(content_type=content_type) if content_type else None)
+        instrumentation.add('openai_sql.bytes_uploaded', len(data), unit='By')
+        return get_blob_sas_url(blob_service_client, storage_account_name, container_name, file_name)
+
+
+def commit_blocks(blob_client, block_ids, content_type, metadata=None):
+    blob_client.commit_block_list(
+        block_ids, content_settings=storage_blob.ContentSettings(content_type=content_type), metadata=metadata or None)
+
+
+class BlockBlobWriter:
+    """
+    File-like writer which uploads a block blob incrementally with stage_block and
+    commits the block list on close, so only one block is held in memory at a time.
+    Without `commit` the blocks are only staged, so several writers can write parts of
+    one blob and the parts are committed together.
+
+    Block IDs start with an ID of the writer, so writers of the same blob never overwrite
+    each other's blocks. A commit discards the uncommitted blocks of the other writers,
+    whose own commit then fails with InvalidBlockList instead of mixing their blocks.
+    """
+    def __init__(self, blob_client, content_type, block_size=RESULTS_BLOCK_SIZE, commit=True):
+        self.blob_client = blob_client
+        self.content_type = content_type
+        self.block_size = block_size
+        self.commit = commit
+        # Same length for all writers, the block IDs of a blob must have the same length
+        self.writer_id = uuid.uuid4().hex[:16]
+        self.bytes_written = 0
+        self.closed = False
+        # Metadata set on the blob when the block list is committed
+        self.metadata = {}
+        self.block_ids = []
+        self._buffer = bytearray()
+
+    def _stage(self, data):
+        block_id = base64.b64encode(f'{self.writer_id}{len(self.block_ids):08d}'.encode()).decode()
+        self.blob_client.stage_block(block_id, bytes(data))
+        self.block_ids.append(block_id)
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._stage(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._buffer or (self.commit and not self.block_ids):
+            self._stage(self._buffer)
+            self._buffer = bytearray()
+        if self.commit:
+            commit_blocks(self.blob_client, self.block_ids, self.content_type, self.metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Staged blocks which are never committed are garbage collected by the service
+        if exc_type is None:
+            self.close()
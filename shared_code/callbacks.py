@@ -0,0 +1,198 @@
+"""
+Delivery of the output of an orchastration to the `callbackUrl` of the request, so
+clients don't have to poll `statusQueryGetUri`.
+
+The output is POSTed as JSON by the `fn-drbl-act-send-callback` activity, signed with
+HMAC-SHA256 over `<timestamp>.<body>` using `CALLBACK_SIGNING_SECRET`. Receivers should
+recompute the signature, reject old timestamps and use the `X-Callback-Id` header, the
+instance ID, to ignore repeated deliveries. Deliveries run in an orchastration of their
+own, `fn-drbl-orch-send-callback`, started by `fn-drbl-act-start-callback` without
+waiting for it, so the orchastration completes as soon as its output is ready. Failed
+deliveries are retried with durable timers and exponential backoff, so a retry doesn't
+hold a worker and survives restarts.
+"""
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from shared_code import instrumentation, query_guard
+
+# Secret used to sign callbacks, callbackUrl is refused when it isn't set
+CALLBACK_SIGNING_SECRET = os.environ.get('CALLBACK_SIGNING_SECRET', '')
+# Comma separated host names callbacks can be sent to, empty allows any host
+CALLBACK_ALLOWED_HOSTS = [h.strip().lower() for h in os.environ.get('CALLBACK_ALLOWED_HOSTS', '').split(',') if h.strip()]
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get('CALLBACK_MAX_ATTEMPTS', 6))
+CALLBACK_RETRY_BASE_DELAY = float(os.environ.get('CALLBACK_RETRY_BASE_DELAY', 5))  # Seconds
+CALLBACK_RETRY_MAX_DELAY = float(os.environ.get('CALLBACK_RETRY_MAX_DELAY', 300))  # Seconds
+CALLBACK_TIMEOUT = float(os.environ.get('CALLBACK_TIMEOUT', 10))  # Seconds
+
+SIGNATURE_HEADER = 'X-Callback-Signature'
+TIMESTAMP_HEADER = 'X-Callback-Timestamp'
+# Request timeout, rate limited and server errors are retried, other client errors are not
+RETRY_STATUS_CODES = {408, 425, 429}
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Redirects are failed deliveries, following them would bypass CALLBACK_ALLOWED_HOSTS
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def validate_callback_url(callback_url):
+    """
+    Error message for a callbackUrl which can't be used, None when it is valid.
+    """
+    if not CALLBACK_SIGNING_SECRET:
+        return 'Callbacks are not enabled, CALLBACK_SIGNING_SECRET is not set.'
+    if not isinstance(callback_url, str):
+        return 'callbackUrl must be a URL.'
+    url = urlsplit(callback_url)
+    host = (url.hostname or '').lower()
+    if not host or url.scheme not in ('https', 'http'):
+        return 'callbackUrl must be an absolute https URL.'
+    # The results URL is a bearer token, plain http is only allowed for local testing
+    if url.scheme == 'http' and not _is_loopback(host):
+        return 'callbackUrl must use https.'
+    if CALLBACK_ALLOWED_HOSTS and host not in CALLBACK_ALLOWED_HOSTS:
+        return f'callbackUrl host {host} is not allowed.'
+    return None
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def sign(body, timestamp, secret=None):
+    """
+    Signature header value of a callback body, `sha256=<hex digest>`.
+    """
+    message = f'{timestamp}.'.encode() + body
+    digest = hmac.new((secret or CALLBACK_SIGNING_SECRET).encode(), message, hashlib.sha256).hexdigest()
+    return f'sha256={digest}'
+
+
+def post_callback(callback_url, payload, delivery_id, attempt=1, correlation_id=None):
+    """
+    POSTs the signed payload once. Returns the outcome of the delivery, with `retry` set
+    when it failed transiently and `retryAfter` when the receiver asked for a delay.
+    """
+    error = validate_callback_url(callback_url)
+    if error:
+        return {'delivered': False, 'retry': False, 'error': error}
+    body = json.dumps(payload, separators=(',', ':'), default=str).encode()
+    # The timestamp is signed with the body, so a captured callback can't be replayed later
+    timestamp = str(int(time.time()))
+    headers = {'Content-Type': 'application/json',
+               'User-Agent': 'openai-sql-callback',
+               'X-Callback-Id': delivery_id,
+               'X-Callback-Attempt': str(attempt),
+               TIMESTAMP_HEADER: timestamp,
+               SIGNATURE_HEADER: sign(body, timestamp)}
+    if correlation_id:
+        headers['x-correlation-id'] = correlation_id
+    request = urllib.request.Request(callback_url, data=body, headers=headers, method='POST')
+    instrumentation.set_attribute('callback.attempt', attempt)
+    try:
+        with _opener.open(request, timeout=CALLBACK_TIMEOUT) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+        result = {'delivered': False, 'status': status, 'error': f'Callback failed with status {status}',
+                  'retry': status in RETRY_STATUS_CODES or status >= 500}
+        retry_after = _retry_after(e.headers.get('Retry-After'))
+        if retry_after is not None:
+            result['retryAfter'] = retry_after
+    except (urllib.error.URLError, OSError) as e:
+        # Connection errors and timeouts
+        result = {'delivered': False, 'error': f'Callback failed: {getattr(e, "reason", e)}', 'retry': True}
+    else:
+        result = {'delivered': True, 'status': status}
+    instrumentation.set_attribute('callback.status', result.get('status', 0))
+    instrumentation.add('openai_sql.callbacks', 1, {'delivered': result['delivered']})
+    return result
+
+
+def _retry_after(value):
+    # Only the delay in seconds form of Retry-After is used
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Seconds to wait before the next attempt, doubled with every attempt.
+    """
+    delay = min(CALLBACK_RETRY_BASE_DELAY * 2 ** (attempt - 1), CALLBACK_RETRY_MAX_DELAY)
+    if retry_after is not None:
+        delay = min(max(delay, retry_after), CALLBACK_RETRY_MAX_DELAY)
+    return delay
+
+
+def delivery_instance_id(instance_id):
+    # Instance ID of the delivery orchastration of the output of an orchastration
+    return f'{instance_id}-callback'
+
+
+def send_callback(context, params, output):
+    """
+    Starts the delivery of the output of the orchastration to the callbackUrl of its
+    input, if any, without waiting for it. Used from orchastrator functions with
+    `yield from` once their custom status is final, right before returning the output.
+    """
+    callback_url = params.get('callbackUrl')
+    if not callback_url:
+        return None
+    failed = isinstance(output, list) or query_guard.is_error_result(output)
+    payload = {'instanceId': context.instance_id,
+               'correlationId': params.get('correlationId'),
+               'status': 'failed' if failed else 'completed',
+               'output': output}
+    result = yield context.call_activity('fn-drbl-act-start-callback',
+                                {
+                                    'callback_url': callback_url,
+                                    'payload': payload,
+                                    'correlation_id': params.get('correlationId'),
+                                    'trace_context': params.get('traceContext')
+                                })
+    if not result.get('started') and not context.is_replaying:
+        logging.warning(f"Callback of {context.instance_id} was not started: {result.get('error')}")
+    return result
+
+
+def deliver_callback(context, delivery):
+    """
+    Delivers a callback started by `send_callback`, retrying failed deliveries after
+    durable timers. Used from `fn-drbl-orch-send-callback` with `yield from`, returns
+    the outcome of the last attempt. Failed deliveries are logged, the output is still
+    available through statusQueryGetUri.
+    """
+    instance_id = delivery['payload']['instanceId']
+    result = None
+    for attempt in range(1, max(1, CALLBACK_MAX_ATTEMPTS) + 1):
+        result = yield context.call_activity('fn-drbl-act-send-callback', {**delivery, 'attempt': attempt})
+        if result.get('delivered') or not result.get('retry') or attempt == CALLBACK_MAX_ATTEMPTS:
+            break
+        # Durable timer, the orchastration is unloaded while it waits
+        delay = retry_delay(attempt, result.get('retryAfter'))
+        yield context.create_timer(context.current_utc_datetime + timedelta(seconds=delay))
+    if not result.get('delivered') and not context.is_replaying:
+        logging.warning(f"Callback of {instance_id} was not delivered: {result.get('error')}")
+    return {**result, 'attempts': attempt}
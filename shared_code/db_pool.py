@@ -0,0 +1,159 @@
+"""
+Worker-lifetime PostgreSQL connection pool shared by all the functions in the app.
+
+Pools are keyed by DSN, so every function talking to the same server/database/user
+borrows from the same set of connections instead of paying a TLS handshake and
+Postgres authentication on every invocation.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import make_dsn, TRANSACTION_STATUS_IDLE
+from shared_code import instrumentation
+
+POOL_MAX_SIZE = int(os.environ.get('POSTGRE_SQL_POOL_MAX_SIZE', 5))
+# Connections idle for longer than this are closed instead of being reused
+POOL_IDLE_TIMEOUT = float(os.environ.get('POSTGRE_SQL_POOL_IDLE_TIMEOUT', 300))
+# Connections idle for longer than this are pinged before being handed out
+POOL_CHECK_INTERVAL = float(os.environ.get('POSTGRE_SQL_POOL_CHECK_INTERVAL', 30))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('POSTGRE_SQL_POOL_ACQUIRE_TIMEOUT', 30))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_interval=POOL_CHECK_INTERVAL):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._idle = []  # (connection, last used time), most recently used last
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('select 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _expire_idle(self):
+        # Called with the lock held. Oldest connections are at the front of the list.
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._close(conn)
+
+    def acquire(self, timeout=POOL_ACQUIRE_TIMEOUT):
+        start = time.monotonic()
+        deadline = start + timeout
+        conn, last_used = None, None
+        with self._cond:
+            while True:
+                self._expire_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f'Timed out after {timeout}s waiting for a database connection')
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        # Health check and connect outside the lock so other borrowers are not blocked
+        try:
+            if conn is not None and not self._is_healthy(conn, time.monotonic() - last_used):
+                logging.info('Discarding unhealthy pooled connection')
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        wait_ms = (time.monotonic() - start) * 1000
+        instrumentation.record('openai_sql.db_pool.wait_time', wait_ms, unit='ms')
+        instrumentation.set_attribute('db.pool_wait_ms', wait_ms)
+        return conn
+
+    def release(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._close(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, database, user, password):
+    dsn = make_dsn(host=host, port=port, dbname=database, user=user, password=password)
+    with _pools_lock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            pool = _pools[dsn] = ConnectionPool(dsn)
+    return pool
+
+
+@contextmanager
+def connection(host, port, database, user, password):
+    """
+    Borrow a pooled connection. The transaction is committed on success and rolled
+    back on error, like `with psycopg2.connect(...) as conn`, but the connection is
+    returned to the pool instead of being left open.
+    """
+    pool = get_pool(host, port, database, user, password)
+    conn = pool.acquire()
+    discard = False
+    try:
+        with conn:
+            yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        pool.release(conn, discard=discard)
@@ -0,0 +1,199 @@
+"""
+Timing spans and metrics for the stages of the pipeline.
+
+Spans are exported as OpenTelemetry spans and the stage durations, row counts, bytes
+uploaded, tokens used, cache results and pool wait times as OpenTelemetry metrics.
+`OTEL_TRACES_EXPORTER` and `OTEL_METRICS_EXPORTER` select the exporter, `console` or
+`otlp` (configured with the standard `OTEL_EXPORTER_OTLP_*` settings). Every span is
+also logged with its duration, attributes and correlation ID, which also works when
+OpenTelemetry is not installed.
+
+The correlation ID and the W3C trace context are created by the HTTP starter and passed
+through the orchestrator to the activities, so all the spans of a request share a trace.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import metrics, trace
+    from opentelemetry.propagate import extract, inject as inject_context
+except ImportError:
+    metrics = trace = None
+
+OTEL_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'openai-sql')
+OTEL_TRACES_EXPORTER = os.environ.get('OTEL_TRACES_EXPORTER', 'none')
+OTEL_METRICS_EXPORTER = os.environ.get('OTEL_METRICS_EXPORTER', 'none')
+
+_current_span = contextvars.ContextVar('openai_sql_span', default=None)
+_instruments = {}
+_listeners = []
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _configure():
+    global _configured
+    if _configured or trace is None:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+        from opentelemetry.sdk.resources import Resource
+        resource = Resource.create({'service.name': OTEL_SERVICE_NAME})
+
+        if OTEL_TRACES_EXPORTER in ('console', 'otlp'):
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+            if OTEL_TRACES_EXPORTER == 'otlp':
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+                span_exporter = OTLPSpanExporter()
+            else:
+                span_exporter = ConsoleSpanExporter()
+            tracer_provider = TracerProvider(resource=resource)
+            tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+            trace.set_tracer_provider(tracer_provider)
+
+        if OTEL_METRICS_EXPORTER in ('console', 'otlp'):
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
+            if OTEL_METRICS_EXPORTER == 'otlp':
+                from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+                metric_exporter = OTLPMetricExporter()
+            else:
+                metric_exporter = ConsoleMetricExporter()
+            metrics.set_meter_provider(MeterProvider(
+                resource=resource, metric_readers=[PeriodicExportingMetricReader(metric_exporter)]))
+
+
+class Span:
+    def __init__(self, name, correlation_id, attributes):
+        self.name = name
+        self.correlation_id = correlation_id
+        self.attributes = attributes
+        self.otel_span = None
+        # Outermost span of the request or activity, which gets the totals of the request
+        self.root = self
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+        if self.otel_span is not None:
+            self.otel_span.set_attribute(key, value)
+
+
+@contextmanager
+def span(name, attributes=None, correlation_id=None, trace_context=None):
+    """
+    Time a stage of the pipeline. Nested spans inherit the correlation ID, spans of
+    activities continue the trace of the caller when its `trace_context` is passed.
+    """
+    _configure()
+    parent = _current_span.get()
+    if correlation_id is None and parent is not None:
+        correlation_id = parent.correlation_id
+    current = Span(name, correlation_id, dict(attributes or {}))
+    if parent is not None:
+        current.root = parent.root
+    if correlation_id:
+        current.attributes['correlation_id'] = correlation_id
+
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        if trace is not None:
+            context = extract(trace_context) if trace_context else None
+            tracer = trace.get_tracer('openai_sql')
+            with tracer.start_as_current_span(name, context=context, attributes=current.attributes) as otel_span:
+                current.otel_span = otel_span
+                yield current
+        else:
+            yield current
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        _current_span.reset(token)
+        record('openai_sql.stage.duration', duration_ms, {'stage': name}, unit='ms')
+        logging.info(f'[{correlation_id}] {name} took {duration_ms:.1f} ms {current.attributes}')
+        for listener in _listeners:
+            listener(name, duration_ms, current.attributes)
+
+
+def add_listener(listener):
+    # Call listener(name, duration_ms, attributes) when a span ends, e.g. to collect timings in benchmarks
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def set_attribute(key, value):
+    # Set an attribute on the innermost span, if any
+    current = _current_span.get()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def inject():
+    # W3C trace context of the current span, to be passed to activities
+    carrier = {}
+    if trace is not None:
+        inject_context(carrier)
+    return carrier
+
+
+def _instrument(kind, name, unit):
+    instrument = _instruments.get(name)
+    if instrument is None:
+        meter = metrics.get_meter('openai_sql')
+        if kind == 'histogram':
+            instrument = meter.create_histogram(name, unit=unit)
+        else:
+            instrument = meter.create_counter(name, unit=unit)
+        _instruments[name] = instrument
+    return instrument
+
+
+def record(name, value, attributes=None, unit=''):
+    # Record a value of a histogram metric, e.g. a duration
+    if metrics is not None:
+        _configure()
+        _instrument('histogram', name, unit).record(value, attributes=attributes)
+
+
+def add(name, value, attributes=None, unit=''):
+    # Add to a counter metric, e.g. rows or bytes
+    if metrics is not None:
+        _configure()
+        _instrument('counter', name, unit).add(value, attributes=attributes)
+
+
+def record_openai_usage(response):
+    # Token usage of an OpenAI completion response, on the current span and as metrics.
+    # The tokens of all completions of the request are summed up on its root span.
+    usage = response.get('usage') or {}
+    current = _current_span.get()
+    for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+        if key in usage:
+            set_attribute(f'openai.{key}', usage[key])
+            if current is not None:
+                current.root.set_attribute(f'request.{key}', current.root.attributes.get(f'request.{key}', 0) + usage[key])
+            if key != 'total_tokens':
+                add('openai_sql.tokens', usage[key], {'type': key.split('_')[0]})
+
+
+def request_usage(current=None):
+    """
+    Tokens used by the OpenAI completions of the request of the current span so far.
+    """
+    current = current or _current_span.get()
+    attributes = current.root.attributes if current is not None else {}
+    return {'promptTokens': attributes.get('request.prompt_tokens', 0),
+            'completionTokens': attributes.get('request.completion_tokens', 0)}
@@ -0,0 +1,36 @@
+"""
+Deferred imports of the heavy dependencies, to keep the cold start of the function app short.
+
+The worker imports every function of the app when it starts, so a package imported at
+module level by any function delays all of them, including orchestrator replays which
+never use it. Modules returned by `lazy_import` are only imported when one of their
+attributes is first used, e.g. `openai.Completion`, and importing is thread safe.
+
+    openai = lazy_import('openai')
+"""
+import importlib
+import sys
+
+
+class LazyModule:
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+
+    def _load(self):
+        return importlib.import_module(object.__getattribute__(self, '_name'))
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        # e.g. `openai.api_key = ...`
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return f"<lazy module '{object.__getattribute__(self, '_name')}'>"
+
+
+def lazy_import(name):
+    # Modules which are already imported are returned as is
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
@@ -0,0 +1,204 @@
+"""
+Batched generation of SQL for several questions, amortizing the schema part of the prompt.
+
+In `combined` mode the questions of a batch are numbered in one prompt after a single
+schema block and the numbered answers are parsed back out of the completion. Questions
+whose answer is missing or cut off are retried with a prompt of their own. In `list`
+mode the prompts of the batch are sent as a prompt list in one completion request,
+which saves requests but not tokens.
+
+All calls go through a `Dispatcher`, which limits the calls in flight and retries rate
+limited and transient failures with exponential backoff and jitter. A rate limit
+response pauses all calls of the worker for its `Retry-After`, so the quota recovers
+instead of being hit by every waiting call in turn.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from shared_code import instrumentation, prompt_builder, translation
+from shared_code.lazy_modules import lazy_import
+
+openai = lazy_import('openai')
+
+# Questions per prompt, 1 disables batching
+GENERATE_BATCH_SIZE = int(os.environ.get('GENERATE_BATCH_SIZE', 8))
+# `combined` or `list`
+GENERATE_BATCH_MODE = os.environ.get('GENERATE_BATCH_MODE', 'combined')
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 4))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 6))
+OPENAI_RETRY_BASE_DELAY = float(os.environ.get('OPENAI_RETRY_BASE_DELAY', 1))
+OPENAI_RETRY_MAX_DELAY = float(os.environ.get('OPENAI_RETRY_MAX_DELAY', 60))
+
+_ANSWER = re.compile(r'^\s*(\d+)\.\s*(?=select\b)', re.IGNORECASE | re.MULTILINE)
+# Markdown code fences some models wrap the answers in
+_FENCE = re.compile(r'```[a-z]*', re.IGNORECASE)
+
+# Monotonic time until which calls are paused after a rate limit response, shared by all dispatchers
+_resume_at = 0.0
+_resume_lock = threading.Lock()
+
+
+def _pause(delay):
+    global _resume_at
+    with _resume_lock:
+        _resume_at = max(_resume_at, time.monotonic() + delay)
+
+
+def retry_after(e):
+    # Delay in seconds requested by the service, Azure OpenAI also sends it in milliseconds
+    headers = getattr(e, 'headers', None) or {}
+    for key, scale in (('retry-after-ms', 1000), ('retry-after', 1)):
+        value = headers.get(key)
+        if value is not None:
+            try:
+                return float(value) / scale
+            except ValueError:
+                pass
+    return None
+
+
+def is_retryable(e):
+    if isinstance(e, (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout,
+                      openai.error.APIConnectionError, openai.error.TryAgain)):
+        return True
+    return isinstance(e, openai.error.APIError) and (e.http_status or 0) >= 500
+
+
+class Dispatcher:
+    """
+    Runs OpenAI calls with at most `max_concurrency` in flight, retrying rate limited
+    and transient failures. Create one per event loop.
+    """
+    def __init__(self, max_concurrency=OPENAI_MAX_CONCURRENCY, max_retries=OPENAI_MAX_RETRIES,
+                 base_delay=OPENAI_RETRY_BASE_DELAY, max_delay=OPENAI_RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    def backoff(self, attempt):
+        # Full jitter, so retries of concurrent calls spread out
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                delay = _resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    return await function(*args, **kwargs)
+                except Exception as e:
+                    if not is_retryable(e) or attempt >= self.max_retries:
+                        raise
+                    delay = min(self.max_delay, retry_after(e) or self.backoff(attempt))
+                    if isinstance(e, openai.error.RateLimitError):
+                        _pause(delay)
+                    logging.warning(f'OpenAI call failed with {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s')
+                    instrumentation.add('openai_sql.openai.retries', 1, {'error': type(e).__name__})
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def get_batch_prompt_text(schema_text, text_queries):
+    # Same layout as the single question prompt, with numbered questions and answers
+    newline = prompt_builder.NEWLINE
+    questions = ''.join(f'### {i}. A query to {q}{newline}' for i, q in enumerate(text_queries, 1))
+    return (schema_text + '### Answer every numbered query with one SQL statement ending in a semicolon, '
+            f'numbered the same{newline}' + questions + '1. SELECT')
+
+
+def parse_batch_completion(text, count, complete):
+    """
+    SQL of every numbered answer of a combined completion, None for the answers which
+    are missing. An answer without a semicolon is only used if it is the last one and
+    the completion was `complete`, i.e. not cut off by max_tokens. Answers are matched
+    to the questions by their number, in any order.
+    """
+    text = _FENCE.sub('', ('1. SELECT' + text).replace('\\n', '\n'))
+    parts = _ANSWER.split(text)
+    answers = [None] * count
+    for i in range(1, len(parts), 2):
+        number, answer = int(parts[i]), parts[i + 1]
+        if not 1 <= number <= count or answers[number - 1] is not None:
+            continue
+        body, semicolon, _ = answer[len('select'):].partition(';')
+        if semicolon or (complete and i == len(parts) - 2):
+            answers[number - 1] = translation.to_sql_query(body.rstrip())
+    return answers
+
+
+async def _generate_single(dispatcher, prompt_schema, text_query, completion_params):
+    return await translation.generate_sql_query_async(prompt_builder.build_prompt(prompt_schema, text_query),
+                                                      dispatcher.call, **completion_params)
+
+
+async def _generate_combined(dispatcher, prompt_schema, text_queries, completion_params):
+    # Schema pruning keeps the tables relevant to any of the questions
+    schema_text = prompt_builder.get_schema_text(prompt_schema, ' '.join(text_queries))
+    prompt = prompt_builder.build_batch_prompt(get_batch_prompt_text(schema_text, text_queries), len(text_queries))
+    with instrumentation.span('prompt_openai_batch', {'batch.size': len(text_queries), 'openai.max_tokens': prompt.max_tokens}):
+        response = await dispatcher.call(openai.Completion.acreate,
+                                         prompt=prompt.text,
+                                         stop=['#', f'\n{len(text_queries) + 1}.'],
+                                         **translation.completion_params(completion_params, prompt.max_tokens))
+        instrumentation.record_openai_usage(response)
+        prompt_builder.record_completion(response, prompt.max_tokens, len(text_queries))
+    choice = response['choices'][0]
+    answers = parse_batch_completion(choice['text'], len(text_queries), choice.get('finish_reason') == 'stop')
+
+    missing = [i for i, answer in enumerate(answers) if answer is None]
+    if missing:
+        logging.warning(f'{len(missing)} of {len(text_queries)} batched questions unanswered, prompting them singly')
+        instrumentation.add('openai_sql.openai.batch_fallbacks', len(missing))
+        results = await asyncio.gather(*(_generate_single(dispatcher, prompt_schema, text_queries[i], completion_params)
+                                         for i in missing), return_exceptions=True)
+        for i, result in zip(missing, results):
+            answers[i] = result
+    return answers
+
+
+async def _generate_list(dispatcher, prompt_schema, text_queries, completion_params):
+    prompts = [prompt_builder.build_prompt(prompt_schema, q) for q in text_queries]
+    # max_tokens applies to every prompt of the list
+    max_tokens = max(prompt.max_tokens for prompt in prompts)
+    with instrumentation.span('prompt_openai_batch', {'batch.size': len(text_queries), 'openai.max_tokens': max_tokens}):
+        response = await dispatcher.call(openai.Completion.acreate, prompt=[prompt.text for prompt in prompts],
+                                         stop=translation.STOP,
+                                         **translation.completion_params(completion_params, max_tokens))
+        instrumentation.record_openai_usage(response)
+        prompt_builder.record_completion(response, max_tokens)
+    answers = [None] * len(text_queries)
+    for choice in response['choices']:
+        answers[choice['index']] = translation.to_sql_query(choice['text'])
+    return answers
+
+
+async def generate_sql_queries(prompt_schema, text_queries, dispatcher=None, batch_size=GENERATE_BATCH_SIZE,
+                               mode=GENERATE_BATCH_MODE, **completion_params):
+    """
+    SQL for every question, in the same order. The questions are split into batches
+    which are generated concurrently. Questions which could not be translated have the
+    exception instead. `completion_params` select the model, e.g. `engine` or `model`.
+    """
+    dispatcher = dispatcher or Dispatcher()
+    batch_size = max(1, batch_size)
+    batches = [text_queries[i:i + batch_size] for i in range(0, len(text_queries), batch_size)]
+
+    async def generate(batch):
+        if len(batch) == 1:
+            return [await _generate_single(dispatcher, prompt_schema, batch[0], completion_params)]
+        if mode == 'list':
+            return await _generate_list(dispatcher, prompt_schema, batch, completion_params)
+        return await _generate_combined(dispatcher, prompt_schema, batch, completion_params)
+
+    sql_queries = []
+    for batch, result in zip(batches, await asyncio.gather(*(generate(b) for b in batches), return_exceptions=True)):
+        sql_queries.extend([result] * len(batch) if isinstance(result, Exception) else result)
+    return sql_queries
@@ -0,0 +1,345 @@
+"""
+Parallel export of large results, split into ranges of a key which the query filters on.
+
+Fetching rows and encoding them in Python is the bottleneck of large exports, not
+Postgres. Plain scans (no aggregates, DISTINCT, LIMIT etc.) which filter on one of
+`PARTITION_KEYS`, e.g. `sales_orders.order_datetime`, and are estimated to return at
+least `PARALLEL_EXPORT_MIN_ROWS` rows, are split into ranges of the key with the same
+number of rows, when an index starts with the key. The ranges are exported by a pool of
+worker processes, each on its own pooled connection and counted as a query by
+admission control, and all partitions read the snapshot of the coordinating
+transaction, so the result is the same as that of the query on one connection.
+
+CSV parts are staged as blocks of one blob and committed in order, so the result is a
+single file in the order of the query, which may only be ordered by the key. Gzip
+streams of the parts are concatenated. Parquet and Arrow parts are written to blobs of
+their own, `<name>.part-00000.parquet` etc., listed with their SAS URLs in a JSON
+manifest.
+"""
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent import futures
+from multiprocessing import get_context
+
+import sqlparse
+from sqlparse import sql as sql_tokens
+from sqlparse import tokens as T
+from shared_code import admission, blob_storage, db_pool, instrumentation, query_guard, result_formats, result_stream
+
+# Default number of partitions of an export, 0 or 1 disables parallel exports
+PARALLEL_EXPORT_PARTITIONS = int(os.environ.get('PARALLEL_EXPORT_PARTITIONS', 0))
+PARALLEL_EXPORT_WORKERS = int(os.environ.get('PARALLEL_EXPORT_WORKERS', os.cpu_count() or 1))
+# `process` or `thread`, threads only help when encoding is cheap compared to fetching
+PARALLEL_EXPORT_EXECUTOR = os.environ.get('PARALLEL_EXPORT_EXECUTOR', 'process')
+PARALLEL_EXPORT_MIN_ROWS = int(os.environ.get('PARALLEL_EXPORT_MIN_ROWS', 50000))
+# `combined` or `manifest`, Parquet and Arrow results always have a manifest
+PARALLEL_EXPORT_OUTPUT = os.environ.get('PARALLEL_EXPORT_OUTPUT', 'combined')
+
+# Keys queries are split on, in order of preference
+PARTITION_KEYS = [('sales_orders', 'order_datetime'), ('sales_orders', 'order_number'),
+                  ('sales_orders', 'order_line_item_no')]
+UNSUPPORTED_KEYWORDS = {'group by', 'having', 'distinct', 'union', 'union all', 'intersect', 'except', 'with',
+                        'over', 'window', 'limit', 'offset', 'fetch', 'for'}
+AGGREGATES = {'count', 'sum', 'avg', 'min', 'max', 'array_agg', 'string_agg', 'json_agg', 'jsonb_agg', 'bool_and',
+              'bool_or', 'every', 'stddev', 'variance', 'percentile_cont', 'percentile_disc', 'mode'}
+MANIFEST_CONTENT_TYPE = 'application/json'
+# Whether an index starts with the key, without one the bounds would take a sort of the rows
+KEY_INDEX_QUERY = ("Select exists (select 1 from pg_index i join pg_attribute a on a.attrelid = i.indrelid "
+                   "and a.attnum = i.indkey[0] where i.indrelid = to_regclass(%s) and a.attname = %s);")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Partitioning:
+    """
+    Queries of the ranges of the partition key, and the snapshot they read.
+    """
+    def __init__(self, queries, snapshot, rows):
+        self.queries = queries
+        self.snapshot = snapshot
+        self.rows = rows
+
+
+def _values(statement):
+    return [' '.join(t.normalized.lower().split()) for t in statement.flatten()
+            if not t.is_whitespace and t.ttype not in T.Comment]
+
+
+def _from_tables(statement):
+    # (table, alias) of the tables of the top level FROM clause
+    tables, in_from = [], False
+    for token in statement.tokens:
+        if token.is_keyword and token.normalized == 'FROM':
+            in_from = True
+        elif isinstance(token, sql_tokens.Where) or token.is_keyword and token.normalized in ('ORDER BY', 'GROUP BY'):
+            in_from = False
+        elif in_from:
+            identifiers = token.get_identifiers() if isinstance(token, sql_tokens.IdentifierList) else [token]
+            for identifier in identifiers:
+                if isinstance(identifier, sql_tokens.Identifier) and identifier.get_real_name():
+                    tables.append((identifier.get_real_name().lower(),
+                                   (identifier.get_alias() or identifier.get_real_name()).lower()))
+    return tables
+
+
+def _references(where, alias, column):
+    # Whether the WHERE clause uses the column, qualified with the alias or not
+    values = _values(where)
+    for i, value in enumerate(values):
+        if value == column and (i < 2 or values[i - 1] != '.' or values[i - 2] == alias):
+            return True
+    return False
+
+
+def _ordered_by(statement, alias, column):
+    # Whether the query is unordered or ordered by the key ascending first
+    values = _values(statement)
+    if 'order by' not in values:
+        return True
+    order = values[values.index('order by') + 1:]
+    key = [alias, '.', column] if order[:3] == [alias, '.', column] else [column]
+    if order[:len(key)] != key:
+        return False
+    # Rows without a key are exported last, like ascending order sorts them
+    return order[len(key):len(key) + 1] in ([], [','], ['asc'], ['asc nulls last'], ['nulls last'])
+
+
+def partition_key(sql_query):
+    """
+    The parsed statement, its WHERE clause, the qualified key and the table and column of
+    the key of a query which can be split into ranges of a key, or None.
+    """
+    statement = sqlparse.parse(query_guard.check_query(sql_query))[0]
+    values = _values(statement)
+    if values.count('select') != 1 or any(v in UNSUPPORTED_KEYWORDS for v in values):
+        return None
+    if any(v in AGGREGATES and i + 1 < len(values) and values[i + 1] == '(' for i, v in enumerate(values)):
+        return None
+    where = next((t for t in statement.tokens if isinstance(t, sql_tokens.Where)), None)
+    if where is None:
+        return None
+    tables = _from_tables(statement)
+    for table, column in PARTITION_KEYS:
+        aliases = [alias for name, alias in tables if name == table]
+        if len(aliases) == 1 and _references(where, aliases[0], column) and _ordered_by(statement, aliases[0], column):
+            return statement, where, f'{aliases[0]}.{column}', (table, column)
+    return None
+
+
+def _with_condition(statement, where, condition):
+    # The query with the condition added to its WHERE clause
+    index = statement.tokens.index(where)
+    where_text = str(where)
+    original = where_text.strip()[len('where'):].strip()
+    trailing = where_text[len(where_text.rstrip()):]
+    return (''.join(str(t) for t in statement.tokens[:index]) + f'where ({original}) and ({condition}){trailing or " "}'
+            + ''.join(str(t) for t in statement.tokens[index + 1:]))
+
+
+def _range_conditions(cursor, key, bounds):
+    # Ranges between the bounds, rows without a key are in the last one, as ORDER BY sorts them last
+    literals = [cursor.mogrify('%s', (bound,)).decode() for bound in bounds]
+    conditions = [f'{key} < {literals[0]}']
+    conditions += [f'{key} >= {low} and {key} < {high}' for low, high in zip(literals, literals[1:])]
+    conditions.append(f'{key} >= {literals[-1]} or {key} is null')
+    return conditions
+
+
+def plan_partitions(conn, sql_query, partitions):
+    """
+    Split the query into at most `partitions` ranges with the same number of rows, in a
+    repeatable read transaction of `conn` whose snapshot is exported for the partitions.
+    None when the query can't be split or is too small to be worth it.
+    """
+    key = partition_key(sql_query)
+    if key is None:
+        return None
+    statement, where, qualified_key, (table, column) = key
+    with conn.cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute(KEY_INDEX_QUERY, (table, column))
+        if not cursor.fetchone()[0]:
+            return None
+        guarded_query = query_guard.guard_query(conn, sql_query)
+        if query_guard.get_limit(guarded_query) != query_guard.QUERY_MAX_ROWS:
+            # Downgraded to fewer rows
+            return None
+        cursor.execute(query_guard.explain_sql(guarded_query))
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        if plan[0]['Plan']['Plan Rows'] < PARALLEL_EXPORT_MIN_ROWS:
+            return None
+        # Bounds with the same number of rows between them, from the rows of the query itself
+        fractions = ', '.join(str(i / partitions) for i in range(1, partitions))
+        from_index = next(i for i, t in enumerate(statement.tokens) if t.is_keyword and t.normalized == 'FROM')
+        from_where = ''.join(str(t) for t in statement.tokens[from_index:statement.tokens.index(where) + 1])
+        cursor.execute(f'Select count(*), percentile_disc(array[{fractions}]::float8[]) within group '
+                       f'(order by {qualified_key}) {from_where}')
+        rows, bounds = cursor.fetchone()
+        # Rows above the limit are left to the serial export, which truncates them
+        if rows < PARALLEL_EXPORT_MIN_ROWS or rows > query_guard.QUERY_MAX_ROWS:
+            return None
+        # Already in the order of the key, which for text depends on the collation
+        bounds = list(dict.fromkeys(b for b in bounds if b is not None))
+        if not bounds:
+            return None
+        cursor.execute('Select pg_export_snapshot()')
+        snapshot = cursor.fetchone()[0]
+        queries = [_with_condition(statement, where, c) for c in _range_conditions(cursor, qualified_key, bounds)]
+    return Partitioning(queries, snapshot, rows)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if PARALLEL_EXPORT_EXECUTOR == 'thread':
+                _executor = futures.ThreadPoolExecutor(max_workers=PARALLEL_EXPORT_WORKERS)
+            else:
+                # Not forked, the worker has threads whose locks a fork could copy while held
+                _executor = futures.ProcessPoolExecutor(max_workers=PARALLEL_EXPORT_WORKERS,
+                                                        mp_context=get_context('spawn'))
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+def export_partition(db_params, snapshot, sql_query, storage_account_name, container_name, file_name,
+                     output_format, partition, combined, preview_rows=0):
+    """
+    Export one partition, as blocks of `file_name` when `combined` or as a blob of its
+    own. Returns the number of rows, bytes, the staged block IDs and a preview of the
+    first `preview_rows` rows, if any. Runs in the workers.
+    """
+    result_format = result_formats.get_output_format(output_format)
+    blob_client = blob_storage.get_blob_service_client(storage_account_name).get_blob_client(container_name, file_name)
+    with instrumentation.span('export_partition', {'partition': partition}) as span:
+        with db_pool.connection(*db_params) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+            with blob_storage.BlockBlobWriter(blob_client, result_format.content_type, commit=not combined) as writer:
+                with result_stream.open_query(conn, sql_query) as (description, batches):
+                    preview = {}
+                    if preview_rows > 0:
+                        batches = result_stream.take_preview(description, batches, preview_rows, preview)
+                    result_formats.write_results(result_format, writer, description, _count_rows(batches, span),
+                                                 header=partition == 0 or not combined)
+                rows = span.attributes.get('db.rows', 0)
+                writer.metadata['rows'] = str(rows)
+        return rows, writer.bytes_written, writer.block_ids, preview or None
+
+
+def _count_rows(batches, span):
+    # The rows of all partitions are counted once in the metrics, by the coordinator
+    rows = 0
+    for batch in batches:
+        rows += len(batch)
+        span.set_attribute('db.rows', rows)
+        yield batch
+
+
+def part_name(file_name, partition):
+    base, _, extension = file_name.partition('.')
+    return f'{base}.part-{partition:05d}.{extension}'
+
+
+def unique_name(file_name):
+    base, _, extension = file_name.partition('.')
+    return f'{base}-{uuid.uuid4().hex[:8]}.{extension}'
+
+
+def manifest_name(file_name):
+    return f"{file_name.partition('.')[0]}.manifest.json"
+
+
+def export_query_to_blob(host, port, database, user, password, sql_query, storage_account_name, container_name,
+                         file_name, output_format=None, partitions=None, priority=admission.NORMAL,
+                         preview_rows=0):
+    """
+    `result_stream.export_query_to_blob` which exports large results of queries on a
+    range key in `partitions` parallel parts. Results with parts, in manifest mode, have
+    the SAS URL of the manifest and the SAS URLs of the parts. The export is only run
+    once admitted with the given priority, with a slot for every connection it uses.
+    The preview is taken from the first partition, the start of the results.
+    """
+    partitions = PARALLEL_EXPORT_PARTITIONS if partitions is None else partitions
+    max_slots = admission.max_slots(priority)
+    if max_slots is not None:
+        # The coordinating connection and the partitions, within the slots the priority can use
+        partitions = min(partitions, max_slots - 1)
+    if partitions > 1 and partition_key(sql_query) is not None:
+        with admission.admit(host, port, database, user, password, priority, slots=partitions + 1):
+            result = _export_partitioned(host, port, database, user, password, sql_query, storage_account_name,
+                                         container_name, file_name, output_format, partitions, preview_rows)
+        if result is not None:
+            return result
+    with admission.admit(host, port, database, user, password, priority):
+        return result_stream.export_query_to_blob(host, port, database, user, password, sql_query,
+                                                  storage_account_name, container_name, file_name, output_format,
+                                                  preview_rows)
+
+
+def _export_partitioned(host, port, database, user, password, sql_query, storage_account_name, container_name,
+                        file_name, output_format, partitions, preview_rows):
+    result_format = result_formats.get_output_format(output_format)
+    combined = PARALLEL_EXPORT_OUTPUT == 'combined' and result_formats.can_concatenate(result_format)
+    if not combined:
+        # Manifests are not reused by the results cache, so concurrent exports of the same
+        # query get parts and a manifest of their own
+        file_name = unique_name(file_name)
+    db_params = (host, port, database, user, password)
+    with instrumentation.span('export_query_to_blob', {'output_format': result_format.extension}) as span:
+        # The transaction whose snapshot the partitions read stays open until they are done
+        with db_pool.connection(*db_params) as conn:
+            partitioning = plan_partitions(conn, sql_query, partitions)
+            if partitioning is None:
+                span.set_attribute('export.partitions', 1)
+                return None
+            span.set_attribute('export.partitions', len(partitioning.queries))
+            logging.info(f'Exporting {partitioning.rows} rows in {len(partitioning.queries)} partitions')
+            executor = _get_executor()
+            try:
+                parts = list(executor.map(
+                    export_partition, *zip(*[(db_params, partitioning.snapshot, query, storage_account_name,
+                                              container_name, file_name if combined else part_name(file_name, i),
+                                              output_format, i, combined, preview_rows if i == 0 else 0)
+                                             for i, query in enumerate(partitioning.queries)])))
+            except futures.process.BrokenProcessPool:
+                _reset_executor()
+                raise
+
+        rows = sum(part[0] for part in parts)
+        bytes_written = sum(part[1] for part in parts)
+        blob_service_client = blob_storage.get_blob_service_client(storage_account_name)
+        if combined:
+            blob_storage.commit_blocks(blob_service_client.get_blob_client(container_name, file_name),
+                                       [block_id for part in parts for block_id in part[2]],
+                                       result_format.content_type, {'rows': str(rows)})
+            url = blob_storage.get_blob_sas_url(blob_service_client, storage_account_name, container_name, file_name)
+            part_urls = None
+        else:
+            part_urls = [blob_storage.get_blob_sas_url(blob_service_client, storage_account_name, container_name,
+                                                       part_name(file_name, i)) for i in range(len(parts))]
+            # The parts are private like the manifest, so it has their SAS URLs
+            manifest = {'format': result_format.extension, 'rows': rows,
+                        'parts': [{'name': part_name(file_name, i), 'rows': part[0], 'url': part_url}
+                                  for i, (part, part_url) in enumerate(zip(parts, part_urls))]}
+            url = blob_storage.upload_blob(storage_account_name, container_name, manifest_name(file_name),
+                                           json.dumps(manifest).encode(), MANIFEST_CONTENT_TYPE)
+        span.set_attribute('db.rows', rows)
+        span.set_attribute('blob.bytes_uploaded', bytes_written)
+        instrumentation.add('openai_sql.rows', rows)
+        instrumentation.add('openai_sql.bytes_uploaded', bytes_written, unit='By')
+        return result_stream.ExportResult(url, rows, part_urls, parts[0][3])
@@ -0,0 +1,48 @@
+"""
+Priorities of admission control and the deferral of activities rejected as overloaded.
+
+Kept apart from `admission`, without its database dependencies, so the orchestrator
+functions which only pass a priority on and defer overloaded activities stay cheap to
+import when they are replayed.
+"""
+import logging
+import os
+from datetime import timedelta
+
+ADMISSION_RETRY_AFTER = float(os.environ.get('ADMISSION_RETRY_AFTER', 5))  # Seconds
+# Times an orchestrator defers a rejected activity before returning the error
+ADMISSION_MAX_DEFERRALS = int(os.environ.get('ADMISSION_MAX_DEFERRALS', 10))
+
+INTERACTIVE = 'interactive'
+NORMAL = 'normal'
+BATCH = 'batch'
+PRIORITIES = {INTERACTIVE: 2, NORMAL: 1, BATCH: 0}
+
+OVERLOADED = 'overloaded'
+
+
+def is_overloaded(result):
+    return isinstance(result, dict) and isinstance(result.get('error'), dict) and result['error'].get('code') == OVERLOADED
+
+
+def retry_overloaded(context, name, inputs, results):
+    """
+    Calls the activities again whose results are `overloaded` errors, after a durable
+    timer of their retryAfter, at most ADMISSION_MAX_DEFERRALS times. Used from
+    orchestrator functions with `yield from`, returns the results in the order of the
+    inputs.
+    """
+    results = list(results)
+    for _ in range(max(0, ADMISSION_MAX_DEFERRALS)):
+        deferred = [i for i, result in enumerate(results) if is_overloaded(result)]
+        if not deferred:
+            break
+        retry_after = max(results[i]['error'].get('retryAfter') or ADMISSION_RETRY_AFTER for i in deferred)
+        if not context.is_replaying:
+            logging.info(f'{len(deferred)} queries deferred for {retry_after:g} s, the database is overloaded')
+        # Durable timer, the orchastration is unloaded while it waits
+        yield context.create_timer(context.current_utc_datetime + timedelta(seconds=retry_after))
+        retried = yield context.task_all([context.call_activity(name, inputs[i]) for i in deferred])
+        for i, result in zip(deferred, retried):
+            results[i] = result
+    return results
@@ -0,0 +1,272 @@
+"""
+Builds the OpenAI prompt for a question within a token budget, and caps the tokens of
+the completion.
+
+In the `compact` format the lines of `config.prompt` describing a table are rewritten
+as `table(column type, ...)` with the types from the database, abbreviated, and
+`ref table` after columns referencing another table, from the foreign keys or, without
+them, from the key columns of the other tables. The prompt uses newlines instead of
+`\\n` escapes. The `lines` format, the default, sends the lines as they are.
+
+The schema part is limited to `PROMPT_MAX_SCHEMA_TOKENS`, counted with the tokenizer of
+the model. Above it, notes sharing the fewest words with the question are left out
+first, then the tables matching it least.
+
+`max_tokens` of a completion is derived from the length of recent answers, which keeps
+the quota reserved for it by Azure OpenAI close to what is used. A completion cut off
+by the adaptive limit is generated again with `OPENAI_MAX_TOKENS`.
+"""
+import logging
+import os
+import re
+import threading
+from collections import deque, namedtuple
+
+from shared_code import instrumentation, prompt_cache, schema_index, tokenizer
+
+# `lines` or `compact`, which is larger than the lines of the sample schema, so only
+# worth it when `benchmarks.run --prompt-format` shows it is smaller for the schema
+PROMPT_FORMAT = os.environ.get('PROMPT_FORMAT', 'lines')
+PROMPT_MAX_SCHEMA_TOKENS = schema_index.PROMPT_MAX_SCHEMA_TOKENS
+OPENAI_MIN_TOKENS = int(os.environ.get('OPENAI_MIN_TOKENS', 64))
+OPENAI_MAX_TOKENS = int(os.environ.get('OPENAI_MAX_TOKENS', 300))
+# Context window of the model, shared by the prompt and the completion
+OPENAI_CONTEXT_TOKENS = int(os.environ.get('OPENAI_CONTEXT_TOKENS', 8001))
+
+# max_tokens until enough answers have been seen
+DEFAULT_MAX_TOKENS = 150
+COMPLETION_SAMPLES = 200
+COMPLETION_MIN_SAMPLES = 20
+COMPLETION_HEADROOM = 1.5
+
+NEWLINE = '\n' if PROMPT_FORMAT == 'compact' else '\\n'
+
+# Types are only hints for the model, so similar types share a short name
+TYPE_ABBREVIATIONS = {
+    'smallint': 'int',
+    'integer': 'int',
+    'bigint': 'int',
+    'numeric': 'num',
+    'real': 'float',
+    'double precision': 'float',
+    'character varying': 'text',
+    'character': 'text',
+    'timestamp without time zone': 'timestamp',
+    'timestamp with time zone': 'timestamptz',
+    'time without time zone': 'time',
+    'time with time zone': 'timetz',
+    'boolean': 'bool',
+}
+
+Prompt = namedtuple('Prompt', ['text', 'tokens', 'max_tokens'])
+SchemaLine = namedtuple('SchemaLine', ['text', 'tokens', 'table'])
+
+
+def abbreviate_type(type_name):
+    # "character varying(50)" -> "text", "numeric(10,2)[]" -> "num[]"
+    array = type_name.endswith('[]')
+    base = ' '.join(re.sub(r'\(.*?\)', '', type_name[:-2] if array else type_name).split())
+    return TYPE_ABBREVIATIONS.get(base, base) + ('[]' if array else '')
+
+
+def _key_tables(catalog, tables):
+    # Tables by the name of their key column, used to hint joins when there are no foreign keys
+    key_tables = {}
+    for name, columns in tables.items():
+        table = catalog.get(name)
+        keys = table.keys if table and len(table.keys) == 1 else columns[:1]
+        for key in keys:
+            if schema_index.JOIN_COLUMN.match(key):
+                key_tables.setdefault(key, name)
+    return key_tables
+
+
+def compact_line(match, catalog, key_tables):
+    """
+    `table(column type ref table, ...)` for a line describing a table.
+    """
+    name = match.group(1).lower()
+    table = catalog.get(name)
+    columns = []
+    for entry in match.group(2).split(','):
+        words = entry.split()
+        if not words:
+            continue
+        column = words[0].lower()
+        # Types already written in the line are kept when the database doesn't have the column
+        type_name = table.types.get(column) if table else None
+        parts = [words[0], abbreviate_type(type_name) if type_name else ' '.join(words[1:])]
+        reference = (table.references.get(column) if table and table.references else None) or key_tables.get(column)
+        if reference and reference != name:
+            parts.append(f'ref {reference}')
+        columns.append(' '.join(part for part in parts if part))
+    return f"{match.group(1)}({', '.join(columns)})"
+
+
+def _schema_line(text, table=None):
+    return SchemaLine(text, tokenizer.count_tokens(f'# {text}{NEWLINE}'), table)
+
+
+def build_schema_lines(prompt_schema):
+    """
+    {line of config.prompt: SchemaLine} in the prompt format, with its tokens.
+    """
+    lines = [line or '' for line in prompt_schema.lines]
+    matches = {line: prompt_cache.TABLE_LINE.match(line) for line in lines}
+    if PROMPT_FORMAT != 'compact':
+        return {line: _schema_line(line, match and match.group(1).lower()) for line, match in matches.items()}
+    catalog = prompt_schema.catalog or {}
+    tables = {m.group(1).lower(): [c.split()[0].lower() for c in m.group(2).split(',') if c.strip()]
+              for m in matches.values() if m}
+    key_tables = _key_tables(catalog, tables)
+    schema_lines = {}
+    for line, match in matches.items():
+        if match:
+            schema_lines[line] = _schema_line(compact_line(match, catalog, key_tables), match.group(1).lower())
+        else:
+            schema_lines[line] = _schema_line(' '.join(line.split()))
+    return schema_lines
+
+
+_schema_lines = {}
+_schema_lines_lock = threading.Lock()
+
+
+def get_schema_lines(prompt_schema):
+    with _schema_lines_lock:
+        schema_lines = _schema_lines.get(prompt_schema.version)
+        if schema_lines is None:
+            # Only the lines of the current schema versions are kept
+            if len(_schema_lines) > 8:
+                _schema_lines.clear()
+            schema_lines = _schema_lines[prompt_schema.version] = build_schema_lines(prompt_schema)
+    return schema_lines
+
+
+def fit_budget(prompt_schema, lines, text_query, max_tokens=PROMPT_MAX_SCHEMA_TOKENS):
+    """
+    The lines without the least relevant ones above `max_tokens`, in the same order.
+    At least one table is kept.
+    """
+    schema_lines = get_schema_lines(prompt_schema)
+    tokens = sum(schema_lines[line].tokens for line in lines)
+    if tokens <= max_tokens:
+        return lines
+    index = schema_index.get_index(prompt_schema)
+    table_scores = dict(index.score_tables(text_query))
+    terms = set(schema_index.tokenize(text_query))
+
+    def priority(position):
+        line = lines[position]
+        table = schema_lines[line].table
+        if table is not None:
+            return (1, table_scores.get(table, 0), -position)
+        owners = [t.name for t in index.tables.values() if line in t.notes]
+        return (0, len(terms.intersection(schema_index.tokenize(line))),
+                max((table_scores.get(t, 0) for t in owners), default=0), -position)
+
+    dropped = set()
+    tables = sum(1 for line in lines if schema_lines[line].table is not None)
+    for position in sorted(range(len(lines)), key=priority):
+        if tokens <= max_tokens:
+            break
+        if schema_lines[lines[position]].table is not None:
+            if tables == 1:
+                continue
+            tables -= 1
+        dropped.add(position)
+        tokens -= schema_lines[lines[position]].tokens
+    instrumentation.set_attribute('prompt.dropped_lines', len(dropped))
+    return [line for position, line in enumerate(lines) if position not in dropped]
+
+
+def get_schema_text(prompt_schema, text_query, max_tokens=PROMPT_MAX_SCHEMA_TOKENS):
+    """
+    Schema block of the prompt for the question, pruned to the relevant tables of large
+    schemas and limited to `max_tokens`.
+    """
+    lines = fit_budget(prompt_schema, [line or '' for line in schema_index.get_schema_lines(prompt_schema, text_query)],
+                       text_query, max_tokens)
+    if PROMPT_FORMAT != 'compact':
+        return prompt_cache.get_schema_text(lines)
+    schema_lines = get_schema_lines(prompt_schema)
+    return (f'### Postgres SQL tables, with their properties:{NEWLINE}#{NEWLINE}'
+            + ''.join(f'# {schema_lines[line].text}{NEWLINE}' for line in lines) + f'#{NEWLINE}')
+
+
+def get_prompt_text(schema_text, text_query):
+    return schema_text + '### A query to ' + text_query + NEWLINE + 'SELECT'
+
+
+_completion_tokens = deque(maxlen=COMPLETION_SAMPLES)
+_completion_lock = threading.Lock()
+
+
+def max_completion_tokens(prompt_tokens, count=1):
+    """
+    max_tokens for `count` answers, 1.5 times the 95th percentile of the tokens of recent
+    answers, within OPENAI_MIN_TOKENS and OPENAI_MAX_TOKENS per answer and the context
+    window left by the prompt.
+    """
+    with _completion_lock:
+        samples = sorted(_completion_tokens)
+    if len(samples) < COMPLETION_MIN_SAMPLES:
+        limit = DEFAULT_MAX_TOKENS
+    else:
+        limit = int(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * COMPLETION_HEADROOM) + 1
+    limit = min(max(limit, OPENAI_MIN_TOKENS), OPENAI_MAX_TOKENS) * count
+    return max(1, min(limit, OPENAI_CONTEXT_TOKENS - prompt_tokens))
+
+
+def record_completion(response, max_tokens, count=1):
+    """
+    Records the tokens of the answers of a completion, for `max_completion_tokens`.
+    Answers cut off by max_tokens are recorded at the limit, so it grows.
+    """
+    samples = []
+    for choice in response['choices']:
+        if choice.get('finish_reason') == 'length':
+            samples.append(max_tokens / count)
+        else:
+            samples.append(tokenizer.count_tokens(choice['text']) / count)
+    with _completion_lock:
+        _completion_tokens.extend(samples)
+
+
+def retry_max_tokens(prompt, response):
+    """
+    Larger max_tokens to generate a completion again with when it was cut off by the
+    adaptive limit, None otherwise.
+    """
+    if not any(choice.get('finish_reason') == 'length' for choice in response['choices']):
+        return None
+    max_tokens = min(OPENAI_MAX_TOKENS, OPENAI_CONTEXT_TOKENS - prompt.tokens)
+    if max_tokens <= prompt.max_tokens:
+        return None
+    logging.info(f'Completion cut off at {prompt.max_tokens} tokens, generating again with {max_tokens}')
+    instrumentation.add('openai_sql.openai.truncated', 1)
+    return max_tokens
+
+
+def build_prompt(prompt_schema, text_query):
+    """
+    Prompt for the question, with its tokens and the max_tokens of the completion.
+    """
+    with instrumentation.span('build_prompt') as span:
+        prompt_text = get_prompt_text(get_schema_text(prompt_schema, text_query), text_query)
+        return _prompt(prompt_text, span)
+
+
+def build_batch_prompt(prompt_text, count):
+    # Tokens and max_tokens of a prompt with `count` numbered questions
+    with instrumentation.span('build_prompt', {'batch.size': count}) as span:
+        return _prompt(prompt_text, span, count)
+
+
+def _prompt(prompt_text, span, count=1):
+    tokens = tokenizer.count_tokens(prompt_text)
+    prompt = Prompt(prompt_text, tokens, max_completion_tokens(tokens, count))
+    span.set_attribute('prompt.tokens', prompt.tokens)
+    span.set_attribute('prompt.max_tokens', prompt.max_tokens)
+    instrumentation.record('openai_sql.prompt.tokens', prompt.tokens)
+    return prompt
@@ -0,0 +1,169 @@
+"""
+In-process cache of the schema part of the OpenAI prompt, built from `config.prompt`.
+
+The rendered schema block is kept per database and reused until the TTL expires. On
+expiry a cheap fingerprint of the table is compared with the cached version and the
+lines are only reloaded when it changed. When `PROMPT_CACHE_NOTIFY_CHANNEL` is set, a
+LISTEN connection is also kept open so that a NOTIFY sent by a trigger on
+`config.prompt` invalidates the cache immediately. A listener which can't connect is
+retried after `PROMPT_CACHE_LISTEN_RETRY` seconds, the cached schema is served meanwhile.
+
+The column types and keys of the tables described by the lines are loaded with them,
+for the compact schema of `prompt_builder`.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import psycopg2
+from psycopg2 import sql
+from shared_code import db_pool, instrumentation
+
+PROMPT_CACHE_TTL = float(os.environ.get('PROMPT_CACHE_TTL', 300))
+PROMPT_CACHE_NOTIFY_CHANNEL = os.environ.get('PROMPT_CACHE_NOTIFY_CHANNEL', '')
+PROMPT_CACHE_LISTEN_RETRY = float(os.environ.get('PROMPT_CACHE_LISTEN_RETRY', 30))  # Seconds
+
+PROMPT_LINES_QUERY = "Select line from config.prompt where include is true order by id;"
+PROMPT_VERSION_QUERY = ("Select md5(coalesce(string_agg(id::text || ':' || coalesce(line, ''), "
+                        "E'\\n' order by id), '')) from config.prompt where include is true;")
+
+# Column types, primary keys and foreign keys of the tables named in the lines
+CATALOG_QUERY = """
+Select u.name, a.attname, format_type(a.atttypid, a.atttypmod),
+       exists (select from pg_constraint k where k.conrelid = c.oid and k.contype = 'p' and k.conkey = array[a.attnum]),
+       (select case when fn.nspname = current_schema() then fc.relname else fn.nspname || '.' || fc.relname end
+          from pg_constraint k join pg_class fc on fc.oid = k.confrelid join pg_namespace fn on fn.oid = fc.relnamespace
+         where k.conrelid = c.oid and k.contype = 'f' and k.conkey = array[a.attnum] limit 1)
+  from unnest({}::text[], {}::text[], {}::text[]) as u(name, schema_name, table_name)
+  join pg_namespace n on n.nspname = coalesce(u.schema_name, current_schema())
+  join pg_class c on c.relnamespace = n.oid and c.relname = u.table_name
+  join pg_attribute a on a.attrelid = c.oid and a.attnum > 0 and not a.attisdropped
+ order by u.name, a.attnum;"""
+
+# Lines describing a table, `table_name(column, column, ...)`
+TABLE_LINE = re.compile(r'^\s*([\w.]+)\s*\((.*)\)\s*$')
+
+PromptSchema = namedtuple('PromptSchema', ['lines', 'text', 'version', 'catalog'], defaults=[None])
+TableCatalog = namedtuple('TableCatalog', ['types', 'keys', 'references'])
+
+
+def get_schema_text(prompt_lines):
+    schema_text = ''
+    for pl in prompt_lines:
+        schema_text += f'# {pl}\\n'
+    return '### Postgres SQL tables, with their properties:\\n#\\n' + schema_text + '#\\n'
+
+
+def catalog_params(prompt_lines):
+    # Names, schemas and table names of the tables described by the lines, for CATALOG_QUERY
+    names = list(dict.fromkeys(m.group(1).lower() for m in (TABLE_LINE.match(line or '') for line in prompt_lines) if m))
+    schemas, tables = zip(*[name.rpartition('.')[::2] for name in names]) if names else ((), ())
+    return names, [schema or None for schema in schemas], list(tables)
+
+
+def to_catalog(rows):
+    # {table name: TableCatalog} from the rows of CATALOG_QUERY
+    catalog = {}
+    for name, column, type_name, is_key, references in rows:
+        table = catalog.setdefault(name, TableCatalog({}, set(), {}))
+        table.types[column] = type_name
+        if is_key:
+            table.keys.add(column)
+        if references:
+            table.references[column] = references
+    return catalog
+
+
+class PromptSchemaCache:
+    def __init__(self, host, port, database, user, password,
+                 ttl=PROMPT_CACHE_TTL, notify_channel=PROMPT_CACHE_NOTIFY_CHANNEL):
+        self.conn_params = (host, port, database, user, password)
+        self.ttl = ttl
+        self.notify_channel = notify_channel
+        self._schema = None
+        self._expires_at = 0
+        self._listener = None
+        # Monotonic time of the last failure of the listener
+        self._listen_failed_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        # The lock is held while refreshing so concurrent requests wait for a single reload
+        with self._lock:
+            self._check_notifications()
+            if self._schema is None or time.monotonic() >= self._expires_at:
+                self._refresh()
+            return self._schema
+
+    def invalidate(self):
+        with self._lock:
+            self._schema = None
+
+    def _refresh(self):
+        with db_pool.connection(*self.conn_params) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(PROMPT_VERSION_QUERY)
+                version = cursor.fetchone()[0]
+                if self._schema is None or self._schema.version != version:
+                    logging.info(f'Loading prompt schema version {version}')
+                    cursor.execute(PROMPT_LINES_QUERY)
+                    lines = [row[0] for row in cursor.fetchall()]
+                    cursor.execute(CATALOG_QUERY.format('%s', '%s', '%s'), catalog_params(lines))
+                    self._schema = PromptSchema(lines, get_schema_text(lines), version, to_catalog(cursor.fetchall()))
+        self._expires_at = time.monotonic() + self.ttl
+
+    def _listen(self):
+        conn = psycopg2.connect(db_pool.get_pool(*self.conn_params).dsn)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.notify_channel)))
+        return conn
+
+    def _check_notifications(self):
+        if not self.notify_channel:
+            return
+        try:
+            if self._listener is None or self._listener.closed:
+                # Requests don't wait for a connect timeout each while the database is unreachable
+                if (self._listen_failed_at is not None
+                        and time.monotonic() - self._listen_failed_at < PROMPT_CACHE_LISTEN_RETRY):
+                    return
+                # Changes may have been missed while not listening
+                self._listener = self._listen()
+                self._listen_failed_at = None
+                self._schema = None
+                return
+            self._listener.poll()
+            if self._listener.notifies:
+                self._listener.notifies.clear()
+                self._schema = None
+        except psycopg2.Error as e:
+            # Fall back to TTL based invalidation until the listener can be re-established
+            logging.exception(e)
+            if self._listener is not None:
+                self._listener.close()
+            self._listener = None
+            self._listen_failed_at = time.monotonic()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_prompt_cache(host, port, database, user, password):
+    dsn = db_pool.get_pool(host, port, database, user, password).dsn
+    with _caches_lock:
+        cache = _caches.get(dsn)
+        if cache is None:
+            cache = _caches[dsn] = PromptSchemaCache(host, port, database, user, password)
+    return cache
+
+
+def get_prompt_schema(host, port, database, user, password):
+    with instrumentation.span('get_prompt_schema') as span:
+        prompt_schema = get_prompt_cache(host, port, database, user, password).get()
+        span.set_attribute('prompt.version', prompt_schema.version)
+        return prompt_schema
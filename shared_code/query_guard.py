@@ -0,0 +1,190 @@
+"""
+Guards the execution of SQL generated by OpenAI, which can't be trusted to be cheap or
+harmless.
+
+Before a query is executed it is parsed with sqlparse and anything but a single SELECT
+statement is rejected, a row limit is injected and the transaction is made read-only
+with a `statement_timeout`. The planner cost from `EXPLAIN` is then checked: queries
+above `QUERY_MAX_COST` are downgraded to `QUERY_DOWNGRADED_MAX_ROWS` rows, or rejected
+when that doesn't bring the cost down either. Errors are returned as a structured
+`{'error': {...}}` result instead of the message of the exception.
+"""
+import json
+import logging
+import os
+
+import sqlparse
+from shared_code import instrumentation
+from sqlparse import sql as sql_tokens
+from sqlparse import tokens as T
+
+QUERY_MAX_ROWS = int(os.environ.get('QUERY_MAX_ROWS', 100000))
+QUERY_STATEMENT_TIMEOUT = int(os.environ.get('QUERY_STATEMENT_TIMEOUT', 60000))  # Milliseconds
+QUERY_MAX_COST = float(os.environ.get('QUERY_MAX_COST', 1000000))
+# What to do with queries above QUERY_MAX_COST, `downgrade` or `reject`
+QUERY_COST_ACTION = os.environ.get('QUERY_COST_ACTION', 'downgrade')
+QUERY_DOWNGRADED_MAX_ROWS = int(os.environ.get('QUERY_DOWNGRADED_MAX_ROWS', 1000))
+
+# SET LOCAL only lasts until the end of the transaction, so pooled connections are not affected
+SESSION_SETTINGS = ['SET LOCAL transaction_read_only = on',
+                    f'SET LOCAL statement_timeout = {QUERY_STATEMENT_TIMEOUT}']
+
+QUERY_CANCELED = '57014'
+
+
+class QueryRejected(Exception):
+    def __init__(self, code, message, sql_query=None, details=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.sql_query = sql_query
+        self.details = details or {}
+
+    def to_dict(self):
+        return {'error': {'code': self.code, 'message': self.message, 'sqlQuery': self.sql_query, **self.details}}
+
+
+def error_result(e, sql_query=None):
+    """
+    Structured error for an exception raised while guarding or executing a query.
+    """
+    if isinstance(e, QueryRejected):
+        result = e.to_dict()
+        result['error']['sqlQuery'] = result['error']['sqlQuery'] or sql_query
+        return result
+    # psycopg2 errors have a pgcode, asyncpg errors a sqlstate
+    sqlstate = getattr(e, 'pgcode', None) or getattr(e, 'sqlstate', None)
+    if sqlstate == QUERY_CANCELED:
+        error = {'code': 'statement_timeout',
+                 'message': f'Query was canceled after {QUERY_STATEMENT_TIMEOUT} ms'}
+    elif sqlstate:
+        error = {'code': 'query_failed', 'message': str(e).strip(), 'sqlState': sqlstate}
+    else:
+        error = {'code': 'internal_error', 'message': str(e)}
+    error['sqlQuery'] = sql_query
+    return {'error': error}
+
+
+def is_error_result(result):
+    return isinstance(result, dict) and 'error' in result
+
+
+def check_query(sql_query):
+    """
+    Return the single SELECT statement of the query without comments and the trailing
+    semicolon, or raise QueryRejected.
+    """
+    statements = [s for s in sqlparse.parse(sqlparse.format(sql_query or '', strip_comments=True))
+                  if str(s).strip(' \t\r\n;')]
+    if len(statements) != 1:
+        raise QueryRejected('invalid_query', f'Expected a single SQL statement, got {len(statements)}', sql_query)
+    statement = statements[0]
+    if statement.get_type() != 'SELECT':
+        raise QueryRejected('not_select', f'Only SELECT queries are allowed, got {statement.get_type()}', sql_query)
+    # Data modifying statements can also hide in CTEs
+    for token in statement.flatten():
+        if token.ttype in (T.DML, T.DDL) and token.normalized != 'SELECT':
+            raise QueryRejected('not_select', f'Only SELECT queries are allowed, found {token.normalized}', sql_query)
+    return str(statement).strip().rstrip(';').strip()
+
+
+def _top_level_limit(statement):
+    # Index of the number token of the top level LIMIT clause, None if there is no LIMIT,
+    # -1 if the limit is not a plain number (LIMIT ALL, expressions or FETCH FIRST)
+    tokens = statement.tokens
+    for i, token in enumerate(tokens):
+        if token.ttype is T.Keyword and token.normalized == 'FETCH':
+            return -1
+        if token.ttype is T.Keyword and token.normalized == 'LIMIT':
+            _, value = statement.token_next(i)
+            if value is not None and value.ttype is T.Literal.Number.Integer:
+                return tokens.index(value)
+            return -1
+    return None
+
+
+def get_limit(sql_query):
+    statement = sqlparse.parse(sql_query)[0]
+    index = _top_level_limit(statement)
+    if index is None or index < 0:
+        return None
+    return int(statement.tokens[index].value)
+
+
+def apply_limit(sql_query, max_rows):
+    """
+    Limit the query to `max_rows` rows, keeping a lower limit of the query itself.
+    """
+    statement = sqlparse.parse(sql_query)[0]
+    index = _top_level_limit(statement)
+    if index is None:
+        return f'{sql_query} limit {max_rows}'
+    if index < 0:
+        return f'select * from ({sql_query}) as guarded_query limit {max_rows}'
+    if int(statement.tokens[index].value) <= max_rows:
+        return sql_query
+    statement.tokens[index] = sql_tokens.Token(T.Literal.Number.Integer, str(max_rows))
+    return ''.join(str(token) for token in statement.tokens)
+
+
+def prepare_query(sql_query, max_rows=QUERY_MAX_ROWS):
+    return apply_limit(check_query(sql_query), max_rows)
+
+
+def explain_sql(sql_query):
+    return f'EXPLAIN (FORMAT JSON) {sql_query}'
+
+
+def plan_cost(plan):
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Total Cost']
+
+
+def downgrade(sql_query, cost):
+    """
+    Return a cheaper version of a query whose cost is above QUERY_MAX_COST, or raise
+    QueryRejected when there is none.
+    """
+    limit = get_limit(sql_query)
+    if QUERY_COST_ACTION == 'downgrade' and (limit is None or limit > QUERY_DOWNGRADED_MAX_ROWS):
+        return apply_limit(sql_query, QUERY_DOWNGRADED_MAX_ROWS)
+    raise QueryRejected('query_too_expensive',
+                        f'Estimated query cost {cost:.0f} is above the maximum of {QUERY_MAX_COST:.0f}',
+                        sql_query, {'cost': cost, 'maxCost': QUERY_MAX_COST})
+
+
+def guard_query(conn, sql_query, max_rows=QUERY_MAX_ROWS):
+    """
+    Check the query and prepare the transaction of the psycopg2 connection for it. The
+    query to execute in the same transaction is returned.
+    """
+    guarded_query = prepare_query(sql_query, max_rows)
+    with conn.cursor() as cursor:
+        for setting in SESSION_SETTINGS:
+            cursor.execute(setting)
+        cursor.execute(explain_sql(guarded_query))
+        cost = plan_cost(cursor.fetchone()[0])
+        while cost > QUERY_MAX_COST:
+            guarded_query = downgrade(guarded_query, cost)
+            logging.warning(f'Query cost {cost} above {QUERY_MAX_COST}, downgraded to: {guarded_query}')
+            cursor.execute(explain_sql(guarded_query))
+            cost = plan_cost(cursor.fetchone()[0])
+    instrumentation.set_attribute('db.query_cost', cost)
+    return guarded_query
+
+
+async def guard_query_async(conn, sql_query, max_rows=QUERY_MAX_ROWS):
+    """
+    `guard_query` for an asyncpg connection, which must be in a transaction.
+    """
+    guarded_query = prepare_query(sql_query, max_rows)
+    for setting in SESSION_SETTINGS:
+        await conn.execute(setting)
+    cost = plan_cost(await conn.fetchval(explain_sql(guarded_query)))
+    while cost > QUERY_MAX_COST:
+        guarded_query = downgrade(guarded_query, cost)
+        logging.warning(f'Query cost {cost} above {QUERY_MAX_COST}, downgraded to: {guarded_query}')
+        cost = plan_cost(await conn.fetchval(explain_sql(guarded_query)))
+    instrumentation.set_attribute('db.query_cost', cost)
+    return guarded_query
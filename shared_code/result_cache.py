@@ -0,0 +1,144 @@
+"""
+Cache of query results, reusing the results blob of an earlier execution of the same SQL.
+
+The blob name is derived from a hash of the canonicalized SQL, the output format and a
+data freshness token, so the cache entry is the blob itself and is shared by all
+workers. With `RESULT_CACHE_FRESHNESS` set to `stats` the token includes the row change
+counters of the tables the query reads from `pg_stat_user_tables`, so a write to any of
+them results in a new entry. Either way entries are only reused for `RESULT_CACHE_TTL`
+seconds. On a hit the query is not executed and only a fresh SAS URL is signed.
+
+Concurrent misses of the same query export to the same blob with blocks of their own.
+The first complete export is committed, the commit of the others fails and they return
+it as a hit.
+
+Expired blobs are deleted by the lifecycle management policy of the storage account on
+`RESULT_CACHE_PREFIX`, see `deployment/template.bicep`.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import sqlparse
+from shared_code import admission, blob_storage, db_pool, instrumentation, parallel_export, query_guard, result_formats, result_stream
+from shared_code.lazy_modules import lazy_import
+
+azure_exceptions = lazy_import('azure.core.exceptions')
+
+# Seconds a cached result is served for, 0 disables the cache
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 300))
+# `ttl` or `stats`
+RESULT_CACHE_FRESHNESS = os.environ.get('RESULT_CACHE_FRESHNESS', 'ttl')
+RESULT_CACHE_PREFIX = 'results-cache/'
+
+TABLE_CHANGES_QUERY = ("Select coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) || ':' || "
+                       "coalesce(sum(n_live_tup), 0) from pg_stat_user_tables "
+                       "where (schemaname, relname) in (select * from unnest(%s::text[], %s::text[]));")
+
+
+def canonical_sql(sql_query):
+    # Formatting only, keywords are lower cased and comments and extra whitespace removed
+    sql_query = query_guard.check_query(sql_query)
+    return sqlparse.format(sql_query, keyword_case='lower', strip_comments=True, strip_whitespace=True)
+
+
+def _relations(plan):
+    # Schema and name of the tables scanned by a plan from EXPLAIN (VERBOSE)
+    if 'Relation Name' in plan:
+        yield plan.get('Schema', 'public'), plan['Relation Name']
+    for subplan in plan.get('Plans', ()):
+        yield from _relations(subplan)
+
+
+def table_changes(host, port, database, user, password, sql_query, priority=admission.NORMAL):
+    """
+    Token which changes when rows of the tables the query reads from change, as far as
+    the statistics collector has seen them. Planned once admitted, with the settings of
+    the query guard.
+    """
+    with admission.admit(host, port, database, user, password, priority):
+        with db_pool.connection(host, port, database, user, password) as conn:
+            with conn.cursor() as cursor:
+                for setting in query_guard.SESSION_SETTINGS:
+                    cursor.execute(setting)
+                cursor.execute(f'EXPLAIN (FORMAT JSON, VERBOSE) {sql_query}')
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                relations = sorted(set(_relations(plan[0]['Plan'])))
+                cursor.execute(TABLE_CHANGES_QUERY, ([r[0] for r in relations], [r[1] for r in relations]))
+                return f'{relations}:{cursor.fetchone()[0]}'
+
+
+def get_blob_name(sql_query, result_format, freshness_token=''):
+    key = '\n'.join([sql_query, result_format.extension, str(query_guard.QUERY_MAX_ROWS),
+                     freshness_token])
+    return f'{RESULT_CACHE_PREFIX}{hashlib.sha256(key.encode()).hexdigest()}.{result_format.extension}'
+
+
+def _get_fresh_properties(blob_client):
+    try:
+        properties = blob_client.get_blob_properties()
+    except azure_exceptions.ResourceNotFoundError:
+        return None
+    age = (datetime.now(timezone.utc) - properties.last_modified).total_seconds()
+    return properties if age < RESULT_CACHE_TTL else None
+
+
+def _cached_result(blob_service_client, storage_account_name, container_name, file_name, properties):
+    return result_stream.ExportResult(
+        blob_storage.get_blob_sas_url(blob_service_client, storage_account_name, container_name, file_name),
+        int(properties.metadata.get('rows', 0)))
+
+
+def _count(result):
+    instrumentation.set_attribute('result_cache.result', result)
+    instrumentation.add('openai_sql.cache.lookups', 1, {'cache': 'results', 'result': result})
+
+
+def export_query_to_blob(host, port, database, user, password, sql_query,
+                         storage_account_name, container_name, output_format=None, partitions=None,
+                         priority=admission.NORMAL, preview_rows=0):
+    """
+    `parallel_export.export_query_to_blob` which returns the cached results blob, with a
+    fresh SAS URL, and its number of rows when the same query was exported recently.
+    Results exported in parts with a manifest are not reused. Exports are admitted with
+    the given priority, cache hits don't wait and have no preview.
+    """
+    result_format = result_formats.get_output_format(output_format)
+    if RESULT_CACHE_TTL <= 0:
+        return parallel_export.export_query_to_blob(host, port, database, user, password, sql_query,
+                                                    storage_account_name, container_name,
+                                                    result_formats.new_file_name(output_format), output_format,
+                                                    partitions, priority, preview_rows)
+
+    with instrumentation.span('result_cache'):
+        cache_sql_query = canonical_sql(sql_query)
+        freshness_token = ''
+        if RESULT_CACHE_FRESHNESS == 'stats':
+            freshness_token = table_changes(host, port, database, user, password, cache_sql_query, priority)
+        file_name = get_blob_name(cache_sql_query, result_format, freshness_token)
+        blob_service_client = blob_storage.get_blob_service_client(storage_account_name)
+        blob_client = blob_service_client.get_blob_client(container_name, file_name)
+        properties = _get_fresh_properties(blob_client)
+        if properties is not None:
+            _count('hit')
+            logging.info(f'Result cache hit: {file_name}')
+            return _cached_result(blob_service_client, storage_account_name, container_name, file_name, properties)
+        _count('miss')
+
+    # Expired entries are overwritten, the new blob only replaces them once it is complete
+    try:
+        return parallel_export.export_query_to_blob(host, port, database, user, password, sql_query,
+                                                    storage_account_name, container_name, file_name, output_format,
+                                                    partitions, priority, preview_rows)
+    except azure_exceptions.HttpResponseError as e:
+        # Another export of the same query was committed first and discarded our blocks
+        properties = _get_fresh_properties(blob_client) if e.error_code == 'InvalidBlockList' else None
+        if properties is None:
+            raise
+        _count('concurrent')
+        logging.info(f'Result cache entry committed by a concurrent export: {file_name}')
+        return _cached_result(blob_service_client, storage_account_name, container_name, file_name, properties)
@@ -0,0 +1,200 @@
+"""
+Output formats for query results. Every format has an encoder which writes batches of
+rows incrementally to a file-like sink, so it can be driven by the synchronous
+`result_stream` as well as by the asyncio pipeline.
+
+Parquet and Arrow IPC need pyarrow, which is only imported when one of them is used.
+
+The orchestrators also return a preview of the first rows inline, bounded in rows and
+in bytes since it is part of their custom status and output.
+"""
+import csv
+import gzip
+import io
+import os
+import uuid
+from collections import namedtuple
+
+ResultFormat = namedtuple('ResultFormat', ['extension', 'content_type', 'encoder'])
+# Column description with the same attributes as the psycopg2 cursor description
+Column = namedtuple('Column', ['name', 'type_code'])
+
+DEFAULT_OUTPUT_FORMAT = 'csv'
+
+# Rows of the inline preview when the request has no `previewRows`, larger values are lowered to the maximum
+RESULTS_PREVIEW_ROWS = int(os.environ.get('RESULTS_PREVIEW_ROWS', 20))
+RESULTS_PREVIEW_MAX_ROWS = int(os.environ.get('RESULTS_PREVIEW_MAX_ROWS', 100))
+# Custom status is limited to 16 KB, the preview is kept to half of it next to the SQL query
+MAX_PREVIEW_BYTES = 8 * 1024
+RESULTS_PREVIEW_MAX_BYTES = min(int(os.environ.get('RESULTS_PREVIEW_MAX_BYTES', MAX_PREVIEW_BYTES)), MAX_PREVIEW_BYTES)
+
+# Postgres type OIDs of the columns which are written with a native Arrow type,
+# everything else is written as text. Numerics are written as decimals when their
+# precision is declared and fits, otherwise as text so no digits are lost.
+_ARROW_TYPES = {
+    16: ('bool_', None),
+    20: ('int64', None),
+    21: ('int64', None),
+    23: ('int64', None),
+    700: ('float64', None),
+    701: ('float64', None),
+    1700: ('decimal', None),
+    1082: ('date32', None),
+    1114: ('timestamp', None),
+    1184: ('timestamp_tz', None),
+    25: ('string', None),
+    1042: ('string', None),
+    1043: ('string', None),
+}
+
+
+class CsvEncoder:
+    # Parts of a result after the first are written without `header`
+    def __init__(self, sink, description, header=True):
+        self.sink = sink
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        if header:
+            self._writer.writerow([desc.name for desc in description])
+            self._flush()
+
+    def _flush(self):
+        self.sink.write(self._buffer.getvalue().encode('utf-8'))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def write_batch(self, rows):
+        self._writer.writerows(rows)
+        self._flush()
+
+    def close(self):
+        pass
+
+
+class GzipCsvEncoder(CsvEncoder):
+    def __init__(self, sink, description, header=True):
+        # Gzip streams of the parts of a result can be concatenated
+        self._gzip = gzip.GzipFile(fileobj=sink, mode='wb')
+        super().__init__(self._gzip, description, header)
+
+    def close(self):
+        self._gzip.close()
+
+
+def _arrow_type(pa, type_name):
+    if type_name == 'timestamp':
+        return pa.timestamp('us')
+    if type_name == 'timestamp_tz':
+        return pa.timestamp('us', tz='UTC')
+    return getattr(pa, type_name)()
+
+
+def _decimal(value):
+    # NaN has no decimal representation
+    return None if value.is_nan() else value
+
+
+def _arrow_schema(pa, description):
+    fields, converters = [], []
+    for desc in description:
+        type_name, converter = _ARROW_TYPES.get(desc.type_code, ('string', str))
+        if type_name == 'decimal':
+            # Only the psycopg2 description has the declared precision and scale
+            precision, scale = getattr(desc, 'precision', None), getattr(desc, 'scale', None)
+            if precision and precision <= 38:
+                fields.append(pa.field(desc.name, pa.decimal128(precision, scale or 0)))
+                converters.append(_decimal)
+            else:
+                fields.append(pa.field(desc.name, pa.string()))
+                converters.append(str)
+            continue
+        fields.append(pa.field(desc.name, _arrow_type(pa, type_name)))
+        converters.append(converter)
+    return pa.schema(fields), converters
+
+
+def _arrow_batch(pa, schema, converters, rows):
+    arrays = []
+    for i, (field, converter) in enumerate(zip(schema, converters)):
+        values = [row[i] for row in rows]
+        if converter is not None:
+            values = [None if v is None else converter(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ParquetEncoder:
+    def __init__(self, sink, description):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema, self._converters = _arrow_schema(pa, description)
+        self._writer = pq.ParquetWriter(sink, self._schema, compression='snappy')
+
+    def write_batch(self, rows):
+        self._writer.write_batch(_arrow_batch(self._pa, self._schema, self._converters, rows))
+
+    def close(self):
+        self._writer.close()
+
+
+class ArrowEncoder(ParquetEncoder):
+    def __init__(self, sink, description):
+        import pyarrow as pa
+
+        self._pa = pa
+        self._schema, self._converters = _arrow_schema(pa, description)
+        self._writer = pa.ipc.new_file(sink, self._schema)
+
+
+OUTPUT_FORMATS = {
+    'csv': ResultFormat('csv', 'text/csv', CsvEncoder),
+    'csv.gz': ResultFormat('csv.gz', 'application/gzip', GzipCsvEncoder),
+    'parquet': ResultFormat('parquet', 'application/vnd.apache.parquet', ParquetEncoder),
+    'arrow': ResultFormat('arrow', 'application/vnd.apache.arrow.file', ArrowEncoder),
+}
+
+
+def is_supported(output_format):
+    # Null is the default format, any other value must be the name of a format
+    return output_format is None or isinstance(output_format, str) and output_format.lower() in OUTPUT_FORMATS
+
+
+def preview_rows(value):
+    """
+    Number of preview rows for the `previewRows` of a request, at most
+    RESULTS_PREVIEW_MAX_ROWS, or None when it is not a number of rows.
+    """
+    if value is None:
+        value = RESULTS_PREVIEW_ROWS
+    elif isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        return None
+    return min(value, max(0, RESULTS_PREVIEW_MAX_ROWS))
+
+
+def get_output_format(output_format):
+    result_format = OUTPUT_FORMATS.get((output_format or DEFAULT_OUTPUT_FORMAT).lower())
+    if result_format is None:
+        raise ValueError(f"Unsupported output format '{output_format}', "
+                         f"supported formats are {', '.join(OUTPUT_FORMATS)}")
+    return result_format
+
+
+def new_file_name(output_format):
+    return f"file_{uuid.uuid4()}.{get_output_format(output_format).extension}"
+
+
+def can_concatenate(result_format):
+    # Whether the parts of a result in this format can be joined into one file
+    return issubclass(result_format.encoder, CsvEncoder)
+
+
+def write_results(result_format, sink, description, batches, header=True):
+    # Only the formats which can be concatenated have a header to leave out
+    encoder = result_format.encoder(sink, description) if header else result_format.encoder(sink, description, header=False)
+    for rows in batches:
+        encoder.write_batch(rows)
+    encoder.close()
@@ -0,0 +1,113 @@
+"""
+Streams query results from a server-side cursor to a blob in batches, so peak memory
+is bounded by the batch size rather than by the size of the result set.
+"""
+import json
+import logging
+import os
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+from shared_code import blob_storage, db_pool, instrumentation, query_guard, result_formats
+
+RESULTS_BATCH_SIZE = int(os.environ.get('RESULTS_BATCH_SIZE', 5000))
+
+# `parts` are the SAS URLs of the parts of results exported in parallel with a manifest,
+# `preview` the column names and first rows of the results
+ExportResult = namedtuple('ExportResult', ['url', 'rows', 'parts', 'preview'], defaults=[None, None])
+
+
+def _iter_batches(cursor, rows, batch_size):
+    while rows:
+        yield rows
+        rows = cursor.fetchmany(batch_size)
+
+
+def count_rows(batches, span):
+    # Pass batches through, keeping the row count on the span up to date
+    rows = 0
+    for batch in batches:
+        rows += len(batch)
+        span.set_attribute('db.rows', rows)
+        yield batch
+    instrumentation.add('openai_sql.rows', rows)
+
+
+def _json_value(value):
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+
+def take_preview(description, batches, max_rows, preview, max_bytes=None):
+    """
+    Pass batches through, keeping the column names and the first `max_rows` rows as JSON
+    serializable values in the `preview` dict. Taken from the rows fetched for the export,
+    so the preview is the start of the exported results. Rows stop being taken once their
+    JSON would be larger than `max_bytes`, RESULTS_PREVIEW_MAX_BYTES by default, and the
+    preview is then marked `truncated`.
+    """
+    if max_bytes is None:
+        max_bytes = result_formats.RESULTS_PREVIEW_MAX_BYTES
+    preview['columns'] = [desc[0] for desc in description]
+    preview['rows'] = []
+    size = len(json.dumps(preview['columns']).encode())
+    taking = max_rows > 0
+    for batch in batches:
+        for row in batch if taking else ():
+            if len(preview['rows']) >= max_rows:
+                taking = False
+                break
+            values = [_json_value(value) for value in row]
+            size += len(json.dumps(values).encode()) + 1
+            if size > max_bytes:
+                preview['truncated'] = True
+                taking = False
+                break
+            preview['rows'].append(values)
+        yield batch
+
+
+@contextmanager
+def open_query(conn, sql_query, batch_size=RESULTS_BATCH_SIZE):
+    """
+    Execute the guarded query on a named (server-side) cursor and yield the cursor
+    description and an iterator over lists of at most `batch_size` rows.
+    """
+    sql_query = query_guard.guard_query(conn, sql_query)
+    with conn.cursor(name=f'results_{uuid.uuid4().hex}') as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(sql_query)
+        # Description of a named cursor is only available after the first fetch
+        rows = cursor.fetchmany(batch_size)
+        yield cursor.description, _iter_batches(cursor, rows, batch_size)
+
+
+def export_query_to_blob(host, port, database, user, password, sql_query,
+                         storage_account_name, container_name, file_name, output_format=None, preview_rows=0):
+    """
+    Execute the query and stream the results in the given output format to a block
+    blob, returning the SAS URL of the blob, the number of rows and a preview of the
+    first `preview_rows` rows, if any.
+    """
+    result_format = result_formats.get_output_format(output_format)
+    blob_service_client = blob_storage.get_blob_service_client(storage_account_name)
+    blob_client = blob_service_client.get_blob_client(container_name, file_name)
+    with instrumentation.span('export_query_to_blob', {'output_format': result_format.extension}) as span:
+        with db_pool.connection(host, port, database, user, password) as conn:
+            with blob_storage.BlockBlobWriter(blob_client, result_format.content_type) as writer:
+                with open_query(conn, sql_query) as (description, batches):
+                    preview = {}
+                    if preview_rows > 0:
+                        batches = take_preview(description, batches, preview_rows, preview)
+                    result_formats.write_results(result_format, writer, description, count_rows(batches, span))
+                # Kept with the blob for the results cache
+                rows = span.attributes.get('db.rows', 0)
+                writer.metadata['rows'] = str(rows)
+        span.set_attribute('blob.bytes_uploaded', writer.bytes_written)
+        instrumentation.add('openai_sql.bytes_uploaded', writer.bytes_written, unit='By')
+        logging.info(f'Uploaded {writer.bytes_written} bytes to {file_name}')
+        return ExportResult(
+            blob_storage.get_blob_sas_url(blob_service_client, storage_account_name, container_name, file_name), rows,
+            preview=preview or None)
+
+
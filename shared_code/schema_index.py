@@ -0,0 +1,219 @@
+"""
+Relevance-based pruning of the prompt schema, so the prompt only describes the tables
+a question needs instead of every line of `config.prompt`.
+
+Lines of the form `table(column, column, ...)` describe tables, other lines are notes.
+Notes mentioning a table or column are attached to that table, the rest are always
+included. An inverted index of the table and column name terms, weighted by TF-IDF, is
+built once per prompt schema version. For a question the best matching tables are
+picked, together with the tables needed to join them (inferred from shared `*_id`
+columns), until the schema token budget is used up. No model call is needed.
+"""
+import math
+import os
+import re
+import threading
+from collections import defaultdict, deque
+
+import Levenshtein
+from shared_code import prompt_cache, tokenizer
+
+# Pruning only kicks in for schemas with at least this many tables
+PROMPT_PRUNING_MIN_TABLES = int(os.environ.get('PROMPT_PRUNING_MIN_TABLES', 10))
+PROMPT_MAX_SCHEMA_TOKENS = int(os.environ.get('PROMPT_MAX_SCHEMA_TOKENS', 1500))
+# Tables scoring below this fraction of the best score are left out
+PROMPT_PRUNING_MIN_SCORE_RATIO = 0.4
+
+TABLE_NAME_WEIGHT = 2.0
+COLUMN_NAME_WEIGHT = 1.0
+NOTE_WEIGHT = 0.5
+
+JOIN_COLUMN = re.compile(r'.+_(id|no|key|code)$')
+_STOPWORDS = {'a', 'an', 'and', 'all', 'are', 'by', 'for', 'from', 'get', 'in', 'is', 'list', 'me', 'most',
+              'my', 'of', 'on', 'or', 'show', 'the', 'their', 'to', 'top', 'what', 'which', 'who', 'with'}
+
+
+def _stem(term):
+    if len(term) > 4 and term.endswith('ies'):
+        return term[:-3] + 'y'
+    if len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+        return term[:-1]
+    return term
+
+
+def tokenize(text):
+    # Numbers are left out, they are values in questions rather than names
+    return [_stem(t) for t in re.findall(r'[a-z0-9]+', text.lower()) if t not in _STOPWORDS and not t.isdigit()]
+
+
+def _name_terms(name):
+    # "sales_orders" -> ["sale", "order", "sales_orders"]
+    name = name.lower().split('.')[-1]
+    return tokenize(name.replace('_', ' ')) + [name]
+
+
+class Table:
+    def __init__(self, name, line):
+        self.name = name
+        self.line = line
+        self.columns = []
+        self.notes = []
+
+
+class SchemaIndex:
+    def __init__(self, prompt_lines):
+        self.lines = prompt_lines
+        self.tables = {}
+        self.global_notes = []
+        self._parse(prompt_lines)
+        self.joins = self._infer_joins()
+        self.weights = self._build_index()
+
+    def _parse(self, prompt_lines):
+        notes = []
+        for line in prompt_lines:
+            match = prompt_cache.TABLE_LINE.match(line or '')
+            if match:
+                table = Table(match.group(1).lower(), line)
+                table.columns = [c.split()[0].lower() for c in match.group(2).split(',') if c.strip()]
+                self.tables[table.name] = table
+            else:
+                notes.append(line)
+
+        for note in notes:
+            terms = set(re.findall(r'[a-z0-9_]+', (note or '').lower()))
+            owners = [t for t in self.tables.values()
+                      if t.name in terms or terms.intersection(t.columns)]
+            for table in owners:
+                table.notes.append(note)
+            if not owners:
+                self.global_notes.append(note)
+
+    def _infer_joins(self):
+        tables_by_column = defaultdict(set)
+        for table in self.tables.values():
+            for column in table.columns:
+                if JOIN_COLUMN.match(column):
+                    tables_by_column[column].add(table.name)
+        joins = defaultdict(set)
+        for names in tables_by_column.values():
+            for name in names:
+                joins[name].update(names - {name})
+        return joins
+
+    def _build_index(self):
+        term_weights = defaultdict(dict)  # term -> {table name: weight}
+
+        def add(term, table_name, weight):
+            term_weights[term][table_name] = max(term_weights[term].get(table_name, 0), weight)
+
+        for table in self.tables.values():
+            for term in _name_terms(table.name):
+                add(term, table.name, TABLE_NAME_WEIGHT)
+            for column in table.columns:
+                for term in _name_terms(column):
+                    add(term, table.name, COLUMN_NAME_WEIGHT)
+            for note in table.notes:
+                for term in tokenize(note):
+                    add(term, table.name, NOTE_WEIGHT)
+
+        # Weight terms by inverse document frequency, so common columns matter less
+        table_count = max(len(self.tables), 1)
+        for term, tables in term_weights.items():
+            idf = math.log(1 + table_count / len(tables))
+            for name in tables:
+                tables[name] *= idf
+        return term_weights
+
+    def _match_terms(self, term):
+        if term in self.weights:
+            return [term]
+        # Tolerate typos in longer words
+        if len(term) >= 5:
+            return [t for t in self.weights if abs(len(t) - len(term)) <= 1 and Levenshtein.distance(t, term) <= 1]
+        return []
+
+    def score_tables(self, text_query):
+        scores = defaultdict(float)
+        for term in tokenize(text_query):
+            for matched in self._match_terms(term):
+                for name, weight in self.weights[matched].items():
+                    scores[name] += weight
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def _join_path(self, source, targets):
+        # Shortest path from source to any of the targets in the join graph
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            name = queue.popleft()
+            if name in targets:
+                path = []
+                while name is not None:
+                    path.append(name)
+                    name = previous[name]
+                return path
+            for joined in self.joins.get(name, ()):
+                if joined not in previous:
+                    previous[joined] = name
+                    queue.append(joined)
+        return []
+
+    def _table_lines(self, name):
+        table = self.tables[name]
+        return [table.line] + table.notes
+
+    def select_tables(self, text_query, max_tokens=PROMPT_MAX_SCHEMA_TOKENS):
+        scores = self.score_tables(text_query)
+        if not scores:
+            return None
+        min_score = scores[0][1] * PROMPT_PRUNING_MIN_SCORE_RATIO
+        selected = []
+        budget = max_tokens - sum(tokenizer.count_tokens(n) for n in self.global_notes)
+        for name, score in scores:
+            if score < min_score:
+                break
+            # Add the table together with the tables needed to join it to the ones already selected
+            path = self._join_path(name, set(selected)) if selected else [name]
+            new_tables = [t for t in (path or [name]) if t not in selected]
+            cost = sum(tokenizer.count_tokens(line) for t in new_tables for line in self._table_lines(t))
+            if selected and cost > budget:
+                continue
+            selected.extend(new_tables)
+            budget -= cost
+        return selected
+
+    def get_schema_lines(self, text_query, max_tokens=PROMPT_MAX_SCHEMA_TOKENS):
+        selected = self.select_tables(text_query, max_tokens)
+        if not selected:
+            return self.lines
+        keep = set(self.global_notes)
+        for name in selected:
+            keep.update(self._table_lines(name))
+        # Keep the original order of config.prompt
+        return [line for line in self.lines if line in keep]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(prompt_schema):
+    with _indexes_lock:
+        index = _indexes.get(prompt_schema.version)
+        if index is None:
+            # Only the indexes of the current schema versions are kept
+            if len(_indexes) > 8:
+                _indexes.clear()
+            index = _indexes[prompt_schema.version] = SchemaIndex(prompt_schema.lines)
+    return index
+
+
+def get_schema_lines(prompt_schema, text_query):
+    """
+    Lines of `config.prompt` relevant to the question. Small schemas are used as is.
+    """
+    index = get_index(prompt_schema)
+    if len(index.tables) < PROMPT_PRUNING_MIN_TABLES:
+        return prompt_schema.lines
+    return index.get_schema_lines(text_query)
@@ -0,0 +1,531 @@
+"""
+Aggregate layer of summary tables, so aggregate questions don't scan `sales_orders`.
+
+Every summary table holds the quantity, revenue and number of order lines of
+`sales_orders`, joined to some of the dimension tables and summed per day (order_date)
+and dimension columns. Tables are refreshed incrementally: only the order lines above
+the `order_line_item_no` watermark of the last refresh are summed and appended, and a
+full rebuild runs every `SUMMARY_FULL_REFRESH_INTERVAL` seconds to compact the tables
+and pick up updated or deleted order lines. They are also described in `config.prompt`.
+
+Generated queries which group `sales_orders` joined to the same tables as a summary,
+and only use its dimension columns, sums of its measures or the day, week, month etc.
+of `order_datetime`, are rewritten to read the summary instead. With
+`SUMMARY_REALTIME` the order lines above the watermark are summed on the fly, so
+results are the same as on the base tables between refreshes.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import sqlparse
+from sqlparse import tokens as T
+from shared_code import db_pool, instrumentation, query_guard
+
+SUMMARY_TABLES_ENABLED = os.environ.get('SUMMARY_TABLES_ENABLED', 'false').lower() == 'true'
+# Sum the order lines above the watermark on the fly, so rewritten queries don't return stale results
+SUMMARY_REALTIME = os.environ.get('SUMMARY_REALTIME', 'true').lower() == 'true'
+SUMMARY_FULL_REFRESH_INTERVAL = float(os.environ.get('SUMMARY_FULL_REFRESH_INTERVAL', 86400))
+SUMMARY_CATALOG_TTL = float(os.environ.get('SUMMARY_CATALOG_TTL', 300))
+SUMMARY_SCHEMA = 'summary'
+
+FACT_TABLE = 'sales_orders'
+TIME_COLUMN = 'order_datetime'
+DAY_COLUMN = 'order_date'
+# Primary key of the fact table, the refreshes and realtime sums read the rows above it through its index
+WATERMARK_COLUMN = 'order_line_item_no'
+# Dimension tables and the column they are joined to the fact table on
+JOIN_COLUMNS = {'products': 'product_id', 'customers': 'customer_id'}
+# Summary column, aggregate of the fact table
+MEASURES = [
+    ('quantity', f'sum({FACT_TABLE}.quantity)'),
+    ('revenue', f'sum({FACT_TABLE}.unit_price * {FACT_TABLE}.quantity)'),
+    ('order_lines', 'count(*)'),
+]
+
+Summary = namedtuple('Summary', ['name', 'tables', 'dimensions', 'daily', 'description'])
+
+SUMMARIES = [
+    Summary('sales_by_day', (), ('sales_orders.product_id',), True,
+            'sales_orders summed per day and product'),
+    Summary('sales_by_day_product', ('products',),
+            ('sales_orders.product_id', 'products.product_category', 'products.product_name'), True,
+            'sales_orders joined to products, summed per day and product'),
+    Summary('sales_by_day_product_state', ('products', 'customers'),
+            ('sales_orders.product_id', 'products.product_category', 'products.product_name', 'customers.state'), True,
+            'sales_orders joined to products and customers, summed per day, product and customer state'),
+    Summary('sales_by_customer', ('customers',),
+            ('sales_orders.customer_id', 'customers.customer_name', 'customers.state', 'customers.city'), False,
+            'sales_orders joined to customers, summed per customer'),
+]
+
+# Units and fields of order_datetime which are the same for the day it is truncated to
+DAY_UNITS = {'day', 'week', 'month', 'quarter', 'year', 'decade', 'century', 'millennium'}
+DATE_FIELDS = DAY_UNITS | {'dow', 'isodow', 'doy', 'isoyear'}
+# Aggregates which can't be computed from the sums, only sum, count, min and max can
+OTHER_AGGREGATES = {'avg', 'array_agg', 'string_agg', 'json_agg', 'jsonb_agg', 'json_object_agg', 'jsonb_object_agg',
+                    'xmlagg', 'stddev', 'stddev_pop', 'stddev_samp', 'variance', 'var_pop', 'var_samp', 'bool_and',
+                    'bool_or', 'every', 'bit_and', 'bit_or', 'percentile_cont', 'percentile_disc', 'mode', 'corr',
+                    'covar_pop', 'covar_samp'}
+UNSUPPORTED_KEYWORDS = {'with', 'union', 'union all', 'intersect', 'except', 'over', 'distinct', 'window', 'lateral',
+                        'filter', 'within', 'grouping sets', 'rollup', 'cube'}
+CLAUSES = {'select', 'from', 'where', 'group by', 'having', 'order by', 'limit', 'offset', 'fetch'}
+# Keywords followed by a space before an opening parenthesis, function names are not
+SPACED_KEYWORDS = {'select', 'and', 'or', 'not', 'in', 'exists', 'any', 'all', 'as', 'from', 'where', 'having', 'by',
+                   'when', 'then', 'else', 'between', 'is'}
+_DAY_LITERAL = re.compile(r"^'\d{4}-\d{2}-\d{2}( 00:00(:00)?)?'$")
+
+STATE_TABLE_QUERY = (f'Create table if not exists {SUMMARY_SCHEMA}.refresh_state (summary_name text primary key, '
+                     'watermark bigint not null default 0, refreshed_at timestamptz, full_refreshed_at timestamptz);')
+# Columns of the summary tables and of the tables they summarize
+CATALOG_QUERY = ("Select c.relname, a.attname, format_type(a.atttypid, a.atttypmod) from pg_attribute a "
+                 "join pg_class c on c.oid = a.attrelid join pg_namespace n on n.oid = c.relnamespace "
+                 "where (n.nspname = %s or n.nspname = 'public' and c.relname = any(%s)) and c.relkind = 'r' "
+                 "and a.attnum > 0 and not a.attisdropped;")
+BASE_TABLES = [FACT_TABLE] + list(JOIN_COLUMNS)
+TIME_TYPE_QUERY = ("Select format_type(atttypid, atttypmod) from pg_attribute "
+                   "where attrelid = %s::regclass and attname = %s;")
+
+
+def _column(dimension):
+    return dimension.split('.')[-1]
+
+
+def aggregate_query(summary, time_type, where=''):
+    """
+    Query which sums the order lines selected by `where` for the summary. The day is
+    cast back to the type of order_datetime, so expressions on it keep their types.
+    """
+    columns = []
+    if summary.daily:
+        columns.append(f"date_trunc('day', {FACT_TABLE}.{TIME_COLUMN}::timestamp)::{time_type} as {DAY_COLUMN}")
+    columns += list(summary.dimensions)
+    joins = ''.join(f' join {table} on {table}.{JOIN_COLUMNS[table]} = {FACT_TABLE}.{JOIN_COLUMNS[table]}'
+                    for table in summary.tables)
+    group_by = ', '.join(str(i) for i in range(1, len(columns) + 1))
+    measures = ', '.join(f'{expression} as {name}' for name, expression in MEASURES)
+    return f"select {', '.join(columns)}, {measures} from {FACT_TABLE}{joins} {where} group by {group_by}"
+
+
+def prompt_lines(summary):
+    columns = ([DAY_COLUMN] if summary.daily else []) + [_column(d) for d in summary.dimensions] + [m for m, _ in MEASURES]
+    return [f"{SUMMARY_SCHEMA}.{summary.name}({', '.join(columns)})",
+            f'{SUMMARY_SCHEMA}.{summary.name} has {summary.description}: quantity, revenue (unit_price * quantity) '
+            f'and order_lines (count of order lines) are sums, sum them again when grouping']
+
+
+def create_summaries(conn):
+    """
+    Create the summary tables which don't exist yet, empty, and describe them in `config.prompt`.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f'Create schema if not exists {SUMMARY_SCHEMA};')
+        cursor.execute(STATE_TABLE_QUERY)
+        cursor.execute(TIME_TYPE_QUERY, (FACT_TABLE, TIME_COLUMN))
+        time_type = cursor.fetchone()[0]
+        for summary in SUMMARIES:
+            cursor.execute('Select to_regclass(%s) is null;', (f'{SUMMARY_SCHEMA}.{summary.name}',))
+            if not cursor.fetchone()[0]:
+                continue
+            logging.info(f'Creating summary table {SUMMARY_SCHEMA}.{summary.name}')
+            cursor.execute(f'Create table {SUMMARY_SCHEMA}.{summary.name} as {aggregate_query(summary, time_type)} with no data;')
+            if summary.daily:
+                cursor.execute(f'Create index on {SUMMARY_SCHEMA}.{summary.name} ({DAY_COLUMN});')
+            cursor.execute(f'Insert into {SUMMARY_SCHEMA}.refresh_state (summary_name) values (%s) '
+                           'on conflict (summary_name) do update set watermark = 0, full_refreshed_at = null;',
+                           (summary.name,))
+            for line in prompt_lines(summary):
+                cursor.execute('Insert into config.prompt (line, include) select %s, true '
+                               'where not exists (select 1 from config.prompt where line = %s);', (line, line))
+
+
+def refresh_summary(conn, summary, time_type, full=False):
+    """
+    Append the sums of the order lines added since the last refresh, or rebuild the
+    table when `full`. Returns the number of summary rows written.
+    """
+    table = f'{SUMMARY_SCHEMA}.{summary.name}'
+    with conn.cursor() as cursor:
+        # Locks the state row, so concurrent refreshes of the same summary wait for each other
+        cursor.execute(f'Select watermark from {SUMMARY_SCHEMA}.refresh_state where summary_name = %s for update;',
+                       (summary.name,))
+        watermark = 0 if full else cursor.fetchone()[0]
+        cursor.execute(f'Select coalesce(max({WATERMARK_COLUMN}), 0) from {FACT_TABLE};')
+        new_watermark = cursor.fetchone()[0]
+        if full:
+            cursor.execute(f'Truncate {table};')
+        elif new_watermark <= watermark:
+            return 0
+        where = (f'where {FACT_TABLE}.{WATERMARK_COLUMN} > {int(watermark)} '
+                 f'and {FACT_TABLE}.{WATERMARK_COLUMN} <= {int(new_watermark)}')
+        cursor.execute(f'Insert into {table} {aggregate_query(summary, time_type, where)};')
+        rows = cursor.rowcount
+        cursor.execute(f"Update {SUMMARY_SCHEMA}.refresh_state set watermark = %s, refreshed_at = now()"
+                       f"{', full_refreshed_at = now()' if full else ''} where summary_name = %s;",
+                       (new_watermark, summary.name))
+        return rows
+
+
+def refresh_summaries(host, port, database, user, password, full=False):
+    """
+    Create missing summary tables and refresh all of them, fully when `full` or when
+    the last full refresh is older than `SUMMARY_FULL_REFRESH_INTERVAL`.
+    """
+    with db_pool.connection(host, port, database, user, password) as conn:
+        create_summaries(conn)
+    for summary in SUMMARIES:
+        # One transaction per summary, readers see the appended rows and the new watermark together
+        with instrumentation.span('refresh_summary', {'summary.name': summary.name}) as span:
+            with db_pool.connection(host, port, database, user, password) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(TIME_TYPE_QUERY, (FACT_TABLE, TIME_COLUMN))
+                    time_type = cursor.fetchone()[0]
+                    cursor.execute(f'Select full_refreshed_at is null or full_refreshed_at < now() - %s * interval '
+                                   f"'1 second' from {SUMMARY_SCHEMA}.refresh_state where summary_name = %s;",
+                                   (SUMMARY_FULL_REFRESH_INTERVAL, summary.name))
+                    summary_full = full or cursor.fetchone()[0]
+                rows = refresh_summary(conn, summary, time_type, summary_full)
+            span.set_attribute('summary.full', summary_full)
+            span.set_attribute('summary.rows', rows)
+
+
+class _Rejected(Exception):
+    # The query can't be answered from a summary
+    pass
+
+
+def _tokens(sql_query):
+    tokens = []
+    for token in sqlparse.parse(sql_query)[0].flatten():
+        if token.is_whitespace or token.ttype in T.Comment or token.value == ';':
+            continue
+        value = token.value
+        if token.ttype in T.Literal.String.Symbol:
+            # Quoted identifiers, only lower case ones can be columns
+            value = value[1:-1]
+        tokens.append((token.ttype, value))
+    return tokens
+
+
+def _lower(token):
+    return ' '.join(token[1].lower().split()) if token[0] not in T.Literal.String else token[1]
+
+
+def _is_name(token):
+    return token[0] in T.Name or token[0] in T.Literal.String.Symbol or token[0] in T.Keyword
+
+
+def _matching_paren(values, start):
+    depth = 0
+    for i in range(start, len(values)):
+        if values[i] == '(':
+            depth += 1
+        elif values[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise _Rejected('unbalanced parentheses')
+
+
+def _clauses(values):
+    # Index of every top level clause keyword
+    clauses, depth = {}, 0
+    for i, value in enumerate(values):
+        depth += (value == '(') - (value == ')')
+        if depth == 0 and value in CLAUSES:
+            if value in clauses:
+                raise _Rejected(f'more than one {value}')
+            clauses[value] = i
+    return clauses
+
+
+def _parse_from(tokens, values):
+    """
+    Tables of an explicit inner join of the fact table and dimension tables, by alias,
+    and the dimension tables. Every dimension table must be joined to the fact table
+    on its join column.
+    """
+    tables, joined, i = {}, [], 0
+
+    def table_ref(i):
+        if not _is_name(tokens[i]):
+            raise _Rejected('not a table')
+        table, i = values[i], i + 1
+        if i + 1 < len(values) and values[i] == '.':
+            if table != 'public':
+                raise _Rejected(f'schema {table}')
+            table, i = values[i + 1], i + 2
+        alias = table
+        if i < len(values) and values[i] == 'as':
+            i += 1
+        if i < len(values) and tokens[i][0] in T.Name:
+            alias, i = values[i], i + 1
+        if table not in JOIN_COLUMNS and table != FACT_TABLE or table in tables.values() or alias in tables:
+            raise _Rejected(f'table {table}')
+        tables[alias] = table
+        return table, i
+
+    def qualified_column(i):
+        if i + 2 < len(values) and values[i + 1] == '.' and values[i] in tables:
+            return tables[values[i]], values[i + 2], i + 3
+        raise _Rejected('unqualified join column')
+
+    table, i = table_ref(0)
+    joined.append(table)
+    while i < len(values):
+        if values[i] not in ('join', 'inner join'):
+            raise _Rejected(f'{values[i]} in from')
+        table, i = table_ref(i + 1)
+        if i < len(values) and values[i] == 'using':
+            if values[i + 1] != '(' or values[i + 3] != ')':
+                raise _Rejected('using more than one column')
+            column, i = values[i + 2], i + 4
+            other = FACT_TABLE if table != FACT_TABLE else next((t for t in joined if JOIN_COLUMNS.get(t) == column), None)
+            edge = {table, other}
+        elif i < len(values) and values[i] == 'on':
+            left, column, i = qualified_column(i + 1)
+            if i >= len(values) or values[i] != '=':
+                raise _Rejected('join condition')
+            right, right_column, i = qualified_column(i + 1)
+            if right_column != column:
+                raise _Rejected('join condition')
+            edge = {left, right}
+        else:
+            raise _Rejected('join without condition')
+        dimension = next(iter(edge - {FACT_TABLE}), None)
+        if FACT_TABLE not in edge or table not in edge or JOIN_COLUMNS.get(dimension) != column:
+            raise _Rejected('join condition')
+        joined.append(table)
+    if FACT_TABLE not in joined:
+        raise _Rejected(f'no {FACT_TABLE}')
+    return tables, set(joined) - {FACT_TABLE}
+
+
+def _strip_qualifiers(tokens, tables):
+    stripped, i = [], 0
+    while i < len(tokens):
+        if i + 2 < len(tokens) and tokens[i + 1][1] == '.' and _is_name(tokens[i]):
+            if _lower(tokens[i]) not in tables:
+                raise _Rejected(f'unknown qualifier {tokens[i][1]}')
+            i += 2
+            continue
+        stripped.append(tokens[i])
+        i += 1
+    return stripped
+
+
+def _time_safe(values, i, time_type):
+    """
+    Whether the value of order_datetime at `i` is only used at day granularity, so the
+    day of the summary gives the same result.
+    """
+    start, end, casts = i, i + 1, []
+    while end + 1 < len(values) and values[end] == '::':
+        casts.append(values[end + 1])
+        end += 2
+    if start >= 2 and values[start - 2:start] == ['cast', '('] and end + 2 < len(values) \
+            and values[end] == 'as' and values[end + 2] == ')':
+        casts.append(values[end + 1])
+        start, end = start - 2, end + 3
+        while end + 1 < len(values) and values[end] == '::':
+            casts.append(values[end + 1])
+            end += 2
+    if casts and casts[-1] == 'date':
+        return True
+    before = values[start - 1] if start >= 1 else None
+    after = values[end] if end < len(values) else None
+    if before == '(' and after == ')' and start >= 2 and values[start - 2] == 'date':
+        return True
+    if before == ',' and after == ')' and start >= 4 and values[start - 3] == '(' \
+            and values[start - 4] in ('date_trunc', 'date_part') and values[start - 2].strip("'").lower() in DATE_FIELDS:
+        return values[start - 4] == 'date_part' or values[start - 2].strip("'").lower() in DAY_UNITS
+    if before == 'from' and after == ')' and start >= 4 and values[start - 3] == '(' and values[start - 4] == 'extract':
+        return values[start - 2].strip("'").lower() in DATE_FIELDS
+    # Comparisons with midnight, only for values compared as timestamps or dates, which
+    # are a condition of their own
+    timestamp = any(c in ('timestamp', 'date') for c in casts) or time_type.startswith(('timestamp', 'date'))
+    boundaries = ('where', 'and', 'having', '(')
+    ends = ('and', ')', None) + tuple(CLAUSES)
+    if timestamp and before in boundaries and end + 1 < len(values) and values[end] in ('>=', '<') \
+            and _DAY_LITERAL.match(values[end + 1]) and (values[end + 2] if end + 2 < len(values) else None) in ends:
+        return True
+    if timestamp and after in ends and start >= 2 and values[start - 1] in ('<=', '>') \
+            and _DAY_LITERAL.match(values[start - 2]) and (start == 2 or values[start - 3] in boundaries):
+        return True
+    return False
+
+
+def _join(values):
+    text = ''
+    for value in values:
+        if text and not text.endswith(('(', '::')) and value not in (',', ')', '::') \
+                and not (value == '(' and text[-1].isalnum() and text.split()[-1].lower() not in SPACED_KEYWORDS):
+            text += ' '
+        text += value
+    return text
+
+
+def rewrite(sql_query, catalog):
+    """
+    The query rewritten to read a summary table, or None when none of the summaries
+    in `catalog` (table name -> column types) gives the same results.
+    """
+    try:
+        sql_query = query_guard.check_query(sql_query)
+        tokens = _tokens(sql_query)
+        values = [_lower(t) for t in tokens]
+        if any(v in UNSUPPORTED_KEYWORDS for v in values) or values.count('select') != 1:
+            raise _Rejected('unsupported query')
+        clauses = _clauses(values)
+        if values[0] != 'select' or 'from' not in clauses:
+            raise _Rejected('no from')
+        from_end = min([i for i in clauses.values() if i > clauses['from']] + [len(values)])
+        tables, joined = _parse_from(tokens[clauses['from'] + 1:from_end], values[clauses['from'] + 1:from_end])
+        summary = next((s for s in SUMMARIES if set(s.tables) == joined and s.name in catalog), None)
+        if summary is None:
+            raise _Rejected('no summary of these tables')
+        column_types = catalog[summary.name]
+        dimensions = {_column(d) for d in summary.dimensions}
+        # Columns which can't be read from the summary, including measures which are sums there
+        other_columns = {c for t in BASE_TABLES for c in catalog.get(t, {})} | set(column_types)
+
+        head = _strip_qualifiers(tokens[:clauses['from']], tables)
+        tail = _strip_qualifiers(tokens[from_end:], tables)
+        body = head + [(T.Keyword, 'from')] + tail
+        body_values = [_lower(t) for t in body]
+        # Output names, the types of casts are builtins
+        aliases = {body_values[i + 1] for i, v in enumerate(body_values[:-1])
+                   if v == 'as' and body[i + 1][0] not in T.Name.Builtin}
+        output, clause, aggregated, i = [], 'select', 'group by' in clauses, 0
+        while i < len(body):
+            token, value = body[i], body_values[i]
+            if i == len(head):
+                from_index = len(output)
+            if value in CLAUSES:
+                clause = value
+            if token[0] in T.Name and i + 1 < len(body) and body_values[i + 1] == '(':
+                if value in OTHER_AGGREGATES or value.startswith('regr_'):
+                    raise _Rejected(f'aggregate {value}')
+                if value in ('sum', 'count'):
+                    end = _matching_paren(body_values, i + 1)
+                    argument = ''.join(body_values[i + 2:end])
+                    while argument.startswith('(') and argument.endswith(')'):
+                        argument = argument[1:-1]
+                    if value == 'sum' and argument == 'quantity':
+                        output.append(f"sum(quantity)::{column_types['quantity']}")
+                    elif value == 'sum' and argument in ('unit_price*quantity', 'quantity*unit_price'):
+                        output.append(f"sum(revenue)::{column_types['revenue']}")
+                    elif value == 'count' and argument in ('*', '1'):
+                        output.append(f"coalesce(sum(order_lines), 0)::{column_types['order_lines']}")
+                    else:
+                        raise _Rejected(f'{value}({argument})')
+                    aggregated = True
+                    i = end + 1
+                    continue
+                output.append(token[1])
+            elif token[0] in T.Wildcard:
+                raise _Rejected('select *')
+            elif value in dimensions:
+                output.append(value)
+            elif value == TIME_COLUMN and summary.daily and _time_safe(body_values, i, column_types[DAY_COLUMN]):
+                output.append(DAY_COLUMN)
+            elif i >= 1 and body_values[i - 1] == 'as' and _is_name(token) or body_values[i - 2:i] == ['extract', '(']:
+                output.append(token[1])
+            elif value in aliases and (clause == 'order by' or clause == 'group by' and value not in other_columns):
+                # GROUP BY prefers input columns to output names, ORDER BY the other way round
+                output.append(token[1])
+            elif value in other_columns or token[0] in T.Name and token[0] not in T.Name.Builtin:
+                raise _Rejected(f'column {token[1]}')
+            else:
+                output.append(token[1])
+            i += 1
+        if not aggregated:
+            raise _Rejected('not an aggregate')
+    except (_Rejected, query_guard.QueryRejected) as e:
+        logging.info(f'Query not rewritten to a summary: {e}')
+        return None
+
+    source = f'{SUMMARY_SCHEMA}.{summary.name}'
+    if SUMMARY_REALTIME:
+        where = (f'where {FACT_TABLE}.{WATERMARK_COLUMN} > (select watermark from {SUMMARY_SCHEMA}.refresh_state '
+                 f"where summary_name = '{summary.name}')")
+        source = (f'(select * from {source} union all '
+                  f"{aggregate_query(summary, column_types.get(DAY_COLUMN), where)}) as {summary.name}")
+    return _join(output[:from_index] + ['from', source] + output[from_index + 1:]) + ';'
+
+
+_catalogs = {}  # connection key -> (catalog, expiry time)
+_catalogs_lock = threading.Lock()
+
+
+def _to_catalog(rows):
+    catalog = {}
+    for table, column, column_type in rows:
+        catalog.setdefault(table, {})[column] = column_type
+    return catalog
+
+
+def get_catalog(host, port, database, user, password):
+    """
+    Column types of the summary tables which exist, cached for `SUMMARY_CATALOG_TTL` seconds.
+    """
+    key = (host, str(port), database, user)
+    with _catalogs_lock:
+        cached = _catalogs.get(key)
+    if cached is not None and time.monotonic() < cached[1]:
+        return cached[0]
+    with db_pool.connection(host, port, database, user, password) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(CATALOG_QUERY, (SUMMARY_SCHEMA, BASE_TABLES))
+            catalog = _to_catalog(cursor.fetchall())
+    with _catalogs_lock:
+        _catalogs[key] = (catalog, time.monotonic() + SUMMARY_CATALOG_TTL)
+    return catalog
+
+
+def _rewrite_query(sql_query, catalog):
+    rewritten = rewrite(sql_query, catalog) if any(s.name in catalog for s in SUMMARIES) else None
+    instrumentation.set_attribute('summary.rewritten', rewritten is not None)
+    instrumentation.add('openai_sql.summary.rewrites', 1, {'result': 'rewritten' if rewritten else 'unchanged'})
+    if rewritten is not None:
+        logging.info(f'Query rewritten to a summary: {rewritten}')
+    return rewritten or sql_query
+
+
+def rewrite_query(host, port, database, user, password, sql_query):
+    """
+    The generated query, rewritten to read a summary table when one gives the same results.
+    """
+    if not SUMMARY_TABLES_ENABLED:
+        return sql_query
+    try:
+        return _rewrite_query(sql_query, get_catalog(host, port, database, user, password))
+    except Exception as e:
+        # The aggregate layer is optional, queries run on the base tables when it fails
+        logging.exception(e)
+        return sql_query
+
+
+async def rewrite_query_async(host, port, database, user, password, sql_query):
+    """
+    `rewrite_query` which loads the catalog with the asyncpg pool.
+    """
+    if not SUMMARY_TABLES_ENABLED:
+        return sql_query
+    from shared_code import async_db_pool
+    try:
+        key = (host, str(port), database, user)
+        cached = _catalogs.get(key)
+        if cached is None or time.monotonic() >= cached[1]:
+            pool = await async_db_pool.get_pool(host, port, database, user, password)
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(CATALOG_QUERY.replace('%s', '$1', 1).replace('%s', '$2'),
+                                        SUMMARY_SCHEMA, BASE_TABLES)
+            cached = _catalogs[key] = (_to_catalog(rows), time.monotonic() + SUMMARY_CATALOG_TTL)
+        return _rewrite_query(sql_query, cached[0])
+    except Exception as e:
+        logging.exception(e)
+        return sql_query
@@ -0,0 +1,53 @@
+"""
+Token counts of prompts, measured with the tokenizer of the completion model so prompt
+budgets are in the tokens which are billed and count against the rate limits.
+
+tiktoken runs locally, but downloads the encoding file on first use unless it is found
+in `TIKTOKEN_CACHE_DIR`, which can be deployed with the app. When tiktoken is not
+installed or the encoding can't be loaded, tokens are estimated from the length of the
+text instead.
+"""
+import logging
+import os
+import threading
+
+# p50k_base is the encoding of code-davinci-002 and text-davinci-002/003
+PROMPT_TOKENIZER_ENCODING = os.environ.get('PROMPT_TOKENIZER_ENCODING', 'p50k_base')
+
+_encoding = None
+_failed = False
+_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    # Rough estimate for English text and SQL identifiers, about 4 characters per token
+    return len(text) // 4 + 1
+
+
+def get_encoding():
+    """
+    The tiktoken encoding, None when it isn't available.
+    """
+    global _encoding, _failed
+    if _encoding is not None or _failed:
+        return _encoding
+    with _lock:
+        if _encoding is None and not _failed:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER_ENCODING)
+            except Exception as e:
+                # Only logged once, the estimate is used from then on
+                logging.warning(f'Tokenizer {PROMPT_TOKENIZER_ENCODING} not available, estimating tokens: {e!r}')
+                _failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    # Special tokens in the text are counted as plain text
+    return len(encoding.encode(text, disallowed_special=()))
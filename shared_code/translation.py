@@ -0,0 +1,134 @@
+"""
+Translation of natural language questions to SQL with OpenAI, shared by the HTTP
+functions and the generate activity.
+
+The schema block of the prompt is cached per worker and only the question is appended
+per request. Large schemas are pruned to the tables relevant to the question and the
+prompt is kept within its token budget, see `prompt_builder`. Translations are cached
+per schema version so OpenAI is only called on a miss, and aggregates are answered from
+the summary tables when they give the same results.
+
+`completion_params` select the model, `model` for OpenAI or `engine` for Azure OpenAI.
+"""
+import asyncio
+import logging
+
+from shared_code import instrumentation, prompt_builder, prompt_cache, summary_tables, translation_cache
+from shared_code.lazy_modules import lazy_import
+
+openai = lazy_import('openai')
+
+# Completions of a single question end with the statement
+STOP = ['#', ';']
+
+TRANSLATION_FAILED = 'translation_failed'
+
+
+def to_sql_query(s):
+    s = s.replace('\\n', ' ').replace('\n', ' ')
+    return f'select {s};'
+
+
+def translation_error(e):
+    # Structured error returned instead of the SQL of a question which could not be translated
+    return {'error': {'code': TRANSLATION_FAILED, 'message': str(e)}}
+
+
+def completion_params(params, max_tokens):
+    return dict(params, temperature=0, max_tokens=max_tokens, top_p=1, frequency_penalty=0, presence_penalty=0)
+
+
+def _model(params):
+    # Translations are cached per model
+    return params.get('engine') or params.get('model') or ''
+
+
+def generate_sql_query(prompt, **params):
+    """
+    SQL of the completion of a single question prompt. A completion cut off by
+    max_tokens is requested once more with the tokens left by the prompt.
+    """
+    with instrumentation.span('prompt_openai', {'openai.max_tokens': prompt.max_tokens}):
+        response = openai.Completion.create(prompt=prompt.text, stop=STOP,
+                                            **completion_params(params, prompt.max_tokens))
+        instrumentation.record_openai_usage(response)
+        max_tokens = prompt_builder.retry_max_tokens(prompt, response)
+        if max_tokens:
+            response = openai.Completion.create(prompt=prompt.text, stop=STOP, **completion_params(params, max_tokens))
+            instrumentation.record_openai_usage(response)
+        prompt_builder.record_completion(response, max_tokens or prompt.max_tokens)
+    return to_sql_query(response['choices'][0]['text'])
+
+
+async def _call(function, *args, **kwargs):
+    return await function(*args, **kwargs)
+
+
+async def generate_sql_query_async(prompt, call=None, **params):
+    """
+    `generate_sql_query` with the asyncio client. `call` runs the requests, e.g.
+    `Dispatcher.call` of `openai_batch` to retry rate limited requests.
+    """
+    call = call or _call
+    with instrumentation.span('prompt_openai', {'openai.max_tokens': prompt.max_tokens}):
+        response = await call(openai.Completion.acreate, prompt=prompt.text, stop=STOP,
+                              **completion_params(params, prompt.max_tokens))
+        instrumentation.record_openai_usage(response)
+        max_tokens = prompt_builder.retry_max_tokens(prompt, response)
+        if max_tokens:
+            response = await call(openai.Completion.acreate, prompt=prompt.text, stop=STOP,
+                                  **completion_params(params, max_tokens))
+            instrumentation.record_openai_usage(response)
+        prompt_builder.record_completion(response, max_tokens or prompt.max_tokens)
+    return to_sql_query(response['choices'][0]['text'])
+
+
+def translate_text_query(host, port, database, user, password, text_query, **params):
+    prompt_schema = prompt_cache.get_prompt_schema(host, port, database, user, password)
+    sql_query = translation_cache.get_translation_cache().get_or_set(
+        prompt_schema.version,
+        text_query,
+        lambda: generate_sql_query(prompt_builder.build_prompt(prompt_schema, text_query), **params),
+        model=_model(params))
+    return summary_tables.rewrite_query(host, port, database, user, password, sql_query)
+
+
+async def translate_text_query_async(host, port, database, user, password, text_query, **params):
+    # `translate_text_query` without blocking the event loop
+    from shared_code import async_prompt_cache
+    prompt_schema = await async_prompt_cache.get_prompt_schema(host, port, database, user, password)
+    cache = translation_cache.get_translation_cache()
+    sql_query = cache.get(prompt_schema.version, text_query, model=_model(params))
+    if sql_query is None:
+        sql_query = await generate_sql_query_async(prompt_builder.build_prompt(prompt_schema, text_query), **params)
+        cache.set(prompt_schema.version, text_query, sql_query, model=_model(params))
+    return await summary_tables.rewrite_query_async(host, port, database, user, password, sql_query)
+
+
+def translate_text_queries(host, port, database, user, password, text_queries, **params):
+    """
+    `translate_text_query` of every question, in the same order. The questions missing
+    from the translation cache are numbered in shared prompts, so the schema block is
+    sent once per batch instead of once per question. Questions which could not be
+    translated have a `translation_error` instead of their SQL.
+    """
+    # Imported here, `openai_batch` generates single questions with this module
+    from shared_code import openai_batch
+    prompt_schema = prompt_cache.get_prompt_schema(host, port, database, user, password)
+    cache = translation_cache.get_translation_cache()
+    sql_queries = [cache.get(prompt_schema.version, text_query, model=_model(params)) for text_query in text_queries]
+    misses = [i for i, sql_query in enumerate(sql_queries) if sql_query is None]
+    failed = set()
+    if misses:
+        generated = asyncio.run(openai_batch.generate_sql_queries(
+            prompt_schema, [text_queries[i] for i in misses], **params))
+        for i, sql_query in zip(misses, generated):
+            if isinstance(sql_query, Exception):
+                logging.error(sql_query, exc_info=sql_query)
+                failed.add(i)
+                sql_query = translation_error(sql_query)
+            else:
+                cache.set(prompt_schema.version, text_queries[i], sql_query, model=_model(params))
+            sql_queries[i] = sql_query
+    return [summary_tables.rewrite_query(host, port, database, user, password, sql_query)
+            if i not in failed else sql_query for i, sql_query in enumerate(sql_queries)]
@@ -0,0 +1,260 @@
+"""
+Cache of natural language query -> SQL translations.
+
+Entries are keyed by the model, the prompt schema version and the normalized query
+text, so a change to `config.prompt` never serves SQL generated for an older schema.
+Lookups match the normalized text exactly, literals keep their case unless the whole
+question is in capitals or title case. With
+`TRANSLATION_CACHE_SIMILARITY` below 1 they fall back to near-duplicate matching using
+Levenshtein similarity, between questions which only differ in whitespace, punctuation
+and stopwords. Entries are evicted least recently used first
+and after a TTL. The backing store is either in-memory or a local SQLite file.
+"""
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import Levenshtein
+from shared_code import instrumentation
+
+TRANSLATION_CACHE_STORE = os.environ.get('TRANSLATION_CACHE_STORE', 'memory')
+TRANSLATION_CACHE_PATH = os.environ.get('TRANSLATION_CACHE_PATH',
+                                        os.path.join(tempfile.gettempdir(), 'translation_cache.db'))
+TRANSLATION_CACHE_TTL = float(os.environ.get('TRANSLATION_CACHE_TTL', 86400))
+TRANSLATION_CACHE_MAX_ENTRIES = int(os.environ.get('TRANSLATION_CACHE_MAX_ENTRIES', 1000))
+# Minimum Levenshtein ratio for a near-duplicate hit, 1 disables near-duplicate matching
+TRANSLATION_CACHE_SIMILARITY = float(os.environ.get('TRANSLATION_CACHE_SIMILARITY', 1.0))
+
+# Words near-duplicates can differ in, they don't change the SQL
+STOPWORDS = frozenset({'a', 'an', 'the', 'please', 'me', 'us', 'show', 'list', 'give', 'get', 'find', 'display',
+                       'return', 'what', 'which', 'are', 'is', 'all'})
+NEGATIONS = frozenset({'not', 'no', 'without', 'except', 'excluding', 'never', 'none', 'nor'})
+_QUOTED = re.compile(r'''(?<!\w)('[^']*'|"[^"]*")(?!\w)''')
+_LITERAL = re.compile(r'''(?<!\w)'[^']*'(?!\w)|(?<!\w)"[^"]*"(?!\w)|\b\w*[A-Z]\w*''')
+
+
+def _is_literal(word, first, case=None):
+    # Names and codes, e.g. "CA" or "Smith". The first word only when it isn't just capitalized.
+    # Capitals don't mark names in questions written in capitals or in title case.
+    if case == 'upper':
+        return False
+    if case == 'title':
+        return any(c.isupper() for c in word[1:])
+    return any(c.isupper() for c in word[1:]) or (word[:1].isupper() and not first)
+
+
+def _case(words):
+    # 'upper' or 'title' for questions written in capitals or title case, None otherwise
+    words = [word for word in words if word[:1].isalpha()]
+    if len(words) < 2:
+        return None
+    if not any(c.islower() for word in words for c in word):
+        return 'upper'
+    if all(word[:1].isupper() for word in words):
+        return 'title'
+    return None
+
+
+def normalize_text(text_query):
+    """
+    The question without case, punctuation and extra whitespace, except for literals:
+    quoted strings and capitalized words keep their case.
+    """
+    chunks = _QUOTED.split(text_query)
+    words = [[word.strip('.,') for word in re.sub(r'[^\w\s\'",.-]', ' ', chunk).split()] if i % 2 == 0 else chunk
+             for i, chunk in enumerate(chunks)]
+    case = _case([word for chunk in words[::2] for word in chunk])
+    parts = []
+    for i, chunk in enumerate(words):
+        if i % 2:
+            parts.append(chunk)
+            continue
+        for word in chunk:
+            if word:
+                parts.append(word if _is_literal(word, not parts, case) else word.lower())
+    return ' '.join(parts)
+
+
+def _numbers(text):
+    return re.findall(r'\d+', text)
+
+
+def _literals(text):
+    return _LITERAL.findall(text)
+
+
+def _words(text):
+    return [word for chunk in _QUOTED.split(text)[::2] for word in chunk.split()]
+
+
+def _negations(text):
+    return [word for word in _words(text) if word in NEGATIONS or word.endswith("n't")]
+
+
+def _content_words(text):
+    return [word for word in _words(text) if word not in STOPWORDS]
+
+
+class MemoryStore:
+    def __init__(self, max_entries=TRANSLATION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (scope, text) -> (sql query, created time)
+        self._lock = threading.Lock()
+
+    def get(self, scope, text):
+        with self._lock:
+            entry = self._entries.get((scope, text))
+            if entry is None:
+                return None
+            self._entries.move_to_end((scope, text))
+            return entry
+
+    def set(self, scope, text, sql_query):
+        with self._lock:
+            self._entries[(scope, text)] = (sql_query, time.time())
+            self._entries.move_to_end((scope, text))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, scope, text):
+        with self._lock:
+            self._entries.pop((scope, text), None)
+
+    def texts(self, scope):
+        with self._lock:
+            return [text for (s, text) in self._entries if s == scope]
+
+
+class SqliteStore:
+    def __init__(self, path=TRANSLATION_CACHE_PATH, max_entries=TRANSLATION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'create table if not exists translations ('
+                'scope text not null, text_query text not null, sql_query text not null, '
+                'created_at real not null, used_at real not null, primary key (scope, text_query))')
+
+    def get(self, scope, text):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'select sql_query, created_at from translations where scope = ? and text_query = ?',
+                (scope, text)).fetchone()
+            if row is not None:
+                self._conn.execute('update translations set used_at = ? where scope = ? and text_query = ?',
+                                   (time.time(), scope, text))
+            return row
+
+    def set(self, scope, text, sql_query):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('insert or replace into translations values (?, ?, ?, ?, ?)',
+                               (scope, text, sql_query, now, now))
+            self._conn.execute(
+                'delete from translations where rowid in (select rowid from translations '
+                'order by used_at desc limit -1 offset ?)', (self.max_entries,))
+
+    def delete(self, scope, text):
+        with self._lock, self._conn:
+            self._conn.execute('delete from translations where scope = ? and text_query = ?', (scope, text))
+
+    def texts(self, scope):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'select text_query from translations where scope = ?', (scope,))]
+
+
+class TranslationCache:
+    def __init__(self, store, ttl=TRANSLATION_CACHE_TTL, similarity=TRANSLATION_CACHE_SIMILARITY):
+        self.store = store
+        self.ttl = ttl
+        self.similarity = similarity
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    def _lookup(self, scope, text):
+        entry = self.store.get(scope, text)
+        if entry is None:
+            return None
+        sql_query, created_at = entry
+        if time.time() - created_at > self.ttl:
+            self.store.delete(scope, text)
+            return None
+        return sql_query
+
+    def _closest_text(self, scope, text):
+        # Near-duplicates only differ in whitespace, punctuation and stopwords. Numbers ("top 3"
+        # vs "top 10"), literals ("CA" vs "CO") and negations change the meaning, so they must
+        # match exactly.
+        best_text, best_ratio = None, self.similarity
+        for candidate in self.store.texts(scope):
+            if (_numbers(candidate) != _numbers(text) or _literals(candidate) != _literals(text)
+                    or _negations(candidate) != _negations(text)
+                    or _content_words(candidate) != _content_words(text)):
+                continue
+            ratio = Levenshtein.ratio(candidate, text)
+            if ratio >= best_ratio:
+                best_text, best_ratio = candidate, ratio
+        return best_text
+
+    def _count(self, result):
+        instrumentation.set_attribute('translation_cache.result', result)
+        instrumentation.add('openai_sql.cache.lookups', 1, {'cache': 'translation', 'result': result})
+
+    def get(self, schema_version, text_query, model=''):
+        scope = f'{model}/{schema_version}'
+        text = normalize_text(text_query)
+        sql_query = self._lookup(scope, text)
+        if sql_query is not None:
+            self.exact_hits += 1
+            self._count('exact')
+            return sql_query
+        if self.similarity < 1:
+            closest_text = self._closest_text(scope, text)
+            if closest_text is not None:
+                sql_query = self._lookup(scope, closest_text)
+                if sql_query is not None:
+                    self.fuzzy_hits += 1
+                    self._count('fuzzy')
+                    logging.info(f"Translation cache near-duplicate hit: '{text}' ~ '{closest_text}'")
+                    return sql_query
+        self.misses += 1
+        self._count('miss')
+        return None
+
+    def set(self, schema_version, text_query, sql_query, model=''):
+        self.store.set(f'{model}/{schema_version}', normalize_text(text_query), sql_query)
+
+    def get_or_set(self, schema_version, text_query, translate, model=''):
+        sql_query = self.get(schema_version, text_query, model)
+        if sql_query is None:
+            sql_query = translate()
+            self.set(schema_version, text_query, sql_query, model)
+        logging.info(f'Translation cache stats: {self.stats()}')
+        return sql_query
+
+    def stats(self):
+        return {'exactHits': self.exact_hits, 'fuzzyHits': self.fuzzy_hits, 'misses': self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_translation_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if TRANSLATION_CACHE_STORE == 'sqlite':
+                store = SqliteStore()
+            else:
+                store = MemoryStore()
+            _cache = TranslationCache(store)
+    return _cache
@@ -33,11 +33,14 @@ def call_az_func_api(text_query, exec_state):
             response= requests.get(statusUri)
             response.raise_for_status()
             func_run = response.json()
-            exec_state.text(f'Status: {func_run["runtimeStatus"]}') 
+            # Progress published by the orchastrator, the SQL is known before the results
+            progress = func_run.get('customStatus') or {}
+            exec_state.text(f'Status: {func_run["runtimeStatus"]} {progress.get("stage", "")} '
+                            f'{progress.get("rowsProcessed", "")}') 
             if (func_run['runtimeStatus'] == 'Failed'):
                 exec_state.text(f'Status: {func_run["runtimeStatus"]}, Error:{func_run["output"]}') 
                 Exception(f'Error : {func_run["output"]}')
-        return { 'sqlQuery': func_run['output']['sqlQuery'], 'resultsFileUrl' : func_run['output']['resultsFileUrl'] }
+        return func_run['output']
     except HTTPError as http_e:
         print(f'HTTP error occurred: {http_e}')
     except Exception as e: 
@@ -53,8 +56,22 @@ def load_data(nrows, resultsFileUrl):
 text_query = st.text_area('Please enter query text', '')
 if (text_query): 
     exec_state = st.text(f'Triggering execution ...')
-    response = call_az_func_api(text_query, exec_state)
+    # Kept across the reruns of the script, e.g. when asking for the full results
+    if st.session_state.get('text_query') != text_query:
+        st.session_state['response'] = call_az_func_api(text_query, exec_state)
+        st.session_state['text_query'] = text_query
+    response = st.session_state['response']
     st.code(sqlparse.format(response['sqlQuery'], reindent=True, keyword_case='upper'), language='sql')
-    data = load_data(1000, response['resultsFileUrl'])
-    st.write(data)
-    exec_state.text(f'Done, results:')
\ No newline at end of file
+    if 'error' in response:
+        exec_state.text(f'Query not executed, {response["error"]["code"]}: {response["error"]["message"]}')
+        st.stop()
+    # The preview comes with the response, the results file is only downloaded when asked for
+    preview = response.get('preview')
+    if preview:
+        exec_state.text(f'Done, first {len(preview["rows"])} of {response["rows"]} rows:')
+        st.write(pd.DataFrame(preview['rows'], columns=[str(c).lower() for c in preview['columns']], dtype=str))
+    else:
+        exec_state.text(f'Done, {response["rows"]} rows')
+    if st.checkbox('Show the full results (first 1000 rows)', value=not preview):
+        data = load_data(1000, response['resultsFileUrl'])
+        st.write(data)
\ No newline at end of file
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from shared_code import openai_batch, translation
+from shared_code.prompt_cache import PromptSchema
+
+PROMPT_SCHEMA = PromptSchema(['customers(customer_id, customer_name, state)', 'products(product_id, product_name)'],
+                             '', 'test')
+
+
+def test_parse_batch_completion():
+    text = ' * from a;\n2. SELECT * from b;\n3. SELECT * from c;'
+    assert openai_batch.parse_batch_completion(text, 3, True) == [
+        'select  * from a;', 'select  * from b;', 'select  * from c;']
+
+
+def test_parse_batch_completion_with_missing_index():
+    text = ' * from a;\n3. SELECT * from c;'
+    assert openai_batch.parse_batch_completion(text, 3, True) == ['select  * from a;', None, 'select  * from c;']
+
+
+def test_parse_batch_completion_maps_reordered_answers_by_number():
+    text = ' * from a;\n3. SELECT * from c;\n2. SELECT * from b;'
+    assert openai_batch.parse_batch_completion(text, 3, True) == [
+        'select  * from a;', 'select  * from b;', 'select  * from c;']
+
+
+def test_parse_batch_completion_ignores_repeated_and_unknown_numbers():
+    text = ' * from a;\n1. SELECT * from z;\n5. SELECT * from e;\n2. SELECT * from b;'
+    assert openai_batch.parse_batch_completion(text, 2, True) == ['select  * from a;', 'select  * from b;']
+
+
+@pytest.mark.parametrize('text', [
+    ' * from a;\n```sql\n2. SELECT * from b;\n```',
+    ' * from a;\n2. ```sql\nSELECT * from b;\n```',
+    ' * from a;\n2. SELECT * from b\n```',
+])
+def test_parse_batch_completion_strips_code_fences(text):
+    assert openai_batch.parse_batch_completion(text, 2, True) == ['select  * from a;', 'select  * from b;']
+
+
+def test_parse_batch_completion_with_fewer_answers_than_questions():
+    text = ' * from a;\n2. SELECT * from b;'
+    assert openai_batch.parse_batch_completion(text, 4, True) == ['select  * from a;', 'select  * from b;', None, None]
+
+
+def test_parse_batch_completion_drops_answer_cut_off():
+    text = ' * from a;\n2. SELECT * from b where'
+    assert openai_batch.parse_batch_completion(text, 2, False) == ['select  * from a;', None]
+
+
+class FakeDispatcher:
+    # Answers the combined prompt with `combined_text`, single prompts with the question
+    def __init__(self, combined_text):
+        self.combined_text = combined_text
+        self.prompts = []
+
+    async def call(self, function, prompt, stop, **params):
+        self.prompts.append(prompt)
+        if stop == translation.STOP:
+            question = prompt.rsplit('A query to ', 1)[1].split('\\n')[0].split('\n')[0]
+            return {'choices': [{'text': f" '{question}'", 'finish_reason': 'stop'}]}
+        return {'choices': [{'text': self.combined_text, 'finish_reason': 'stop'}]}
+
+
+def test_generate_sql_queries_prompts_unanswered_questions_singly():
+    dispatcher = FakeDispatcher(" 'first';\n3. SELECT 'third';")
+    sql_queries = asyncio.run(openai_batch.generate_sql_queries(
+        PROMPT_SCHEMA, ['first', 'second', 'third', 'fourth'], dispatcher, batch_size=4, mode='combined',
+        engine='test'))
+    assert sql_queries == ["select  'first';", "select  'second';", "select  'third';", "select  'fourth';"]
+    # One combined prompt, then one prompt for each question left unanswered
+    assert len(dispatcher.prompts) == 3
+
+
+def test_generate_sql_queries_returns_exception_of_failed_batch():
+    class FailingDispatcher:
+        async def call(self, *args, **kwargs):
+            raise RuntimeError('Service unavailable')
+
+    sql_queries = asyncio.run(openai_batch.generate_sql_queries(
+        PROMPT_SCHEMA, ['first', 'second'], FailingDispatcher(), batch_size=2, engine='test'))
+    assert [str(e) for e in sql_queries] == ['Service unavailable'] * 2
@@ -0,0 +1,142 @@
+import importlib
+
+import pytest
+
+from shared_code import result_formats
+
+batch_orchestrator = importlib.import_module('fn-drbl-orch-openai-sql-batch')
+exec_sql_orchestrator = importlib.import_module('fn-drbl-orch-openai-exec-sql')
+sql_orchestrator = importlib.import_module('fn-drbl-orch-openai-sql')
+
+
+class FakeContext:
+    # Runs the activities scheduled by the orchestrator with the given functions
+    def __init__(self, params, activities):
+        self.params = params
+        self.activities = activities
+        self.calls = []
+        self.custom_status = []
+        self.instance_id = 'instance'
+        self.is_replaying = False
+
+    def get_input(self):
+        return self.params
+
+    def set_custom_status(self, status):
+        self.custom_status.append(status)
+
+    def call_activity(self, name, activity_input):
+        return name, activity_input
+
+    def task_all(self, tasks):
+        return tasks
+
+    def _call(self, task):
+        name, activity_input = task
+        self.calls.append((name, activity_input))
+        return self.activities[name](activity_input)
+
+    def run(self, orchestrator_function):
+        generator = orchestrator_function(self)
+        try:
+            task = next(generator)
+            while True:
+                # Lists of tasks are from task_all
+                result = [self._call(t) for t in task] if isinstance(task, list) else self._call(task)
+                task = generator.send(result)
+        except StopIteration as e:
+            return e.value
+
+
+def generate(activity_input):
+    return [f"select '{text_query}'" for text_query in activity_input['text_queries']]
+
+
+def execute(activity_input):
+    return {'url': f"https://results/{len(activity_input['sql_query'])}", 'rows': 1}
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    for name in ['POSTGRE_SQL_SERVER', 'POSTGRE_SQL_PORT', 'POSTGRE_SQL_DB_NAME', 'POSTGRE_SQL_USER',
+                 'POSTGRE_SQL_PWD', 'STORAGE_ACCOUNT_NAME', 'STORAGE_CONTAINER_NAME']:
+        monkeypatch.setenv(name, 'test')
+    monkeypatch.setattr(batch_orchestrator, 'GENERATE_BATCH_SIZE', 2)
+
+
+def run_batch(params):
+    context = FakeContext(params, {'fn-drbl-act-generate-sql-query': generate,
+                                   'fn-drbl-act-execute-sql-query': execute})
+    return context, context.run(batch_orchestrator.orchestrator_function)
+
+
+def test_batch_generates_in_windows_and_returns_manifest_in_input_order():
+    queries = ['Top 3 products', 'Sales by state', 'top 3  PRODUCTS', 'Orders in 2019', 'Customers in CA']
+    context, output = run_batch({'queries': queries, 'maxConcurrency': 1})
+    generated = [i['text_queries'] for name, i in context.calls if name == 'fn-drbl-act-generate-sql-query']
+    # Identical questions are translated once, from the first text, GENERATE_BATCH_SIZE per activity
+    assert generated == [['Top 3 products', 'Sales by state'], ['Orders in 2019', 'Customers in CA']]
+    executed = [i['sql_query'] for name, i in context.calls if name == 'fn-drbl-act-execute-sql-query']
+    assert len(executed) == 4
+    assert [r['query'] for r in output['results']] == queries
+    assert output['results'][2]['sqlQuery'] == "select 'Top 3 products'"
+    assert output['results'][2]['url'] == output['results'][0]['url']
+    assert context.custom_status[-1]['stage'] == 'completed'
+
+
+def test_batch_skips_questions_which_failed_translation():
+    failed = {'error': {'code': 'translation_failed', 'message': 'Rate limit reached'}}
+
+    def generate_with_failure(activity_input):
+        return [failed if 'fail' in q else f"select '{q}'" for q in activity_input['text_queries']]
+
+    context = FakeContext({'queries': ['Top 3 products', 'please fail', 'Sales by state']},
+                          {'fn-drbl-act-generate-sql-query': generate_with_failure,
+                           'fn-drbl-act-execute-sql-query': execute})
+    output = context.run(batch_orchestrator.orchestrator_function)
+    executed = [i['sql_query'] for name, i in context.calls if name == 'fn-drbl-act-execute-sql-query']
+    assert executed == ["select 'Top 3 products'", "select 'Sales by state'"]
+    assert output['results'][1] == {'query': 'please fail', 'sqlQuery': None, **failed}
+    assert output['results'][2]['rows'] == 1
+
+
+def test_batch_without_queries():
+    context, output = run_batch({})
+    assert output == ['Please provide a list of query texts.']
+    assert context.calls == []
+
+
+def run_exec_sql(params):
+    preview = {'columns': ['state'], 'rows': [['CA']]}
+    context = FakeContext(params, {'fn-drbl-act-execute-sql-query': lambda i: {
+        'resultsFileUrl': 'https://results', 'rows': 1, 'preview': preview}})
+    return context, context.run(exec_sql_orchestrator.orchestrator_function)
+
+
+@pytest.mark.parametrize('preview_rows, expected', [(None, 20), (5, 5), ('5', 5), (0, 0), (10**6, 100)])
+def test_exec_sql_passes_preview_rows_to_export(monkeypatch, preview_rows, expected):
+    monkeypatch.setattr(result_formats, 'RESULTS_PREVIEW_ROWS', 20)
+    monkeypatch.setattr(result_formats, 'RESULTS_PREVIEW_MAX_ROWS', 100)
+    params = {'query': 'select state from customers'}
+    if preview_rows is not None:
+        params['previewRows'] = preview_rows
+    context, output = run_exec_sql(params)
+    assert context.calls[0][1]['preview_rows'] == expected
+    assert output['preview'] == {'columns': ['state'], 'rows': [['CA']]}
+    assert context.custom_status[-1]['preview'] == output['preview']
+
+
+@pytest.mark.parametrize('preview_rows', ['ten', -1, 2.5, True, [5]])
+def test_exec_sql_rejects_invalid_preview_rows(preview_rows):
+    context, output = run_exec_sql({'query': 'select state from customers', 'previewRows': preview_rows})
+    assert output == ['previewRows must be a whole number of rows, 0 skips the preview.']
+    assert context.calls == []
+
+
+def test_sql_does_not_execute_failed_translation():
+    failed = {'error': {'code': 'translation_failed', 'message': 'Rate limit reached'}}
+    context = FakeContext({'query': 'Top 3 products'}, {'fn-drbl-act-generate-sql-query': lambda i: failed})
+    output = context.run(sql_orchestrator.orchestrator_function)
+    assert output == {'sqlQuery': None, **failed}
+    assert [name for name, i in context.calls] == ['fn-drbl-act-generate-sql-query']
+    assert context.custom_status[-1]['stage'] == 'failed'
@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from psycopg2.extensions import adapt
+
+from shared_code import parallel_export, result_stream
+
+
+class FakeCursor:
+    # Answers the queries of plan_partitions for a key with an index and the given bounds
+    def __init__(self, rows, bounds, plan_rows=None, indexed=True):
+        self.rows = rows
+        self.indexed = indexed
+        self.bounds = bounds
+        self.plan_rows = rows if plan_rows is None else plan_rows
+        self.executed = []
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        if sql.startswith('Select exists'):
+            self.result = (self.indexed,)
+        elif sql.startswith('EXPLAIN'):
+            self.result = ([{'Plan': {'Total Cost': 10, 'Plan Rows': self.plan_rows}}],)
+        elif 'percentile_disc' in sql:
+            self.result = (self.rows, self.bounds)
+        elif 'pg_export_snapshot' in sql:
+            self.result = ('00000003-00000002-1',)
+
+    def fetchone(self):
+        return self.result
+
+    def mogrify(self, sql, params):
+        return sql.replace('%s', adapt(params[0]).getquoted().decode()).encode()
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.cursor_ = cursor
+
+    def cursor(self):
+        return self.cursor_
+
+
+def test_partition_key_adds_range_to_existing_where_before_order_by():
+    sql_query = ("select s.order_number, s.quantity from sales_orders s "
+                 "where s.order_datetime >= '2019-01-01' and s.quantity > 1 order by s.order_datetime asc")
+    statement, where, key, (table, column) = parallel_export.partition_key(sql_query)
+    assert (key, table, column) == ('s.order_datetime', 'sales_orders', 'order_datetime')
+    assert parallel_export._with_condition(statement, where, "s.order_datetime < '2019-06-01'") == (
+        "select s.order_number, s.quantity from sales_orders s "
+        "where (s.order_datetime >= '2019-01-01' and s.quantity > 1) and (s.order_datetime < '2019-06-01') "
+        "order by s.order_datetime asc")
+
+
+def test_partition_key_keeps_or_conditions_together():
+    sql_query = "select * from sales_orders where order_datetime >= '2019-01-01' or order_number > 5"
+    statement, where, key, _ = parallel_export.partition_key(sql_query)
+    assert parallel_export._with_condition(statement, where, 'CONDITION') == (
+        "select * from sales_orders where (order_datetime >= '2019-01-01' or order_number > 5) and (CONDITION) ")
+
+
+@pytest.mark.parametrize('sql_query', [
+    "select * from sales_orders where order_datetime >= '2019-01-01' order by order_datetime limit 10",
+    "select * from sales_orders where order_datetime >= '2019-01-01' order by order_datetime desc",
+    "select * from sales_orders where order_datetime >= '2019-01-01' order by quantity",
+    "select count(*) from sales_orders where order_datetime >= '2019-01-01'",
+    "select distinct product_id from sales_orders where order_datetime >= '2019-01-01'",
+    'select * from sales_orders',
+    'select * from sales_orders where quantity > 1',
+    "select * from sales_orders s join sales_orders t on s.order_number = t.order_number "
+    "where s.order_datetime >= '2019-01-01'",
+    "select * from customers where customer_id > 5",
+])
+def test_partition_key_of_query_without_usable_key(sql_query):
+    assert parallel_export.partition_key(sql_query) is None
+
+
+def test_export_without_usable_key_falls_back_to_single_export(monkeypatch):
+    exported = []
+
+    def export_query_to_blob(*args):
+        exported.append(args[5])
+        return result_stream.ExportResult('https://results', 10)
+
+    def export_partitioned(*args):
+        raise AssertionError('Partitioned export of a query without a key')
+
+    @contextmanager
+    def admit(*args, **kwargs):
+        yield
+
+    monkeypatch.setattr(result_stream, 'export_query_to_blob', export_query_to_blob)
+    monkeypatch.setattr(parallel_export, '_export_partitioned', export_partitioned)
+    monkeypatch.setattr(parallel_export.admission, 'admit', admit)
+    sql_query = "select * from sales_orders where order_datetime >= '2019-01-01' order by order_datetime limit 10"
+    result = parallel_export.export_query_to_blob('host', 5432, 'db', 'user', 'password', sql_query,
+                                                  'account', 'container', 'file.csv', partitions=4)
+    assert result.url == 'https://results'
+    assert exported == [sql_query]
+
+
+def test_range_conditions_are_open_ended_at_both_ends():
+    cursor = FakeCursor(0, [])
+    assert parallel_export._range_conditions(cursor, 'so.order_number', [100, 200, 300]) == [
+        'so.order_number < 100',
+        'so.order_number >= 100 and so.order_number < 200',
+        'so.order_number >= 200 and so.order_number < 300',
+        'so.order_number >= 300 or so.order_number is null']
+
+
+def test_plan_partitions_splits_query_at_bounds(monkeypatch):
+    monkeypatch.setattr(parallel_export, 'PARALLEL_EXPORT_MIN_ROWS', 1000)
+    bounds = [datetime(2019, 4, 1), datetime(2019, 7, 1), datetime(2019, 10, 1)]
+    cursor = FakeCursor(20000, bounds)
+    sql_query = "select * from sales_orders where order_datetime >= '2019-01-01' order by order_datetime"
+    partitioning = parallel_export.plan_partitions(FakeConnection(cursor), sql_query, 4)
+    assert partitioning.rows == 20000
+    assert partitioning.snapshot == '00000003-00000002-1'
+    prefix = "select * from sales_orders where (order_datetime >= '2019-01-01') and "
+    key = 'sales_orders.order_datetime'
+    assert partitioning.queries == [
+        f"{prefix}({key} < '2019-04-01T00:00:00'::timestamp) order by order_datetime",
+        f"{prefix}({key} >= '2019-04-01T00:00:00'::timestamp and {key} < '2019-07-01T00:00:00'::timestamp) "
+        "order by order_datetime",
+        f"{prefix}({key} >= '2019-07-01T00:00:00'::timestamp and {key} < '2019-10-01T00:00:00'::timestamp) "
+        "order by order_datetime",
+        f"{prefix}({key} >= '2019-10-01T00:00:00'::timestamp or {key} is null) order by order_datetime"]
+    # The bounds are taken from the rows of the query itself, at 1/4, 2/4 and 3/4
+    [bounds_query] = [sql for sql in cursor.executed if 'percentile_disc' in sql]
+    assert 'array[0.25, 0.5, 0.75]' in bounds_query
+    assert bounds_query.endswith("from sales_orders where order_datetime >= '2019-01-01' ")
+
+
+def test_plan_partitions_merges_duplicate_bounds(monkeypatch):
+    monkeypatch.setattr(parallel_export, 'PARALLEL_EXPORT_MIN_ROWS', 1000)
+    cursor = FakeCursor(20000, [5, 5, None])
+    sql_query = 'select * from sales_orders where order_number > 1'
+    partitioning = parallel_export.plan_partitions(FakeConnection(cursor), sql_query, 4)
+    assert [q.split(' and (')[-1] for q in partitioning.queries] == [
+        'sales_orders.order_number < 5) ', 'sales_orders.order_number >= 5 or sales_orders.order_number is null) ']
+
+
+@pytest.mark.parametrize('cursor', [FakeCursor(20000, [5], plan_rows=10), FakeCursor(20000, [5], indexed=False),
+                                    FakeCursor(20000, [None, None, None])])
+def test_plan_partitions_falls_back_to_single_export(monkeypatch, cursor):
+    # Small results, keys without an index and keys without bounds are not split
+    monkeypatch.setattr(parallel_export, 'PARALLEL_EXPORT_MIN_ROWS', 1000)
+    assert parallel_export.plan_partitions(FakeConnection(cursor), 'select * from sales_orders where order_number > 1',
+                                           4) is None
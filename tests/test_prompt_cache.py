@@ -0,0 +1,69 @@
+import psycopg2
+import pytest
+
+from shared_code import prompt_cache
+from shared_code.prompt_cache import PromptSchema, PromptSchemaCache
+
+
+class FakeListener:
+    closed = False
+
+    def __init__(self):
+        self.notifies = []
+
+    def poll(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(prompt_cache.time, 'monotonic', lambda: clock[0])
+    return clock
+
+
+@pytest.fixture
+def cache(monkeypatch, clock):
+    cache = PromptSchemaCache('host', 5432, 'db', 'user', 'password', ttl=300, notify_channel='config_prompt_changed')
+    cache.connects = 0
+    cache.refreshes = 0
+    cache.database_up = False
+
+    def listen():
+        cache.connects += 1
+        if not cache.database_up:
+            raise psycopg2.OperationalError('could not connect to server')
+        return FakeListener()
+
+    def refresh():
+        cache.refreshes += 1
+        cache._schema = PromptSchema(['customers(customer_id)'], 'customers', f'v{cache.refreshes}')
+        cache._expires_at = clock[0] + cache.ttl
+
+    monkeypatch.setattr(cache, '_listen', listen)
+    monkeypatch.setattr(cache, '_refresh', refresh)
+    cache._schema = PromptSchema(['customers(customer_id)'], 'customers', 'v0')
+    cache._expires_at = clock[0] + cache.ttl
+    return cache
+
+
+def test_failed_listener_is_not_reconnected_by_every_request(cache, clock):
+    for _ in range(5):
+        assert cache.get().version == 'v0'
+        clock[0] += 1
+    assert cache.connects == 1
+    assert cache.refreshes == 0
+
+
+def test_failed_listener_is_reconnected_after_retry_interval(cache, clock):
+    cache.get()
+    clock[0] += prompt_cache.PROMPT_CACHE_LISTEN_RETRY
+    cache.get()
+    assert cache.connects == 2
+    cache.database_up = True
+    clock[0] += prompt_cache.PROMPT_CACHE_LISTEN_RETRY
+    # Changes may have been missed while not listening, so the schema is reloaded
+    assert cache.get().version == 'v1'
+    assert cache.connects == 3
+    cache.get()
+    assert cache.connects == 3
@@ -0,0 +1,177 @@
+import pytest
+
+from shared_code import query_guard
+from shared_code.query_guard import QueryRejected
+
+
+class FakeCursor:
+    # Returns the plans of the EXPLAIN queries with the given costs, in order
+    def __init__(self, costs):
+        self.costs = list(costs)
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return ([{'Plan': {'Total Cost': self.costs.pop(0)}}],)
+
+
+class FakeConnection:
+    def __init__(self, costs):
+        self.cursor_ = FakeCursor(costs)
+
+    def cursor(self):
+        return self.cursor_
+
+
+class FakeError(Exception):
+    def __init__(self, message, pgcode=None, sqlstate=None):
+        super().__init__(message)
+        self.pgcode = pgcode
+        self.sqlstate = sqlstate
+
+
+def rejection(sql_query):
+    with pytest.raises(QueryRejected) as e:
+        query_guard.check_query(sql_query)
+    return e.value
+
+
+def test_check_query_returns_statement_without_semicolon_and_comments():
+    assert query_guard.check_query('select * from customers; -- all of them\n') == 'select * from customers'
+
+
+@pytest.mark.parametrize('sql_query, found', [
+    ('with d as (delete from sales_orders returning *) select * from d', 'DELETE'),
+    ("with u as (update customers set state = 'CA' returning *) select * from u", 'UPDATE'),
+    ('with i as (insert into products (product_id) values (1) returning *) select * from i', 'INSERT'),
+])
+def test_check_query_rejects_data_modifying_cte(sql_query, found):
+    e = rejection(sql_query)
+    assert e.code == 'not_select'
+    assert found in e.message
+    assert e.sql_query == sql_query
+
+
+@pytest.mark.parametrize('sql_query', ['drop table customers', 'delete from sales_orders'])
+def test_check_query_rejects_other_statements(sql_query):
+    assert rejection(sql_query).code == 'not_select'
+
+
+@pytest.mark.parametrize('sql_query', ['select 1; delete from sales_orders', 'select 1; select 2', '', ' ; '])
+def test_check_query_rejects_anything_but_one_statement(sql_query):
+    assert rejection(sql_query).code == 'invalid_query'
+
+
+def test_apply_limit_adds_limit():
+    assert query_guard.apply_limit('select * from customers', 100) == 'select * from customers limit 100'
+
+
+def test_apply_limit_keeps_lower_limit():
+    assert query_guard.apply_limit('select * from customers limit 10', 100) == 'select * from customers limit 10'
+
+
+def test_apply_limit_lowers_higher_limit():
+    assert query_guard.apply_limit('select * from customers limit 1000', 100) == 'select * from customers limit 100'
+
+
+def test_apply_limit_ignores_limit_of_subquery():
+    sql_query = 'select * from (select * from customers limit 5) s'
+    assert query_guard.apply_limit(sql_query, 100) == f'{sql_query} limit 100'
+
+
+@pytest.mark.parametrize('sql_query', ['select * from customers limit all',
+                                       'select * from customers fetch first 500 rows only',
+                                       'select * from customers limit 10 + 5'])
+def test_apply_limit_wraps_limit_which_is_not_a_number(sql_query):
+    assert query_guard.apply_limit(sql_query, 100) == f'select * from ({sql_query}) as guarded_query limit 100'
+
+
+def test_get_limit():
+    assert query_guard.get_limit('select * from customers limit 20') == 20
+    assert query_guard.get_limit('select * from customers') is None
+    assert query_guard.get_limit('select * from customers limit all') is None
+
+
+def test_downgrade_limits_rows(monkeypatch):
+    monkeypatch.setattr(query_guard, 'QUERY_COST_ACTION', 'downgrade')
+    monkeypatch.setattr(query_guard, 'QUERY_DOWNGRADED_MAX_ROWS', 1000)
+    assert query_guard.downgrade('select * from sales_orders limit 100000', 2e6) == 'select * from sales_orders limit 1000'
+
+
+def test_downgrade_rejects_already_downgraded_query(monkeypatch):
+    monkeypatch.setattr(query_guard, 'QUERY_COST_ACTION', 'downgrade')
+    monkeypatch.setattr(query_guard, 'QUERY_DOWNGRADED_MAX_ROWS', 1000)
+    with pytest.raises(QueryRejected) as e:
+        query_guard.downgrade('select * from sales_orders limit 1000', 2e6)
+    assert e.value.code == 'query_too_expensive'
+    assert e.value.details == {'cost': 2e6, 'maxCost': query_guard.QUERY_MAX_COST}
+
+
+def test_downgrade_rejects_when_action_is_reject(monkeypatch):
+    monkeypatch.setattr(query_guard, 'QUERY_COST_ACTION', 'reject')
+    with pytest.raises(QueryRejected) as e:
+        query_guard.downgrade('select * from sales_orders limit 100000', 2e6)
+    assert e.value.code == 'query_too_expensive'
+
+
+def test_guard_query_sets_transaction_and_limit(monkeypatch):
+    monkeypatch.setattr(query_guard, 'QUERY_MAX_COST', 1000)
+    conn = FakeConnection([10])
+    assert query_guard.guard_query(conn, 'select * from customers', 100) == 'select * from customers limit 100'
+    assert conn.cursor_.executed == query_guard.SESSION_SETTINGS + [
+        'EXPLAIN (FORMAT JSON) select * from customers limit 100']
+
+
+def test_guard_query_downgrades_expensive_query(monkeypatch):
+    monkeypatch.setattr(query_guard, 'QUERY_MAX_COST', 1000)
+    monkeypatch.setattr(query_guard, 'QUERY_COST_ACTION', 'downgrade')
+    monkeypatch.setattr(query_guard, 'QUERY_DOWNGRADED_MAX_ROWS', 10)
+    conn = FakeConnection([5000, 500])
+    assert query_guard.guard_query(conn, 'select * from sales_orders', 100) == 'select * from sales_orders limit 10'
+
+
+def test_guard_query_rejects_query_still_expensive_after_downgrade(monkeypatch):
+    monkeypatch.setattr(query_guard, 'QUERY_MAX_COST', 1000)
+    monkeypatch.setattr(query_guard, 'QUERY_COST_ACTION', 'downgrade')
+    monkeypatch.setattr(query_guard, 'QUERY_DOWNGRADED_MAX_ROWS', 10)
+    conn = FakeConnection([5000, 4000])
+    with pytest.raises(QueryRejected) as e:
+        query_guard.guard_query(conn, 'select * from sales_orders', 100)
+    assert e.value.code == 'query_too_expensive'
+    assert e.value.sql_query == 'select * from sales_orders limit 10'
+    assert len(conn.cursor_.executed) == len(query_guard.SESSION_SETTINGS) + 2
+
+
+@pytest.mark.parametrize('error', [FakeError('canceling statement due to statement timeout', pgcode='57014'),
+                                   FakeError('canceling statement due to statement timeout', sqlstate='57014')])
+def test_error_result_maps_query_canceled_to_statement_timeout(error):
+    result = query_guard.error_result(error, 'select 1')
+    assert result['error']['code'] == 'statement_timeout'
+    assert result['error']['sqlQuery'] == 'select 1'
+
+
+def test_error_result_of_failed_query():
+    result = query_guard.error_result(FakeError('column "x" does not exist\n', pgcode='42703'), 'select x')
+    assert result == {'error': {'code': 'query_failed', 'message': 'column "x" does not exist', 'sqlState': '42703',
+                                'sqlQuery': 'select x'}}
+
+
+def test_error_result_of_other_exception():
+    assert query_guard.error_result(ValueError('boom'))['error']['code'] == 'internal_error'
+
+
+def test_error_result_of_rejected_query_keeps_its_sql():
+    rejected = QueryRejected('not_select', 'Only SELECT queries are allowed', 'drop table customers')
+    assert query_guard.error_result(rejected, 'other')['error']['sqlQuery'] == 'drop table customers'
+    rejected = QueryRejected('overloaded', 'Retry later', details={'retryAfter': 5})
+    assert query_guard.error_result(rejected, 'select 1') == {'error': {
+        'code': 'overloaded', 'message': 'Retry later', 'sqlQuery': 'select 1', 'retryAfter': 5}}
+    assert query_guard.is_error_result(query_guard.error_result(rejected))
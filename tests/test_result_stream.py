@@ -0,0 +1,34 @@
+import json
+from decimal import Decimal
+
+from shared_code import result_stream
+
+
+def preview_of(batches, max_rows, max_bytes=None):
+    preview = {}
+    passed = list(result_stream.take_preview([('id',), ('name',)], iter(batches), max_rows, preview, max_bytes))
+    assert passed == batches
+    return preview
+
+
+def test_take_preview_keeps_first_rows_across_batches():
+    batches = [[(1, 'a'), (2, 'b')], [(3, Decimal('1.5')), (4, 'd')]]
+    assert preview_of(batches, 3) == {'columns': ['id', 'name'], 'rows': [[1, 'a'], [2, 'b'], [3, '1.5']]}
+
+
+def test_take_preview_without_rows():
+    assert preview_of([[(1, 'a')]], 0) == {'columns': ['id', 'name'], 'rows': []}
+
+
+def test_take_preview_stops_at_byte_budget():
+    batches = [[(i, 'x' * 100) for i in range(50)]]
+    preview = preview_of(batches, 50, max_bytes=1000)
+    assert preview['truncated']
+    assert 0 < len(preview['rows']) < 50
+    assert preview['rows'] == [[i, 'x' * 100] for i in range(len(preview['rows']))]
+    assert len(json.dumps(preview).encode()) < 1100
+
+
+def test_take_preview_skips_row_larger_than_budget():
+    preview = preview_of([[(1, 'x' * 10000), (2, 'b')]], 10, max_bytes=1000)
+    assert preview == {'columns': ['id', 'name'], 'rows': [], 'truncated': True}
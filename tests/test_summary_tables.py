@@ -0,0 +1,126 @@
+import pytest
+
+from shared_code import summary_tables
+
+SUMMARY_TYPES = {'quantity': 'bigint', 'revenue': 'numeric', 'order_lines': 'bigint'}
+# Columns of the base tables and the summary tables, as loaded by `get_catalog`
+CATALOG = {
+    'sales_orders': {'order_line_item_no': 'bigint', 'order_number': 'bigint',
+                     'order_datetime': 'timestamp without time zone', 'customer_id': 'bigint', 'product_id': 'text',
+                     'unit_price': 'numeric', 'quantity': 'integer'},
+    'products': {'product_id': 'text', 'product_category': 'text', 'product_name': 'text', 'sales_price': 'numeric',
+                 'ean13': 'bigint', 'ean5': 'bigint', 'product_unit': 'text'},
+    'customers': {'customer_id': 'bigint', 'customer_name': 'text', 'state': 'text', 'city': 'text',
+                  'postcode': 'text'},
+    'sales_by_day': {'order_date': 'timestamp without time zone', 'product_id': 'text', **SUMMARY_TYPES},
+    'sales_by_day_product': {'order_date': 'timestamp without time zone', 'product_id': 'text',
+                             'product_category': 'text', 'product_name': 'text', **SUMMARY_TYPES},
+    'sales_by_day_product_state': {'order_date': 'timestamp without time zone', 'product_id': 'text',
+                                   'product_category': 'text', 'product_name': 'text', 'state': 'text',
+                                   **SUMMARY_TYPES},
+    'sales_by_customer': {'customer_id': 'bigint', 'customer_name': 'text', 'state': 'text', 'city': 'text',
+                          **SUMMARY_TYPES},
+}
+
+
+@pytest.fixture(autouse=True)
+def without_realtime(monkeypatch):
+    monkeypatch.setattr(summary_tables, 'SUMMARY_REALTIME', False)
+
+
+@pytest.mark.parametrize('sql_query, rewritten', [
+    ('select product_id, sum(quantity) from sales_orders group by product_id',
+     'select product_id, sum(quantity)::bigint from summary.sales_by_day group by product_id;'),
+    ('select p.product_name, sum(s.quantity) as total_quantity from sales_orders s '
+     'join products p on p.product_id = s.product_id group by p.product_name order by total_quantity desc limit 10',
+     'select product_name, sum(quantity)::bigint as total_quantity from summary.sales_by_day_product '
+     'group by product_name order by total_quantity desc limit 10;'),
+    ('select c.state, p.product_name, sum(so.unit_price * so.quantity) as revenue from sales_orders so '
+     'join products p on so.product_id = p.product_id join customers c on c.customer_id = so.customer_id '
+     'group by c.state, p.product_name',
+     'select state, product_name, sum(revenue)::numeric as revenue from summary.sales_by_day_product_state '
+     'group by state, product_name;'),
+    ("select date_trunc('month', order_datetime) as month, count(*) from sales_orders group by 1 order by 1",
+     "select date_trunc('month', order_date) as month, coalesce(sum(order_lines), 0)::bigint "
+     "from summary.sales_by_day group by 1 order by 1;"),
+    ('select c.customer_name, sum(s.quantity) from sales_orders s join customers c using (customer_id) '
+     'group by c.customer_name',
+     'select customer_name, sum(quantity)::bigint from summary.sales_by_customer group by customer_name;'),
+    ("select product_id, sum(quantity) from sales_orders "
+     "where order_datetime >= '2019-01-01' and order_datetime < '2019-02-01' group by product_id",
+     "select product_id, sum(quantity)::bigint from summary.sales_by_day "
+     "where order_date >= '2019-01-01' and order_date < '2019-02-01' group by product_id;"),
+    ("select product_id, sum(quantity) from sales_orders where order_datetime::date = '2019-01-01' "
+     "group by product_id having sum(quantity) > 10",
+     "select product_id, sum(quantity)::bigint from summary.sales_by_day where order_date::date = '2019-01-01' "
+     "group by product_id having sum(quantity)::bigint > 10;"),
+])
+def test_rewrite_to_summary(sql_query, rewritten):
+    assert summary_tables.rewrite(sql_query, CATALOG) == rewritten
+
+
+@pytest.mark.parametrize('sql_query', [
+    # Filters on columns which are not in the summary
+    'select product_id, sum(quantity) from sales_orders where order_number > 5 group by product_id',
+    'select product_id, sum(quantity) from sales_orders where unit_price > 5 group by product_id',
+    "select product_id, sum(quantity) from sales_orders where order_datetime >= '2019-01-01 12:00' "
+    "group by product_id",
+    "select product_id, sum(quantity) from sales_orders where order_datetime < '2019-01-01' + 1 group by product_id",
+    # DISTINCT
+    'select count(distinct product_id) from sales_orders',
+    'select distinct product_id from sales_orders',
+    # HAVING on raw columns
+    'select product_id, sum(quantity) from sales_orders group by product_id having max(unit_price) > 10',
+    'select product_id, sum(quantity) from sales_orders group by product_id having sum(unit_price) > 10',
+    # Joins no summary has, or which are not inner joins on the join column
+    'select p.sales_price, sum(s.quantity) from sales_orders s join products p on p.product_id = s.product_id '
+    'group by p.sales_price',
+    'select p.product_name, sum(s.quantity) from sales_orders s left join products p on p.product_id = s.product_id '
+    'group by p.product_name',
+    'select p.product_name, sum(s.quantity) from sales_orders s join products p on p.ean13 = s.order_number '
+    'group by p.product_name',
+    'select c.city, sum(s.quantity) from sales_orders s join customers c on c.customer_id = s.customer_id '
+    'join products p on p.product_id = s.product_id group by c.city',
+    'select p.product_name, sum(s.quantity) from sales_orders s, products p where p.product_id = s.product_id '
+    'group by p.product_name',
+    # Aggregates which can't be computed from the sums, or no aggregate at all
+    'select product_id, avg(quantity) from sales_orders group by product_id',
+    "select date_trunc('hour', order_datetime), count(*) from sales_orders group by 1",
+    'select product_id, quantity from sales_orders',
+    'select * from sales_orders',
+    # Set operations and subqueries
+    'select product_id, sum(quantity) from sales_orders group by product_id '
+    'union all select product_id, 1 from sales_orders',
+    'select product_id, sum(quantity) from sales_orders where product_id in (select product_id from products) '
+    'group by product_id',
+])
+def test_rewrite_leaves_query_unchanged(sql_query):
+    assert summary_tables.rewrite(sql_query, CATALOG) is None
+
+
+def test_rewrite_needs_summary_table():
+    catalog = {name: columns for name, columns in CATALOG.items() if name != 'sales_by_day'}
+    assert summary_tables.rewrite('select product_id, sum(quantity) from sales_orders group by product_id',
+                                  catalog) is None
+
+
+def test_rewrite_sums_new_order_lines_in_realtime(monkeypatch):
+    monkeypatch.setattr(summary_tables, 'SUMMARY_REALTIME', True)
+    rewritten = summary_tables.rewrite('select product_id, sum(quantity) from sales_orders group by product_id',
+                                       CATALOG)
+    assert rewritten.startswith('select product_id, sum(quantity)::bigint from (select * from summary.sales_by_day '
+                                'union all select ')
+    assert ("where sales_orders.order_line_item_no > (select watermark from summary.refresh_state "
+            "where summary_name = 'sales_by_day')") in rewritten
+    assert rewritten.endswith(') as sales_by_day group by product_id;')
+
+
+def test_rewrite_query_falls_back_to_base_tables(monkeypatch):
+    monkeypatch.setattr(summary_tables, 'SUMMARY_TABLES_ENABLED', True)
+
+    def get_catalog(*args):
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(summary_tables, 'get_catalog', get_catalog)
+    sql_query = 'select product_id, sum(quantity) from sales_orders group by product_id'
+    assert summary_tables.rewrite_query('host', 5432, 'db', 'user', 'password', sql_query) == sql_query
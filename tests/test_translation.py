@@ -0,0 +1,33 @@
+from collections import namedtuple
+
+import pytest
+
+from shared_code import openai_batch, prompt_cache, summary_tables, translation, translation_cache
+
+PromptSchema = namedtuple('PromptSchema', ['version'])
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = translation_cache.TranslationCache(translation_cache.MemoryStore())
+    monkeypatch.setattr(translation_cache, 'get_translation_cache', lambda: cache)
+    monkeypatch.setattr(prompt_cache, 'get_prompt_schema', lambda *args: PromptSchema(1))
+    monkeypatch.setattr(summary_tables, 'rewrite_query', lambda *args: args[-1])
+    return cache
+
+
+def test_translate_text_queries_returns_error_of_failed_questions(monkeypatch, cache):
+    async def generate_sql_queries(prompt_schema, text_queries, **params):
+        return [RuntimeError('Rate limit reached') if 'fail' in q else f"select '{q}';" for q in text_queries]
+
+    monkeypatch.setattr(openai_batch, 'generate_sql_queries', generate_sql_queries)
+    cache.set(1, 'cached question', 'select 1;', model='engine')
+    sql_queries = translation.translate_text_queries('host', 5432, 'db', 'user', 'password',
+                                                     ['cached question', 'please fail', 'new question'],
+                                                     engine='engine')
+    assert sql_queries == ['select 1;',
+                           {'error': {'code': 'translation_failed', 'message': 'Rate limit reached'}},
+                           "select 'new question';"]
+    # Failures are not cached
+    assert cache.get(1, 'please fail', model='engine') is None
+    assert cache.get(1, 'new question', model='engine') == "select 'new question';"
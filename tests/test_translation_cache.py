@@ -0,0 +1,70 @@
+import pytest
+
+from shared_code import translation_cache
+from shared_code.translation_cache import MemoryStore, TranslationCache, normalize_text
+
+
+@pytest.mark.parametrize('text_query, normalized', [
+    ('  Top 3   products, by sales? ', 'top 3 products by sales'),
+    ('TOP 3 PRODUCTS BY SALES', 'top 3 products by sales'),
+    ('Top 3 Products By Sales', 'top 3 products by sales'),
+    ('Customers in CA', 'customers in CA'),
+    ('Customers In CA', 'customers in CA'),
+    ("orders of 'Smith' in 2019", "orders of 'Smith' in 2019"),
+    ('orders of Smith', 'orders of Smith'),
+])
+def test_normalize_text(text_query, normalized):
+    assert normalize_text(text_query) == normalized
+
+
+@pytest.fixture
+def cache():
+    cache = TranslationCache(MemoryStore(), similarity=0.8)
+    cache.set(1, 'top 3 products by sales', 'select 3', model='model')
+    cache.set(1, 'customers in CA', 'select CA', model='model')
+    cache.set(1, "orders of 'Smith'", 'select Smith', model='model')
+    cache.set(1, 'customers with orders', 'select with', model='model')
+    return cache
+
+
+@pytest.mark.parametrize('text_query, sql_query', [
+    ('Top 3 products by sales', 'select 3'),
+    ('top 3   products  by sales.', 'select 3'),
+    ('TOP 3 PRODUCTS BY SALES', 'select 3'),
+    ('Top 3 Products By Sales', 'select 3'),
+    ('show the top 3 products by sales', 'select 3'),
+    ('Customers in CA!', 'select CA'),
+])
+def test_get_matches_whitespace_case_and_stopword_differences(cache, text_query, sql_query):
+    assert cache.get(1, text_query, model='model') == sql_query
+
+
+@pytest.mark.parametrize('text_query', [
+    'top 5 products by sales',
+    'top 3 products by revenue',
+    'customers in CO',
+    'customers in ca',
+    "orders of 'Smyth'",
+    'orders of "Smith"',
+    'customers without orders',
+])
+def test_get_refuses_different_numbers_literals_and_negations(cache, text_query):
+    assert cache.get(1, text_query, model='model') is None
+
+
+def test_get_is_scoped_by_model_and_schema_version(cache):
+    assert cache.get(2, 'top 3 products by sales', model='model') is None
+    assert cache.get(1, 'top 3 products by sales', model='other') is None
+
+
+def test_get_without_near_duplicate_matching():
+    cache = TranslationCache(MemoryStore(), similarity=1.0)
+    cache.set(1, 'top 3 products by sales', 'select 3')
+    assert cache.get(1, 'Top 3 products by sales') == 'select 3'
+    assert cache.get(1, 'show the top 3 products by sales') is None
+
+
+def test_get_expires_entries(monkeypatch, cache):
+    now = translation_cache.time.time()
+    monkeypatch.setattr(translation_cache.time, 'time', lambda: now + cache.ttl + 1)
+    assert cache.get(1, 'top 3 products by sales', model='model') is None